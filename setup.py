@@ -16,7 +16,8 @@ setup(
       packages=find_packages(),
       include_package_data=True,
       unit_test='pytest',
-      install_requires=['numpy', 'scipy', 'pandas', 'matplotlib', 'lmfit'],
+      python_requires='>=3.8',
+      install_requires=['numpy>=1.17', 'scipy>=1.4', 'pandas', 'matplotlib', 'lmfit'],
       classifiers=["Programming Language :: Python :: 3",
                    "License :: OSI Approved :: MIT License",
                    "Intended Audience :: Science/Research",
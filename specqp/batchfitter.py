@@ -0,0 +1,479 @@
+""" Provides class BatchFit for fitting the same model independently to many spectra at once,
+function fit_regions for fitting it to many regions in a process pool and function bootstrap
+for estimating confidence intervals of fitted parameters by refitting resampled spectra
+"""
+import logging
+import math
+import os
+import time
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from specqp.fitter import CompositeModel, Peak
+
+batchfitter_logger = logging.getLogger("specqp.batchfitter")  # Creating child logger
+
+
+class BatchFit:
+    """Fits one CompositeModel independently to every spectrum of a stack sharing the same energy axis.
+    Levenberg-Marquardt iterations run for all spectra at once on (n_spectra, n_points, n_params) arrays,
+    every spectrum having its own damping and leaving the iterations as soon as it has converged.
+    """
+
+    def __init__(self, energy, intensities, peaks, bg=None, bindingscale=True):
+        """
+        :param energy: x axis common for all spectra
+        :param intensities: 2D array (n_spectra, n_points) of y data
+        :param peaks: list of peak dictionaries (see CompositeModel) or a CompositeModel, then bg and bindingscale
+        are taken from it
+        :param bg: dictionary of backgrounds or list of background names (see CompositeModel)
+        :param bindingscale: True if the energy axis is binding energy
+        """
+        self.energy = np.asarray(energy, dtype=float)
+        self.intensities = np.atleast_2d(np.asarray(intensities, dtype=float))
+        if self.intensities.shape[1] != self.energy.size:
+            raise ValueError(f"Intensities of {self.intensities.shape[1]} points don't match "
+                             f"the energy axis of {self.energy.size} points")
+        if isinstance(peaks, CompositeModel):
+            self.model = peaks
+        else:
+            self.model = CompositeModel(peaks, bg, bindingscale=bindingscale)
+        self.names = self.model.names
+        n_spectra = self.intensities.shape[0]
+        # Results of the last fit
+        self.success = np.zeros(n_spectra, dtype=bool)
+        # Spectra where no step decreased the cost any longer, converged only if the gradient vanished (see fit())
+        self.stalled = np.zeros(n_spectra, dtype=bool)
+        self.iterations = np.zeros(n_spectra, dtype=int)
+        self.cost = np.full(n_spectra, np.nan)
+        self.nfev = 0
+
+    @classmethod
+    def from_region(cls, region, peaks, bg=None, y_data='final'):
+        """Creates BatchFit for all sweeps of an add-dimension region (or the only spectrum of a regular one)
+        :param region: Region object
+        :param peaks: list of peak dictionaries (see CompositeModel)
+        :param bg: backgrounds (see CompositeModel)
+        :param y_data: name of the intensity column. Columns f"{y_data}{i}" are used for add-dimension regions
+        :return: BatchFit
+        """
+        if region.is_add_dimension():
+            intensities = [region.get_data(f"{y_data}{i}") for i in range(region.get_add_dimension_counter())]
+        else:
+            intensities = [region.get_data(y_data)]
+        return cls(region.get_data('energy'), intensities, peaks, bg, bindingscale=bool(region.is_binding()))
+
+    def expand(self, free_values):
+        """Returns (n_spectra, n_params) array of all parameters for (n_spectra, n_free) array of free parameters
+        """
+        values = np.repeat(self.model.values[np.newaxis, :], len(free_values), axis=0)
+        values[:, self.model.free] = free_values
+        for ind, base, operation in self.model.links:
+            if operation == '+':
+                values[:, ind] = values[:, base] + values[:, ind]
+            else:
+                values[:, ind] = values[:, base] * values[:, ind]
+        return values
+
+    def evaluate(self, values):
+        """Calculates the model lines for (n_spectra, n_params) array of parameters
+        :return: (ndarray, ndarray) total lines and backgrounds, both of shape (n_spectra, n_points)
+        """
+        line, bg = self.model.evaluate(self.energy, values.T[:, :, np.newaxis])
+        # A model without peaks or spectrum-dependent backgrounds doesn't have the spectra axis
+        shape = (len(values), self.energy.size)
+        if line.shape != shape:
+            line = np.broadcast_to(line, shape).copy()
+        if bg.shape != shape:
+            bg = np.broadcast_to(bg, shape).copy()
+        return line, bg
+
+    def _model_lines(self, free_values):
+        self.nfev += 1
+        return self.evaluate(self.expand(free_values))[0]
+
+    def _jacobian(self, free_values, lines):
+        """Forward-difference derivatives of the model lines with respect to the free parameters,
+        one batched model evaluation per parameter.
+        :return: (n_spectra, n_points, n_free) array
+        """
+        lower, upper = self.model.lower[self.model.free], self.model.upper[self.model.free]
+        jacobian = np.empty(lines.shape + (free_values.shape[1],))
+        for j in range(free_values.shape[1]):
+            step = np.sqrt(np.finfo(float).eps) * np.maximum(np.absolute(free_values[:, j]), 1.0)
+            # Stepping backwards where the forward step leaves the bounds
+            step = np.where(free_values[:, j] + step > upper[j], -step, step)
+            shifted = free_values.copy()
+            shifted[:, j] += step
+            shifted[:, j] = np.clip(shifted[:, j], lower[j], upper[j])
+            actual_step = shifted[:, j] - free_values[:, j]
+            actual_step[actual_step == 0] = np.inf
+            jacobian[:, :, j] = (self._model_lines(shifted) - lines) / actual_step[:, np.newaxis]
+        return jacobian
+
+    @staticmethod
+    def _solve(matrices, vectors):
+        try:
+            return np.linalg.solve(matrices, vectors[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            return np.einsum('smk,sk->sm', np.linalg.pinv(matrices, hermitian=True), vectors)
+
+    def fit(self, p0=None, max_iter=200, ftol=1e-8, xtol=1e-8, gtol=1e-5, damping=1e-3):
+        """Runs Levenberg-Marquardt iterations for all spectra until every one has converged or max_iter is reached.
+        Steps are projected onto the parameter bounds.
+        :param p0: (n_spectra, n_free) or (n_free,) initial values of free parameters.
+        If None, values from the peaks description are used for all spectra
+        :param max_iter: maximal number of iterations
+        :param ftol: convergence tolerance of the relative decrease of the cost
+        :param xtol: convergence tolerance of the relative step size
+        :param gtol: convergence tolerance of the largest cosine between the residuals and a column of the Jacobian,
+        only used for spectra where no step decreases the cost any longer. If it is not met, the spectrum is left
+        with success False and stalled True
+        :param damping: initial damping factor
+        :return: (ndarray, ndarray) values and errors of all parameters, both (n_spectra, n_params)
+        """
+        n_spectra = self.intensities.shape[0]
+        free = self.model.free
+        lower, upper = self.model.lower[free], self.model.upper[free]
+        if p0 is None:
+            p0 = self.model.values[free]
+        free_values = np.clip(np.broadcast_to(np.asarray(p0, dtype=float), (n_spectra, len(free))),
+                              lower, upper).copy()
+        self.nfev = 0
+        self.iterations[:] = 0
+        self.success[:] = False
+        self.stalled[:] = False
+        lines = self._model_lines(free_values)
+        residuals = self.intensities - lines
+        cost = 0.5 * np.sum(residuals ** 2, axis=1)
+        if len(free) == 0:
+            self.cost = cost
+            self.success[:] = True
+            values = self.expand(free_values)
+            return values, np.zeros_like(values)
+
+        lambdas = np.full(n_spectra, float(damping))
+        active = np.ones(n_spectra, dtype=bool)
+        for _ in range(max_iter):
+            spectra = np.flatnonzero(active)
+            if spectra.size == 0:
+                break
+            self.iterations[spectra] += 1
+            x = free_values[spectra]
+            jacobian = self._jacobian(x, lines[spectra])
+            hessian = np.matmul(jacobian.transpose(0, 2, 1), jacobian)
+            gradient = np.matmul(jacobian.transpose(0, 2, 1), residuals[spectra, :, np.newaxis])[..., 0]
+            # Parameters sitting on a bound with the descent direction pointing outwards are kept there
+            at_bound = ((x <= lower) & (gradient < 0)) | ((x >= upper) & (gradient > 0))
+            gradient[at_bound] = 0.0
+            hessian *= ~at_bound[:, :, np.newaxis] & ~at_bound[:, np.newaxis, :]
+            diagonal = np.maximum(np.einsum('smm->sm', hessian), np.finfo(float).eps)
+            damped = hessian + (lambdas[spectra, np.newaxis] * diagonal)[..., np.newaxis] * np.eye(len(free))
+            trial = np.clip(x + self._solve(damped, gradient), lower, upper)
+            step = trial - x
+            # Decrease of the cost predicted by the linearized model
+            predicted = (np.einsum('sm,sm->s', gradient, step) -
+                         0.5 * np.einsum('sm,smk,sk->s', step, hessian, step))
+            trial_lines = self._model_lines(trial)
+            trial_residuals = self.intensities[spectra] - trial_lines
+            trial_cost = 0.5 * np.sum(trial_residuals ** 2, axis=1)
+
+            better = trial_cost < cost[spectra]
+            accepted = spectra[better]
+            small_step = np.all(np.absolute(step) <= xtol * (xtol + np.absolute(x)), axis=1)
+            small_decrease = ((np.absolute(cost[spectra] - trial_cost) <= ftol * cost[spectra]) &
+                              (predicted <= ftol * cost[spectra]))
+            free_values[accepted] = trial[better]
+            lines[accepted] = trial_lines[better]
+            residuals[accepted] = trial_residuals[better]
+            cost[accepted] = trial_cost[better]
+            lambdas[accepted] = np.maximum(lambdas[accepted] / 10, 1e-12)
+            lambdas[spectra[~better]] *= 10
+            converged = spectra[small_step | small_decrease]
+            self.success[converged] = True
+            active[converged] = False
+            # The step can't decrease the cost any longer even with the steepest-descent-like damping. That is
+            # a minimum only if the residuals are orthogonal to the columns of the Jacobian
+            stuck = ~better & (lambdas[spectra] > 1e10)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cosines = np.absolute(gradient[stuck]) / np.sqrt(np.einsum('smm->sm', hessian[stuck]) *
+                                                                 2 * cost[spectra[stuck], np.newaxis])
+            self.stalled[spectra[stuck]] = True
+            self.success[spectra[stuck]] = np.all(np.nan_to_num(cosines) <= gtol, axis=1)
+            active[spectra[stuck]] = False
+        if np.any(active):
+            batchfitter_logger.warning(f"{np.count_nonzero(active)} of {n_spectra} spectra didn't converge "
+                                       f"in {max_iter} iterations")
+        failed = self.stalled & ~self.success
+        if np.any(failed):
+            batchfitter_logger.warning(f"{np.count_nonzero(failed)} of {n_spectra} spectra stalled "
+                                       f"away from a minimum")
+        self.cost = cost
+        return self.expand(free_values), self._errors(free_values, lines, cost)
+
+    def _errors(self, free_values, lines, cost):
+        """Errors of all parameters from the covariance of free parameters scaled by the reduced chi-square
+        """
+        n_spectra, n_points = lines.shape
+        free = self.model.free
+        jacobian = self._jacobian(free_values, lines)
+        covariance = np.linalg.pinv(np.matmul(jacobian.transpose(0, 2, 1), jacobian), hermitian=True)
+        dof = n_points - len(free)
+        if dof > 0:
+            covariance *= (2 * cost / dof)[:, np.newaxis, np.newaxis]
+        else:
+            covariance.fill(np.inf)
+        # Derivatives of all parameters with respect to the free ones through the dependencies
+        raw = np.repeat(self.model.values[np.newaxis, :], n_spectra, axis=0)
+        raw[:, free] = free_values
+        values = self.expand(free_values)
+        derivatives = np.zeros((n_spectra, len(self.names), len(free)))
+        derivatives[:, free, np.arange(len(free))] = 1.0
+        for ind, base, operation in self.model.links:
+            if operation == '+':
+                derivatives[:, ind] = derivatives[:, base] + derivatives[:, ind]
+            else:
+                derivatives[:, ind] = (raw[:, ind, np.newaxis] * derivatives[:, base] +
+                                       values[:, base, np.newaxis] * derivatives[:, ind])
+        variances = np.einsum('spm,smk,spk->sp', derivatives, covariance, derivatives)
+        return np.sqrt(np.absolute(variances))
+
+
+# State of a fit_regions worker process: the shared data block and the models for binding and kinetic scales
+_worker = {}
+
+
+def _init_worker(shm_name, size, peaks, bg):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['data'] = np.ndarray((size,), dtype=float, buffer=shm.buf)
+    _worker['models'] = {binding: CompositeModel(peaks, bg, bindingscale=binding) for binding in (True, False)}
+
+
+def _fit_chunk(chunk, kws):
+    """Fits the regions of one chunk reading their energy and intensity from the shared data block
+    :param chunk: list of tuples (offset, number of points, True if binding energy scale)
+    :return: (ndarray, ndarray, ndarray, ndarray) values and errors (n_regions, n_params), costs and success flags
+    """
+    data, models = _worker['data'], _worker['models']
+    n_params = len(models[True].names)
+    values = np.full((len(chunk), n_params), np.nan)
+    errors = np.full((len(chunk), n_params), np.nan)
+    costs = np.full(len(chunk), np.nan)
+    success = np.zeros(len(chunk), dtype=bool)
+    for i, (offset, npoints, binding) in enumerate(chunk):
+        energy = data[offset:offset + npoints]
+        intensity = data[offset + npoints:offset + 2 * npoints]
+        try:
+            values[i], errors[i], result = models[binding].fit(energy, intensity, **kws)
+        except ValueError as err:
+            batchfitter_logger.warning(f"Fit of a region failed: {err}")
+            continue
+        if result is None:
+            costs[i] = 0.5 * np.sum((intensity - models[binding].evaluate(energy, values[i])[0]) ** 2)
+            success[i] = True
+        else:
+            costs[i] = result.cost
+            success[i] = result.success
+    return values, errors, costs, success
+
+
+def fit_regions(regions, peaks, bg=None, y_data='final', processes=None, chunksize=None, cache=None, **kws):
+    """Fits one model independently to every region, dispatching the fits to a pool of processes.
+    Energy and intensity arrays of all regions are copied once into a shared memory block
+    which the workers read directly, so only short chunk descriptions and results are pickled.
+    :param regions: RegionsCollection or list of Region objects
+    :param peaks: list of peak dictionaries (see CompositeModel)
+    :param bg: backgrounds (see CompositeModel)
+    :param y_data: name of the intensity column
+    :param processes: number of worker processes, os.cpu_count() if None. With 1 the fits run in this process
+    :param chunksize: number of regions sent to a worker at once. By default every worker gets about 4 chunks
+    :param cache: FitCache (e.g. fitcache.fit_cache) to take the results of regions fitted before with the same model
+    and options from. Only the other regions are fitted, their results are stored in the cache
+    :param kws: keyword arguments passed to scipy.optimize.least_squares
+    :return: pandas DataFrame indexed by region IDs with parameter values, their errors (columns with '_err'
+    suffix), the cost and the success flag for every region
+    """
+    if hasattr(regions, 'get_regions'):
+        regions = list(regions.get_regions())
+    names = CompositeModel(peaks, bg).names
+    ids = [region.get_id() for region in regions]
+    columns = names + [f"{name}_err" for name in names] + ['cost', 'success']
+    if not regions:
+        return pd.DataFrame(columns=columns)
+    if cache is not None:
+        keys = [cache.make_key(region, y_data, 'fit_regions', peaks, bg, kws) for region in regions]
+        rows = [cache.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            fitted = fit_regions([regions[i] for i in missing], peaks, bg, y_data=y_data, processes=processes,
+                                 chunksize=chunksize, **kws)
+            for i, (_, row) in zip(missing, fitted.iterrows()):
+                rows[i] = row.to_list()
+                cache.put(keys[i], rows[i])
+        table = pd.DataFrame(rows, index=ids, columns=columns)
+        table['success'] = table['success'].astype(bool)
+        return table
+    sizes = [len(region.get_data('energy')) for region in regions]
+    total = 2 * sum(sizes)
+    shm = shared_memory.SharedMemory(create=True, size=max(total, 1) * np.dtype(float).itemsize)
+    try:
+        data = np.ndarray((total,), dtype=float, buffer=shm.buf)
+        tasks = []
+        offset = 0
+        for region, npoints in zip(regions, sizes):
+            data[offset:offset + npoints] = region.get_data('energy')
+            data[offset + npoints:offset + 2 * npoints] = region.get_data(y_data)
+            tasks.append((offset, npoints, bool(region.is_binding())))
+            offset += 2 * npoints
+        del data
+        processes = min(processes or os.cpu_count() or 1, len(tasks))
+        if chunksize is None:
+            chunksize = math.ceil(len(tasks) / (4 * processes))
+        chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+        if processes > 1:
+            with Pool(processes, initializer=_init_worker, initargs=(shm.name, total, peaks, bg)) as pool:
+                results = pool.starmap(_fit_chunk, [(chunk, kws) for chunk in chunks])
+        else:
+            _init_worker(shm.name, total, peaks, bg)
+            try:
+                results = [_fit_chunk(chunk, kws) for chunk in chunks]
+            finally:
+                _worker.pop('data')
+                _worker.pop('shm').close()
+    finally:
+        shm.close()
+        shm.unlink()
+    values, errors, costs, success = (np.concatenate(parts) for parts in zip(*results))
+    if not np.all(success):
+        batchfitter_logger.warning(f"{np.count_nonzero(~success)} of {len(success)} regions were not fitted")
+    table = pd.DataFrame(np.hstack([values, errors]), index=ids, columns=columns[:-2])
+    table['cost'] = costs
+    table['success'] = success
+    return table
+
+
+def _init_bootstrap(setups):
+    _worker['bootstrap'] = setups
+
+
+def _bootstrap_chunk(fit_ind, seed, size, method):
+    """Refits one chunk of resampled spectra of the fit number fit_ind
+    :return: (int, ndarray, ndarray) fit number, values of all parameters (size, n_params) with NaN for the refits
+    that didn't converge and peak areas (size, n_peaks)
+    """
+    model, energy, intensity, line, residuals, p0 = _worker['bootstrap'][fit_ind]
+    rng = np.random.default_rng(seed)
+    if method == 'poisson':
+        samples = rng.poisson(np.clip(intensity, 0, None), size=(size, len(intensity))).astype(float)
+    else:
+        samples = line + residuals[rng.integers(0, len(residuals), size=(size, len(residuals)))]
+    batch = BatchFit(energy, samples, model)
+    values, _ = batch.fit(p0=p0)
+    values[~batch.success] = np.nan
+    energy_range = (np.min(energy), np.max(energy))
+    areas = np.column_stack([Peak.calculate_area(fittype, values[:, indices].T, energy_range, model.bindingscale)
+                             for _, fittype, indices in model.peaks]) if model.peaks else np.empty((size, 0))
+    return fit_ind, values, areas
+
+
+def bootstrap(fitters, n_samples=200, method='residual', confidence=0.95, time_budget=None, processes=1,
+              chunksize=25, seed=None):
+    """Estimates confidence intervals of fitted parameters and peak areas by refitting resampled spectra.
+    Unlike the errors from the covariance matrix, the intervals account for the correlations of overlapping
+    components and for asymmetric uncertainties. Resampled spectra are generated in chunks, every chunk is refitted
+    at once with BatchFit starting from the best fit, the chunks are distributed over a pool of processes.
+    :param fitters: Fitter or list of Fitter objects fitted with Fitter.fit(), GlobalFit.fit() or
+    GlobalFit.fit_sequential() (see Fitter.get_fit_model()). 'Common' parameters of a global fit are resampled
+    within every spectrum independently
+    :param n_samples: number of resampled spectra for every fitter
+    :param method: 'residual' to add the residuals of the best fit drawn with replacement to the fit line,
+    'poisson' to draw the counts of every point from the Poisson distribution around the measured ones (the
+    intensity must be in counts)
+    :param confidence: confidence level of the percentile intervals
+    :param time_budget: time in seconds after which no more chunks are started, the intervals are then calculated
+    from the samples refitted so far
+    :param processes: number of worker processes, os.cpu_count() if None. With 1 the fits run in this process
+    :param chunksize: number of resampled spectra refitted at once
+    :param seed: seed of the random generator, the results don't depend on the number of processes
+    :return: pandas DataFrame indexed by (fitter ID, parameter name) with the fitted value, standard deviation and
+    the lower and upper limits of the interval for every parameter and every peak area (names with '_area' suffix)
+    and the number of converged refits
+    """
+    if method not in ('residual', 'poisson'):
+        raise ValueError(f"Unknown resampling method '{method}'")
+    if not isinstance(fitters, (list, tuple)):
+        fitters = [fitters]
+    setups, index = [], []
+    for fitterobj in fitters:
+        if fitterobj.get_fit_model() is None:
+            raise ValueError(f"Fitter {fitterobj.get_id()} has no fit to resample")
+        model, values = fitterobj.get_fit_model()
+        energy, intensity = (np.asarray(data, dtype=float) for data in fitterobj.get_data())
+        line = model.evaluate(energy, values)[0]
+        residuals = intensity - line
+        # Residuals are inflated for the degrees of freedom taken by the fit
+        if len(intensity) > len(model.free):
+            residuals = (residuals - residuals.mean()) * np.sqrt(len(intensity) / (len(intensity) - len(model.free)))
+        setups.append((model, energy, intensity, line, residuals, model.contract(values)))
+        index += [(fitterobj.get_id(), name) for name in model.names]
+        index += [(fitterobj.get_id(), f"{peak_id}_area") for peak_id, _, _ in model.peaks]
+    # Chunks go round the fitters, so that all of them get samples before the time budget is over
+    sizes = [min(chunksize, n_samples - start) for start in range(0, n_samples, chunksize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes) * len(fitters))
+    tasks = [(fit_ind, seeds[chunk_ind * len(fitters) + fit_ind], size, method)
+             for chunk_ind, size in enumerate(sizes) for fit_ind in range(len(fitters))]
+    start = time.perf_counter()
+
+    def in_budget():
+        return time_budget is None or time.perf_counter() - start < time_budget
+
+    results = []
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    if processes > 1:
+        with Pool(processes, initializer=_init_bootstrap, initargs=(setups,)) as pool:
+            pending = [pool.apply_async(_bootstrap_chunk, task) for task in tasks[:processes]]
+            submitted = len(pending)
+            while pending:
+                results.append(pending.pop(0).get())
+                if submitted < len(tasks) and in_budget():
+                    pending.append(pool.apply_async(_bootstrap_chunk, tasks[submitted]))
+                    submitted += 1
+    else:
+        _init_bootstrap(setups)
+        try:
+            for task in tasks:
+                if not in_budget():
+                    break
+                results.append(_bootstrap_chunk(*task))
+        finally:
+            _worker.pop('bootstrap')
+    if len(results) < len(tasks):
+        batchfitter_logger.info(f"Time budget of {time_budget} s is over after {len(results)} of {len(tasks)} "
+                                f"chunks of resampled spectra")
+
+    rows = []
+    alpha = (1 - confidence) / 2
+    for fit_ind, (model, energy, _, _, _, p0) in enumerate(setups):
+        parts = [np.hstack(result[1:]) for result in results if result[0] == fit_ind]
+        samples = np.vstack(parts) if parts else np.empty((0, len(model.names) + len(model.peaks)))
+        best = model.expand(p0)
+        energy_range = (np.min(energy), np.max(energy))
+        best = np.concatenate([best, [Peak.calculate_area(fittype, best[indices], energy_range, model.bindingscale)
+                                      for _, fittype, indices in model.peaks]])
+        converged = samples[~np.isnan(samples).any(axis=1)]
+        if len(converged) < len(samples):
+            batchfitter_logger.warning(f"{len(samples) - len(converged)} of {len(samples)} refits of "
+                                       f"{fitters[fit_ind].get_id()} didn't converge")
+        if len(converged) > 1:
+            low, high = np.quantile(converged, [alpha, 1 - alpha], axis=0)
+            std = converged.std(axis=0, ddof=1)
+        else:
+            low = high = std = np.full(len(best), np.nan)
+        rows.append(np.column_stack([best, std, low, high, np.full(len(best), len(converged))]))
+    table = pd.DataFrame(np.vstack(rows), index=pd.MultiIndex.from_tuples(index, names=['fit', 'parameter']),
+                         columns=['value', 'std', 'low', 'high', 'samples'])
+    table['samples'] = table['samples'].astype(int)
+    return table
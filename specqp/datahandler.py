@@ -7,6 +7,8 @@ import ntpath
 import logging
 import copy
 import csv
+import hashlib
+import json
 import pandas as pd
 import numpy as np
 
@@ -349,6 +351,10 @@ class Region:
         """
         # The main attribute of the class is pandas dataframe
         self._data = pd.DataFrame(data={'energy': energy, 'counts': counts}, dtype=float)
+        # Content hashes of the data columns {column: digest} and of the metadata, calculated when requested
+        # and dropped when the column or the metadata change (see get_fingerprint())
+        self._column_hashes = {}
+        self._meta_hash = None
         self._applied_corrections = []
         self._info = info
         self._id = id_
@@ -425,9 +431,19 @@ class Region:
                                        "Pass overwrite=True to overwrite the existing values.")
             return
         self._data[column_label] = array
+        self._data_changed(column_label)
 
     def add_correction(self, correction: str):
         self._applied_corrections.append(correction)
+        self._meta_hash = None
+
+    def _data_changed(self, *columns):
+        """Drops the content hashes of the changed columns (of all columns if none are given)
+        """
+        if not columns:
+            self._column_hashes = {}
+        for column in columns:
+            self._column_hashes.pop(column, None)
 
     @staticmethod
     def bin_add_dimension(region, nbins, drop_remainder=False):
@@ -488,6 +504,7 @@ class Region:
         binned_region._applied_corrections = region.get_corrections()
         binned_region._flags_backup = region._flags_backup
         binned_region._flags[Region.region_flags[4]] = True  # Add-dimension flag
+        binned_region._meta_hash = None
         for key, val in binned_add_dimension_columns.items():
             binned_region.add_column(key, val)
         binned_region.add_column('final', region.get_data('final'), overwrite=True)
@@ -510,6 +527,8 @@ class Region:
         if not self._flags[Region.region_flags[0]]:  # If not already corrected
             self._data['energy'] += shift
             self._flags[Region.region_flags[0]] = True
+            self._data_changed('energy')
+            self._meta_hash = None
             #self._applied_corrections.append("Energy shift corrected")
         else:
             datahandler_logger.info(f"The region {self._id} has already been energy corrected.")
@@ -583,11 +602,13 @@ class Region:
             self._data = self._data.truncate(before=first_index, after=last_index)
             # Reset indexing after truncation so that it starts again with 0
             self._data.reset_index(drop=True, inplace=True)
+            self._data_changed()
             return
 
         tmp_region = copy.deepcopy(self)
         tmp_region._data = tmp_region._data.truncate(before=first_index, after=last_index)
         tmp_region._data.reset_index(drop=True, inplace=True)
+        tmp_region._data_changed()
         return tmp_region
 
     @staticmethod
@@ -723,6 +744,46 @@ class Region:
                         output = "; ".join([output, cor])
                 return output
 
+    def get_column_hash(self, column):
+        """Returns the content hash of the data column. It is calculated once and kept until the column
+        is changed by the methods of Region
+        :param column: name of the column
+        :return: str hexadecimal digest
+        """
+        digest = self._column_hashes.get(column)
+        if digest is None:
+            values = np.ascontiguousarray(self._data[column].to_numpy(), dtype=float)
+            digest = hashlib.blake2b(values.tobytes(), digest_size=16, person=b'specqp column').hexdigest()
+            self._column_hashes[column] = digest
+        return digest
+
+    def get_meta_hash(self):
+        """Returns the hash of the info, conditions, flags, excitation energy and applied corrections of the region.
+        It changes with every correction made by the methods of Region
+        :return: str hexadecimal digest
+        """
+        if self._meta_hash is None:
+            meta = [self._info, self._conditions, self._flags, self._excitation_energy, self._applied_corrections]
+            self._meta_hash = hashlib.blake2b(json.dumps(meta, sort_keys=True, default=str).encode(),
+                                              digest_size=16, person=b'specqp meta').hexdigest()
+        return self._meta_hash
+
+    def get_fingerprint(self, columns=None, metadata=True):
+        """Returns the content fingerprint of the region combining the hashes of the data columns and metadata
+        (see get_column_hash() and get_meta_hash()), e.g. to detect duplicates or to key caches. Only the hashes
+        of the columns changed since the last call are calculated again. Changes made in place to the arrays
+        returned by get_data() are not tracked.
+        :param columns: names of the columns to include, all columns if None
+        :param metadata: if True, the metadata hash is included
+        :return: str hexadecimal digest
+        """
+        if columns is None:
+            columns = self._data.columns
+        parts = [f"{column}:{self.get_column_hash(column)}" for column in columns]
+        if metadata:
+            parts.append(f"meta:{self.get_meta_hash()}")
+        return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
     def get_data(self, column=None):
         """Returns pandas DataFrame with data columns. If column name is
         provided, returns 1D numpy.ndarray of specified column.
@@ -794,6 +855,8 @@ class Region:
         """
         self._data['energy'] = -1 * self._data['energy'] + self._excitation_energy
         self._flags[Region.region_flags[1]] = not self._flags[Region.region_flags[1]]
+        self._data_changed('energy')
+        self._meta_hash = None
 
         # We need to change "Energy Scale" info entry also
         if self._flags[Region.region_flags[1]]:
@@ -863,6 +926,8 @@ class Region:
                     self._data['sweepsNormalized'] = (self._data[column] /
                                                       (float(int(sweeps_per_set) * self._add_dimension_scans_number)))
                 self._flags[self.region_flags[3]] = True
+                self._data_changed()
+                self._meta_hash = None
                 return True
         return False
 
@@ -886,6 +951,8 @@ class Region:
                                                                  float(self._info[Region.info_entries[6]]))
                     self._data['dwellNormalized'] = self._data[column] / float(self._info[Region.info_entries[6]])
                 self._flags[self.region_flags[5]] = True
+                self._data_changed()
+                self._meta_hash = None
                 return True
         return False
 
@@ -931,6 +998,8 @@ class Region:
                 region._data = data
                 region._add_dimension_scans_number = _scans_cnt
                 region._applied_corrections = applied_c
+                region._data_changed()
+                region._meta_hash = None
                 region._data_backup = data.copy()
                 region._info_backup = info.copy()
                 region._flags_backup = flags.copy()
@@ -948,6 +1017,8 @@ class Region:
             self._info = self._info_backup.copy()
             self._flags = self._flags_backup.copy()
             self._applied_corrections = []
+            self._data_changed()
+            self._meta_hash = None
         else:
             datahandler_logger.warning("Attempt to reset a dummy region. Option is not available for dummy regions.")
 
@@ -1035,15 +1106,16 @@ class Region:
         for i in range(region.get_add_dimension_counter()):
             dimension = Region(region.get_data('energy'), region.get_data(f'counts{i}'),
                                add_dimension_flag=False, add_dimension_data=None,
-                               info=region.get_info(), conditions=region.get_conditions(),
+                               info=copy.copy(region.get_info()), conditions=copy.copy(region.get_conditions()),
                                excitation_energy=region.get_excitation_energy(),
                                id_=f"{region.get_id()} : Sweep {i}",
                                fermi_flag=region.get_flags()[Region.region_flags[2]],
                                flags=copy.deepcopy(region.get_flags()))
             dimension._add_dimension_scans_number = 1
-            dimension._applied_corrections = region.get_corrections()
+            dimension._applied_corrections = list(region.get_corrections())
             dimension._flags_backup = region._flags_backup
             dimension._flags[Region.region_flags[4]] = False  # Not add-dimension any longer
+            dimension._meta_hash = None
             for column in region.get_data_columns():
                 if str(i) in column and 'energy' not in column and 'counts' not in column and 'final' not in column:
                     col_base_name = ''.join(filter(lambda x: x.isalpha(), column))
@@ -1065,15 +1137,18 @@ class Region:
                 self._conditions[key] = val
         else:
             self._conditions = conditions
+        self._meta_hash = None
 
     def set_excitation_energy(self, excitation_energy):
         """Set regions's excitation energy.
         """
         self._excitation_energy = float(excitation_energy)
         self._info[Region.info_entries[3]] = str(float(excitation_energy))
+        self._meta_hash = None
 
     def set_fermi_flag(self):
         self._flags[Region.region_flags[2]] = True
+        self._meta_hash = None
 
     def set_id(self, region_id):
         self._id = region_id
@@ -1084,6 +1159,7 @@ class Region:
         if not overwrite and entry_name in self._info and self._info[entry_name] is not None and self._info[entry_name]:
             return
         self._info[entry_name] = value
+        self._meta_hash = None
 
 class RegionsCollection:
     """Keeps track of the list of regions being in work simultaneously in the GUI or the batch mode
@@ -1097,23 +1173,28 @@ class RegionsCollection:
             for region in regions:
                 self.regions[region.get_id()] = region
 
-    def add_regions(self, new_regions):
+    def add_regions(self, new_regions, by_content=False):
         """Adds region objects. Checks for duplicates and rejects adding if already exists.
         :param new_regions: List of region objects (can be also single object in the list form, e.g. [obj,])
+        :param by_content: if True, regions with the same data and metadata as an already loaded one are also
+        rejected, whatever their IDs (see is_duplicate())
         :return: list of IDs for regions that were added
         """
         if not helpers.is_iterable(new_regions):
             new_regions = [new_regions]
         ids = []
         duplicate_ids = []  # For information purposes
+        fingerprints = self.get_fingerprints() if by_content else None
         for new_region in new_regions:
             new_id = new_region.get_id()
-            if self.is_duplicate(new_id):
+            if self.is_duplicate(new_id, new_region if by_content else None, fingerprints):
                 duplicate_ids.append(new_id)
                 continue
             else:
                 ids.append(new_id)
                 self.regions[new_id] = new_region
+                if by_content:
+                    fingerprints[new_region.get_fingerprint()] = new_id
         if duplicate_ids:
             datahandler_logger.warning(f"Regions are already loaded: {duplicate_ids}")
         if ids:
@@ -1164,8 +1245,24 @@ class RegionsCollection:
     def get_regions(self):
         return self.regions.values()
 
-    def is_duplicate(self, id_):
+    def get_fingerprints(self):
+        """Returns the dictionary {content fingerprint: region ID} of the regions in the collection
+        (see Region.get_fingerprint())
+        """
+        return {region.get_fingerprint(): region_id for region_id, region in self.regions.items()}
+
+    def is_duplicate(self, id_, region=None, fingerprints=None):
+        """Checks if a region with the ID id_ or, if region is given, with the same data and metadata is already
+        in the collection
+        :param id_: region ID
+        :param region: Region object to compare by content fingerprint
+        :param fingerprints: dictionary returned by get_fingerprints(), to check many regions without recalculating it
+        :return: True if the region is a duplicate
+        """
         if id_ in self.regions:
             return True
-        else:
+        if region is None:
             return False
+        if fingerprints is None:
+            fingerprints = self.get_fingerprints()
+        return region.get_fingerprint() in fingerprints
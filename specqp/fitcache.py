@@ -0,0 +1,135 @@
+""" Provides class FitCache keeping fit results in memory, so that refitting the same regions with the same
+model definition and solver options returns the stored results at once, and the instance fit_cache shared
+by the GUI and the batch fitting
+"""
+import copy
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+fitcache_logger = logging.getLogger("specqp.fitcache")  # Creating child logger
+
+
+def canonical(obj):
+    """Returns obj converted to JSON-serialisable builtins: numpy arrays and scalars to lists and numbers,
+    tuples to lists, other objects to dictionaries of their public attributes, so that equal definitions
+    give equal JSON strings
+    """
+    if isinstance(obj, dict):
+        return {str(key): canonical(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [canonical(value) for value in obj]
+    if isinstance(obj, np.ndarray):
+        return canonical(obj.tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        return obj
+    return {type(obj).__name__: canonical({key: value for key, value in vars(obj).items()
+                                           if not key.startswith('_')})}
+
+
+class FitCache:
+    """Least recently used cache of fit results with a bounded number of entries. The keys are hashes of the fitted
+    data and of the canonical description of the fit (see make_key()). The methods are thread-safe.
+    """
+
+    def __init__(self, max_entries=256):
+        """
+        :param max_entries: number of results kept, the least recently used ones are evicted first
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._Entries = OrderedDict()
+        self._Lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._Entries)
+
+    def __contains__(self, key):
+        return key in self._Entries
+
+    @staticmethod
+    def make_key(regions, y_data, *definition):
+        """Returns the key of a fit of the regions. The data enter the key through their content hashes kept by
+        the regions (see Region.get_column_hash()), so that the arrays are hashed only once until they change
+        :param regions: Region object or list of them
+        :param y_data: name of the intensity column that is fitted
+        :param definition: anything that defines the result: kind of the fit, peaks and backgrounds, solver options.
+        Dictionaries are compared regardless of the order of their keys
+        :return: str hexadecimal SHA-256 digest
+        """
+        if not isinstance(regions, (list, tuple)):
+            regions = [regions]
+        digest = hashlib.sha256()
+        for region in regions:
+            digest.update(f"binding:{bool(region.is_binding())}".encode())
+            for column in ('energy', y_data):
+                digest.update(f"{column}:{region.get_column_hash(column)}".encode())
+        digest.update(json.dumps(canonical(definition), sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key, default=None):
+        """Returns the result stored with the key and marks it as recently used, or default if there is none
+        """
+        with self._Lock:
+            if key not in self._Entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._Entries.move_to_end(key)
+            return self._Entries[key]
+
+    def put(self, key, value):
+        """Stores the result with the key, evicting the least recently used ones above max_entries
+        """
+        with self._Lock:
+            self._Entries[key] = value
+            self._Entries.move_to_end(key)
+            while len(self._Entries) > self.max_entries:
+                self._Entries.popitem(last=False)
+
+    def clear(self):
+        with self._Lock:
+            self._Entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_fitters(self, key, regions):
+        """Returns copies of the stored Fitter objects attached to the regions, or None if there is no result
+        for the key. The peaks and backgrounds are shared with the stored fitters.
+        :param key: key of the fit (see make_key())
+        :param regions: Region object or list of them in the order of the stored fitters
+        :return: list of Fitter objects or None
+        """
+        fitters = self.get(key)
+        if fitters is None:
+            return None
+        if not isinstance(regions, (list, tuple)):
+            regions = [regions]
+        if len(regions) != len(fitters):
+            fitcache_logger.warning(f"Cached fit has {len(fitters)} spectra, {len(regions)} regions are given")
+            return None
+        copies = []
+        for fitterobj, region in zip(fitters, regions):
+            fitterobj = copy.copy(fitterobj)
+            fitterobj.region = region
+            fitterobj._ID = region.get_id()
+            fitterobj._Peaks = dict(fitterobj._Peaks)
+            fitterobj._VirtualCurves = {}
+            copies.append(fitterobj)
+        return copies
+
+    def put_fitters(self, key, fitters):
+        """Stores the list of Fitter objects with the fit results under the key
+        """
+        self.put(key, list(fitters))
+
+
+# Cache shared by the fit windows of the GUI and the batch fitting
+fit_cache = FitCache()
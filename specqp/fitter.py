@@ -1,8 +1,16 @@
 """ Provides class Fitter with helping functions
 """
 import logging
+import time
+from collections import OrderedDict
+from functools import lru_cache, wraps
+
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy import fft, sparse, special
+from scipy.optimize import curve_fit, least_squares
+from scipy.signal import find_peaks, peak_widths, savgol_coeffs, savgol_filter
+
+from specqp import helpers
 
 fitter_logger = logging.getLogger("specqp.fitter")  # Creating child logger
 
@@ -14,7 +22,8 @@ class Peak:
         "Gauss": ["amplitude", "center", "fwhm"],
         "Lorentz": ["amplitude", "center", "fwhm"],
         "Pseudo Voigt": ["amplitude", "center", "g_fwhm", "l_fwhm"],
-        "Doniach-Sunjic": ["amplitude", "center", "g_fwhm", "l_fwhm"]
+        "Doniach-Sunjic": ["amplitude", "center", "g_fwhm", "l_fwhm"],
+        "Voigt": ["amplitude", "center", "g_fwhm", "l_fwhm"]
     }
 
     def __init__(self, x_data, y_data, popt, pcov, peak_func, peak_id, peak_type, bindingscale=True, lmfit=False):
@@ -27,8 +36,8 @@ class Peak:
         self._function = peak_func
         self._bindingscale = bindingscale
         self._id = peak_id
-        self._Area = np.trapz(self._Y)
         self._PeakType = peak_type
+        self._Area = Peak.calculate_area(peak_type, popt, (np.amin(x_data), np.amax(x_data)), bindingscale)
         self._Pcov = pcov
         self._FittingErrors = []
         if not lmfit:
@@ -44,7 +53,7 @@ class Peak:
         output = f"Type: {self._PeakType}"
         for i, p in enumerate(self._Popt):
             output = "\n".join((output, f"{self.peak_types[self._PeakType][i]}: {p:.4f} (+/- {self._FittingErrors[i]:.4f})"))
-        output = "\n".join((output, f"Area: {self._Area:.4f}"))
+        output = "\n".join((output, f"Area: {self.get_peak_area():.4f}"))
         return output
 
     def get_covariance(self, parameter=None):
@@ -88,6 +97,64 @@ class Peak:
     def get_peak_area(self):
         return self._Area
 
+    @staticmethod
+    def calculate_area(peak_type, parameters, energy_range, bindingscale=True):
+        """Integrates a line shape over the energy range in closed form: Gauss and Lorentz by their cumulative
+        distribution functions, pseudo Voigt as their mix, Doniach-Sunjic by its antiderivative
+        Re[i * exp(i*pi*gamma/2) * (1 - i*t)**gamma / gamma] with t = (cen - x) / sigma (Lorentzian for gamma=0).
+        Voigt has no closed form and is integrated by Gauss-Legendre quadrature over theta = arctan((x - cen) / hwhm),
+        which turns its Lorentzian tails into a smooth bounded integrand.
+        Parameters can be arrays to calculate the areas of many peaks at once.
+        :param peak_type: one of Peak.peak_types
+        :param parameters: values (or arrays of values) of the parameters in the order of Peak.peak_types
+        :param energy_range: (low, high) limits of integration in energy units
+        :param bindingscale: True if the energy axis is binding energy (defines the Doniach-Sunjic asymmetry)
+        :return: float or ndarray
+        """
+        if peak_type not in Peak.peak_types:
+            raise KeyError(f"'{peak_type}' is not a valid fitting model")
+        low, high = energy_range
+        amp, cen = np.asarray(parameters[0], dtype=float), np.asarray(parameters[1], dtype=float)
+
+        def gauss_cdf_diff(fwhm):
+            sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+            return 0.5 * (special.erf((high - cen) / (np.sqrt(2) * sigma)) -
+                          special.erf((low - cen) / (np.sqrt(2) * sigma)))
+
+        def lorentz_cdf_diff(fwhm):
+            return (np.arctan((high - cen) / (fwhm / 2)) - np.arctan((low - cen) / (fwhm / 2))) / np.pi
+
+        if peak_type == "Gauss":
+            return amp * gauss_cdf_diff(parameters[2])
+        if peak_type == "Lorentz":
+            return amp * lorentz_cdf_diff(parameters[2])
+        g_fwhm, l_fwhm = np.asarray(parameters[2], dtype=float), np.asarray(parameters[3], dtype=float)
+        if peak_type == "Pseudo Voigt":
+            f, eta = Fitter.pseudo_voigt_width(g_fwhm, l_fwhm)
+            height = eta * 2 / (np.pi * f) + (1 - eta) * np.sqrt(4 * np.log(2) / np.pi) / f
+            return amp * (eta * lorentz_cdf_diff(f) + (1 - eta) * gauss_cdf_diff(f)) / height
+        if peak_type == "Voigt":
+            hwhm = Fitter.voigt_width(g_fwhm, l_fwhm)[..., None] / 2
+            cen = cen[..., None]
+            theta_low, theta_high = np.arctan((low - cen) / hwhm), np.arctan((high - cen) / hwhm)
+            nodes, weights = np.polynomial.legendre.leggauss(64)
+            theta = (theta_high + theta_low) / 2 + (theta_high - theta_low) / 2 * nodes
+            x = cen + hwhm * np.tan(theta)
+            integrand = Fitter.voigt(x, 1.0, cen, g_fwhm[..., None], l_fwhm[..., None]) * hwhm / np.cos(theta) ** 2
+            return amp * (theta_high[..., 0] - theta_low[..., 0]) / 2 * np.sum(weights * integrand, axis=-1)
+        sigma = g_fwhm / (2 * np.sqrt(2 * np.log(2)))
+        gamma = l_fwhm / 2
+        if bindingscale:
+            t_low, t_high = (cen - high) / sigma, (cen - low) / sigma
+        else:
+            t_low, t_high = (low - cen) / sigma, (high - cen) / sigma
+        # (1 - i*t_high)**gamma - (1 - i*t_low)**gamma written with expm1 to stay exact for small gamma
+        log_low, log_high = np.log(1 - 1j * t_low), np.log(1 - 1j * t_high)
+        safe_gamma = np.where(gamma == 0, 1e-12, gamma)
+        difference = np.exp(safe_gamma * log_low) * np.expm1(safe_gamma * (log_high - log_low)) / safe_gamma
+        integral = np.real(1j * np.exp(1j * np.pi * gamma / 2) * difference)
+        return amp * sigma ** gamma * integral
+
     def get_peak_id(self):
         return self._id
 
@@ -121,6 +188,307 @@ class Peak:
         self._id = new_id
 
 
+class CompactPeak(Peak):
+    """Peak that keeps only its parameters, their errors and a reference to the energy axis shared with the Fitter.
+    The line is calculated when requested, the last few curves are kept by the peak. The returned arrays are
+    read-only.
+    """
+    max_curves = 4
+
+    def __init__(self, x_data, popt, errors, peak_id, peak_type, bindingscale=True, resolution=None, window=None):
+        """
+        :param x_data: energy axis, stored by reference
+        :param popt: values of the peak parameters in the order of Peak.peak_types
+        :param errors: errors of the peak parameters
+        :param peak_id: peak ID
+        :param peak_type: one of Peak.peak_types
+        :param bindingscale: True if the energy axis is binding energy
+        :param resolution: InstrumentResolution the line is convolved with, if any. The area is the one of the
+        line before convolution, which the convolution keeps
+        :param window: energy range (low, high) the line is truncated to, as in a fit with support windows
+        (see CompositeModel.fit()). The area is the one within the window
+        """
+        self._X = x_data
+        self._Popt = list(popt)
+        self._FittingErrors = list(errors)
+        self._Pcov = self._FittingErrors
+        self._id = peak_id
+        self._PeakType = peak_type
+        self._bindingscale = bindingscale
+        self._Resolution = resolution
+        self._Window = window
+        self._Area = None
+        self._Curves = {}
+
+    @property
+    def _function(self):
+        return Fitter.get_model_func(self._PeakType)
+
+    @property
+    def _Y(self):
+        return self._curve(None, True)
+
+    def _curve(self, num, multiply):
+        """Peak line on the energy axis (num=None) or on the virtual axis defined by num and multiply
+        """
+        if (num, multiply) in self._Curves:
+            return self._Curves[(num, multiply)]
+        x = self._X
+        if num is not None:
+            x = np.linspace(self._X[0], self._X[-1], len(self._X) * num if multiply else num, endpoint=True)
+        if self._Resolution is None:
+            y = self._line(x)
+        else:
+            y = self._Resolution.convolve(x, self._line(self._Resolution.get_grid(x)))
+        y.flags.writeable = False
+        if len(self._Curves) >= self.max_curves:
+            del self._Curves[next(iter(self._Curves))]
+        self._Curves[(num, multiply)] = y
+        return y
+
+    def get_data(self):
+        """Returns a list of x and y data
+        """
+        return [self._X, self._Y]
+
+    def _line(self, x):
+        asymmetry = 'higher' if self._bindingscale else 'lower'
+        if self._Window is None:
+            return self._function(x, *self._Popt, asymmetry=asymmetry)
+        inside = (x >= self._Window[0]) & (x <= self._Window[1])
+        y = np.zeros_like(x, dtype=float)
+        y[inside] = self._function(x[inside], *self._Popt, asymmetry=asymmetry)
+        return y
+
+    def get_peak_area(self):
+        if self._Area is None:
+            low, high = np.amin(self._X), np.amax(self._X)
+            if self._Window is not None:
+                low, high = max(low, self._Window[0]), min(high, self._Window[1])
+            self._Area = (Peak.calculate_area(self._PeakType, self._Popt, (low, high), self._bindingscale)
+                          if high > low else 0.0)
+        return self._Area
+
+    def get_virtual_data(self, num=10, multiply=True):
+        """Returns more (or less) data points (see Peak.get_virtual_data())
+        """
+        assert num > 0
+        x = np.linspace(self._X[0], self._X[-1], len(self._X) * num if multiply else num, endpoint=True)
+        return x, self._curve(num, multiply)
+
+
+class FitReport:
+    """Records how a fit went: numbers of model evaluations, wall time split between the model and the solver,
+    final cost, termination reason and optionally the cost of every model evaluation.
+    """
+
+    def __init__(self, name=None, method='least_squares', trace=False):
+        """
+        :param name: ID of the fitted region or the fit
+        :param method: name of the solver
+        :param trace: if True, the cost of every model evaluation (including those done for the Jacobian)
+        is kept in self.trace
+        """
+        self.name = name
+        self.method = method
+        self.evaluations = 0
+        self.nfev = None
+        self.njev = None
+        self.wall_time = 0.0
+        self.model_time = 0.0
+        self.cost = None
+        self.success = None
+        self.status = None
+        self.message = None
+        self.trace = [] if trace else None
+        self._Start = None
+
+    def __str__(self):
+        output = (f"Fit {self.name} ({self.method}): {'converged' if self.success else 'did not converge'}, "
+                  f"{self.message}")
+        output = "\n".join((output, f"Evaluations: {self.evaluations} (nfev {self.nfev}, njev {self.njev})"))
+        output = "\n".join((output, f"Time: {self.wall_time:.4f} s, model {self.model_time:.4f} s, "
+                                    f"solver {self.solver_time:.4f} s"))
+        if self.cost is not None:
+            output = "\n".join((output, f"Cost: {self.cost:.6g}"))
+        return output
+
+    @property
+    def solver_time(self):
+        return max(self.wall_time - self.model_time, 0.0)
+
+    def start(self):
+        """Starts the clock unless it is already running, so that one report can cover several solver runs
+        """
+        if self._Start is None:
+            self._Start = time.perf_counter()
+
+    def finish(self, cost=None, success=None, status=None, message=None, nfev=None, njev=None):
+        """Stops the clock and stores the results of the solver
+        """
+        if self._Start is not None:
+            self.wall_time = time.perf_counter() - self._Start
+        self.cost = None if cost is None else float(cost)
+        self.success = success
+        self.status = status
+        self.message = message
+        self.nfev = nfev
+        self.njev = njev
+
+    def wrap(self, func, data=None):
+        """Returns func counting its calls and their time. The cost traced is half the sum of squares
+        of the returned residuals or, if data is given, of the differences between data and the returned model
+        """
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                output = func(*args, **kwargs)
+            finally:
+                self.evaluations += 1
+                self.model_time += time.perf_counter() - start
+            if self.trace is not None:
+                resid = np.asarray(output) if data is None else data - output
+                self.trace.append(0.5 * float(np.dot(resid.ravel(), resid.ravel())))
+            return output
+        return timed
+
+    def log(self, level=logging.INFO):
+        """Writes the report to the 'specqp.fitter' logger
+        """
+        fitter_logger.log(level, str(self))
+
+
+class InstrumentResolution:
+    """Instrument function convolved with the peaks of a CompositeModel. The peaks are calculated on a uniform
+    oversampled grid padded by the half-width of the instrument function, convolved by FFT and interpolated back
+    to the energy axis. The grids are kept for the last max_grids energy axes and the Fourier transforms of the
+    instrument function for every (FWHM, grid), so that one convolution costs two real FFTs within a fit.
+    """
+    max_grids = 32
+
+    def __init__(self, fwhm=None, kernel=None, oversample=2, extent=3.0):
+        """
+        :param fwhm: FWHM of a Gaussian instrument function, e.g. the analyser broadening at the pass energy used
+        :param kernel: measured instrument function (energy offsets from its center, intensities), e.g. derived
+        from a Fermi edge. The offsets do not need to be uniform, the function is normalised to unit area
+        :param oversample: number of grid points per smallest step of the energy axis
+        :param extent: half-width of the Gaussian instrument function in FWHM taken into account
+        """
+        if (fwhm is None) == (kernel is None):
+            raise ValueError("Either the FWHM or the kernel of the instrument function must be given")
+        self.fwhm = None
+        self.kernel = None
+        if fwhm is not None:
+            if not fwhm > 0:
+                raise ValueError(f"FWHM of the instrument function must be positive, got {fwhm}")
+            self.fwhm = float(fwhm)
+            self.half_width = extent * self.fwhm
+        else:
+            offsets, intensities = (np.asarray(column, dtype=float) for column in kernel)
+            order = np.argsort(offsets)
+            offsets, intensities = offsets[order], intensities[order]
+            # Cumulative area, so that the kernel is integrated over the grid cells however narrow it is
+            area = np.concatenate(([0], np.cumsum(0.5 * (intensities[1:] + intensities[:-1]) * np.diff(offsets))))
+            if len(offsets) < 2 or not area[-1] > 0:
+                raise ValueError("The kernel of the instrument function must have a positive area")
+            self.kernel = (offsets, area / area[-1])
+            self.half_width = float(np.amax(np.absolute(offsets)))
+        self.oversample = max(1, int(oversample))
+        self._Grids = OrderedDict()  # {id(energy): (energy, grid, step, indices, weights)}, least recent first
+        self._Transforms = {}  # {(step, size): transform} of the measured kernel
+
+    @staticmethod
+    def from_value(resolution, region=None):
+        """Returns InstrumentResolution for the resolution argument of Fitter.fit(), CompositeModel and GlobalFit
+        :param resolution: None, InstrumentResolution, FWHM of a Gaussian instrument function or dictionary
+        {pass energy: FWHM or InstrumentResolution}
+        :param region: Region to take the pass energy from if resolution is a dictionary
+        :return: InstrumentResolution or None
+        """
+        if isinstance(resolution, dict):
+            if region is None:
+                raise ValueError("Region is needed to choose the instrument function by pass energy")
+            pass_energy = float(region.get_info("Pass Energy"))
+            matches = [value for key, value in resolution.items() if float(key) == pass_energy]
+            if not matches:
+                raise KeyError(f"No instrument function for pass energy {pass_energy} of region {region.get_id()}")
+            resolution = matches[0]
+        if resolution is None or isinstance(resolution, InstrumentResolution):
+            return resolution
+        return InstrumentResolution(fwhm=resolution)
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _gauss_transform(fwhm, step, size):
+        sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+        transform = np.exp(-2 * (np.pi * sigma * fft.rfftfreq(size, step)) ** 2)
+        transform.flags.writeable = False
+        return transform
+
+    def get_transform(self, step, size):
+        """Returns the Fourier transform (rfft) of the instrument function sampled with step on a periodic grid
+        of size points
+        """
+        if self.fwhm is not None:
+            return self._gauss_transform(self.fwhm, step, size)
+        transform = self._Transforms.get((step, size))
+        if transform is None:
+            offsets = np.arange(size + 1) - size // 2 - 0.5
+            cells = np.diff(np.interp(offsets * step, *self.kernel, left=0.0, right=1.0))
+            transform = fft.rfft(fft.ifftshift(cells))
+            transform.flags.writeable = False
+            self._Transforms[(step, size)] = transform
+        return transform
+
+    def get_grid(self, energy):
+        """Returns the uniform ascending grid the peaks are calculated on for the energy axis
+        """
+        return self._grid(energy)[1]
+
+    def _grid(self, energy):
+        cached = self._Grids.get(id(energy))
+        if cached is not None and cached[0] is energy:
+            try:
+                self._Grids.move_to_end(id(energy))
+            except KeyError:  # Evicted by another thread in the meantime, the grid is still valid
+                pass
+            return cached
+        steps = np.absolute(np.diff(energy))
+        steps = steps[steps > 0]
+        step = (steps.min() if len(steps) else self.half_width) / self.oversample
+        pad = int(np.ceil(self.half_width / step))
+        size = fft.next_fast_len(int(np.ceil((np.amax(energy) - np.amin(energy)) / step)) + 2 * pad + 2, real=True)
+        grid = np.amin(energy) - pad * step + step * np.arange(size)
+        position = (energy - grid[0]) / step
+        indices = np.clip(np.floor(position).astype(int), 0, size - 2)
+        cached = (energy, grid, step, indices, position - indices)
+        self._Grids[id(energy)] = cached
+        while len(self._Grids) > self.max_grids:
+            try:
+                self._Grids.popitem(last=False)
+            except KeyError:
+                break
+        return cached
+
+    def reserve_grids(self, count):
+        """Makes room for the grids of at least count energy axes, e.g. of all spectra sharing the instrument
+        function in a global fit, so that they are not rebuilt at every evaluation
+        """
+        self.max_grids = max(self.max_grids, int(count))
+
+    def convolve(self, energy, lines):
+        """Convolves lines calculated on get_grid(energy) with the instrument function
+        :param energy: x axis
+        :param lines: ndarray with the grid along the last axis
+        :return: convolved lines on the energy axis
+        """
+        _, grid, step, indices, weights = self._grid(energy)
+        transform = self.get_transform(step, len(grid))
+        smooth = fft.irfft(fft.rfft(lines, axis=-1) * transform, n=len(grid), axis=-1)
+        return smooth[..., indices] * (1 - weights) + smooth[..., indices + 1] * weights
+
+
 class Fitter:
     """Provides fitting possibilities for XPS regions
     """
@@ -147,6 +515,11 @@ class Fitter:
         self._RMS = 0
         self._Peaks = {}
         self._Bg = bg
+        self._Report = None
+        # (CompositeModel, values of all its parameters) of the last fit, cleared when the fit changes
+        self._Model = None
+        # Virtual curves for plotting {(curve name, num, multiply, ...): (x, y)}, cleared when the fit changes
+        self._VirtualCurves = {}
         # The gauss widening is constant due to the equipment used in the experiment. So, if we know it,
         # we should fix this parameter in fitting.
         if gauss_fwhm:
@@ -167,6 +540,7 @@ class Fitter:
         peak_id = peak.get_peak_id()
         if peak_id not in self._Peaks:
             self._Peaks[peak_id] = peak
+            self._VirtualCurves = {}
             return True
         else:
             fitter_logger.warning(f"Peak '{peak_id}' already exists in fitter object {self._ID}.")
@@ -175,6 +549,7 @@ class Fitter:
     def delete_peak(self, peak_id):
         if peak_id in self._Peaks:
             del self._Peaks[peak_id]
+            self._VirtualCurves = {}
 
     @staticmethod
     def get_model(model, energy, intensity, params, bindingscale=True):
@@ -207,6 +582,11 @@ class Fitter:
                                            params[Peak.peak_types[model][1]]['value'],
                                            params[Peak.peak_types[model][2]]['value'],
                                            params[Peak.peak_types[model][3]]['value'])
+            if model == "Voigt":
+                return Fitter.voigt(energy, params[Peak.peak_types[model][0]]['value'],
+                                    params[Peak.peak_types[model][1]]['value'],
+                                    params[Peak.peak_types[model][2]]['value'],
+                                    params[Peak.peak_types[model][3]]['value'])
             if model == "Doniach-Sunjic":
                 asymmetry = 'higher'
                 if not bindingscale:
@@ -235,6 +615,8 @@ class Fitter:
                 return Fitter.pseudo_voigt
             if model == "Doniach-Sunjic":
                 return Fitter.doniach_sunjic
+            if model == "Voigt":
+                return Fitter.voigt
         elif model in Fitter.bg_types:
             if model == 'shirley':
                 return Fitter.shirley
@@ -261,7 +643,7 @@ class Fitter:
             energy = energy[::-1]
         bg = bg + (energy - energy[0]) * value
         if need_to_reversed:
-            return bg[::-1]
+            return bg[..., ::-1]
         else:
             return bg
 
@@ -277,24 +659,25 @@ class Fitter:
             energy = energy[::-1]
         bg = bg + np.square((energy - energy[0])) * value
         if need_to_reversed:
-            return bg[::-1]
+            return bg[..., ::-1]
         else:
             return bg
 
     @staticmethod
     def shirley(energy, intensity, value: float, asymmetry=None):
-        """Calculates Shirley background for simulated spectrum
+        """Calculates Shirley background for simulated spectrum. Intensity can be a stack of spectra
+        with the energy along the last axis.
         """
         if energy[0] < energy[-1]:
             is_reversed = True
             energy = energy[::-1]
-            intensity = intensity[::-1]
+            intensity = intensity[..., ::-1]
         else:
             is_reversed = False
         spacing = (energy[-1] - energy[0]) / (len(energy) - 1)
-        output = value * spacing * (np.cumsum(intensity) - intensity.sum())
+        output = value * spacing * (np.cumsum(intensity, axis=-1) - intensity.sum(axis=-1, keepdims=True))
         if is_reversed:
-            return output[::-1]
+            return output[..., ::-1]
         return output
 
         # bg = np.zeros_like(energy)
@@ -329,11 +712,41 @@ class Fitter:
         :param l_fwhm: Lorentz FWHM
         :return: Pseudo Voigt line shape
         """
+        f, eta = Fitter.pseudo_voigt_width(g_fwhm, l_fwhm)
+        pv_func = (eta * Fitter.lorentz(x, 1.0, cen, f) + (1 - eta) * Fitter.gauss(x, 1.0, cen, f))
+        # Normalizing to 1 by the height at the center
+        return amp * pv_func / (eta * 2 / (np.pi * f) + (1 - eta) * np.sqrt(4 * np.log(2) / np.pi) / f)
+
+    @staticmethod
+    def pseudo_voigt_width(g_fwhm, l_fwhm):
+        """Returns the total FWHM and the Lorentz fraction of pseudo Voigt line shape
+        """
         f = (g_fwhm ** 5 + 2.69269 * g_fwhm ** 4 * l_fwhm + 2.42843 * g_fwhm ** 3 * l_fwhm ** 2 +
              4.47163 * g_fwhm ** 2 * l_fwhm ** 3 + 0.07842 * g_fwhm * l_fwhm ** 4 + l_fwhm ** 5) ** (1. / 5.)
         eta = 1.36603 * (l_fwhm / f) - 0.47719 * (l_fwhm / f) ** 2 + 0.11116 * (l_fwhm / f) ** 3
-        pv_func = (eta * Fitter.lorentz(x, 1.0, cen, f) + (1 - eta) * Fitter.gauss(x, 1.0, cen, f))
-        return amp * pv_func / np.amax(pv_func)  # Normalizing to 1
+        return f, eta
+
+    @staticmethod
+    def voigt(x, amp, cen, g_fwhm, l_fwhm, asymmetry=None):
+        """Returns a true Voigt line shape, convolution of Gauss and Lorentz functions, calculated from the real part
+        of the Faddeeva function w(z) with z = (x - cen + i*gamma) / (sigma * sqrt(2)).
+        :param x: X data
+        :param amp: amplitude (area)
+        :param cen: center
+        :param g_fwhm: Gauss FWHM
+        :param l_fwhm: Lorentz FWHM
+        :return: Voigt line shape
+        """
+        sigma = g_fwhm / (2 * np.sqrt(2 * np.log(2)))
+        gamma = l_fwhm / 2
+        z = (x - cen + 1j * gamma) / (sigma * np.sqrt(2))
+        return amp * special.wofz(z).real / (sigma * np.sqrt(2 * np.pi))
+
+    @staticmethod
+    def voigt_width(g_fwhm, l_fwhm):
+        """Returns the total FWHM of Voigt line shape (Olivero and Longbothum approximation, accurate to 0.02%)
+        """
+        return 0.5346 * l_fwhm + np.sqrt(0.2166 * l_fwhm ** 2 + g_fwhm ** 2)
 
     @staticmethod
     def doniach_sunjic(x, amp, cen, g_fwhm, l_fwhm, asymmetry='higher'):
@@ -350,12 +763,6 @@ class Fitter:
         :return: Doniach-Sunjic assimetric line shape
         """
         assert asymmetry in ('higher', 'lower')
-        if x[0] > x[1]:
-            reverse = True
-        else:
-            reverse = False
-        if reverse:
-            x = x[::-1]
         if asymmetry == 'higher':
             asymmetry = cen - x
         elif asymmetry == 'lower':
@@ -367,11 +774,24 @@ class Fitter:
         gamma = l_fwhm / 2
         func_numerator = np.cos(np.pi * gamma / 2 + (1.0 - gamma) * np.arctan((asymmetry) / sigma))
         func_denominator = (1 + ((asymmetry) / sigma) ** 2) ** ((1.0 - gamma) / 2)
-        ds_func = (amp / sigma ** (1.0 - gamma)) * func_numerator / func_denominator
+        return (amp / sigma ** (1.0 - gamma)) * func_numerator / func_denominator
 
-        if reverse:
-            return ds_func[::-1]
-        return ds_func
+    def _curve_fit(self, func, initial_params, bounds):
+        """Runs scipy.optimize.curve_fit recording the FitReport
+        :return: (ndarray, ndarray) optimal parameters and their covariance
+        """
+        report = FitReport(self._ID, method='curve_fit')
+        report.start()
+        # full_output is not used, scipy accepts it with bounds only since 1.9. curve_fit raises RuntimeError
+        # if it does not converge, the evaluations (including those for the Jacobian) are counted by the report
+        popt, pcov = curve_fit(report.wrap(func, data=self._Y_data), self._X_data, self._Y_data,
+                               p0=initial_params, bounds=bounds)
+        resid = self._Y_data - func(self._X_data, *popt)
+        report.finish(cost=0.5 * np.dot(resid, resid), success=True, message="curve_fit converged",
+                      nfev=report.evaluations)
+        self._Report = report
+        report.log(logging.DEBUG)
+        return popt, pcov
 
     def _get_fitting_restrains(self, initial_params, fix_pars=None, tolerance=0.0001, boundaries=None):
         """Parses fitting restrains for multiple peaks
@@ -500,8 +920,7 @@ class Fitter:
             return
         bounds_low, bounds_high = self._get_fitting_restrains(initial_params, fix_pars, tolerance, boundaries)
         # Parameters and parameters covariance of the fit
-        popt, pcov = curve_fit(_multi_gaussian, self._X_data, self._Y_data, p0=initial_params,
-                               bounds=(bounds_low, bounds_high))
+        popt, pcov = self._curve_fit(_multi_gaussian, initial_params, (bounds_low, bounds_high))
 
         cnt = 0
         while cnt < len(initial_params):
@@ -550,8 +969,7 @@ class Fitter:
             return
         bounds_low, bounds_high = self._get_fitting_restrains(initial_params, fix_pars, tolerance, boundaries)
         # Parameters and parameters covariance of the fit
-        popt, pcov = curve_fit(_multi_lorentzian, self._X_data, self._Y_data, p0=initial_params,
-                               bounds=(bounds_low, bounds_high))
+        popt, pcov = self._curve_fit(_multi_lorentzian, initial_params, (bounds_low, bounds_high))
         cnt = 0
         while cnt < len(initial_params):
             peak_y = _multi_lorentzian(self._X_data, popt[cnt], popt[cnt + 1], popt[cnt + 2])
@@ -598,8 +1016,7 @@ class Fitter:
             return
         bounds_low, bounds_high = self._get_fitting_restrains(initial_params, fix_pars, tolerance, boundaries)
         # Parameters and parameters covariance of the fit
-        popt, pcov = curve_fit(_multi_voigt, self._X_data, self._Y_data, p0=initial_params,
-                               bounds=(bounds_low, bounds_high))
+        popt, pcov = self._curve_fit(_multi_voigt, initial_params, (bounds_low, bounds_high))
 
         cnt = 0
         while cnt < len(initial_params):
@@ -615,6 +1032,46 @@ class Fitter:
             cnt += 4
         self.make_fitline()
 
+    def fit_voigt(self, initial_params, fix_pars=None, tolerance=0.0001, boundaries=None):
+        """Fits true Voigt function to Region object based on initial values of four parameters (amplitude, center,
+        gauss_fwhm, lorentz_fwhm). If list with more than one set of four parameters is given, the function fits
+        more than one peak.
+        :param initial_params: list of initial values of parameters: amplitude, center, g_fwhm, l_fwhm. Must contain a
+        multiple of 4 values.
+        :param fix_pars: dictionary with names of parameters to fix as keys and numbers of peaks for which
+        the parameters should be fixed as lists. Ex: {"cen": [1,2], "amp": [0,1,2]}
+        :param tolerance: when fixing parameters some small tolerance is necessary for fitting
+        :param boundaries: dictionary with names of parameters as keys and a dictionary containing lower and upper
+        boundaries for the corresponding peak. Ex: {"cen": {1: [34,35], 2: [35,36]}}
+        """
+        def _multi_voigt(x, *args):
+            """Creates a single or multiple Voigt shape taking amplitude, Center, g_FWHM and l_FWHM parameters
+            """
+            cnt = 0
+            func = 0
+            while cnt < len(args):
+                func += Fitter.voigt(x, args[cnt], args[cnt + 1], args[cnt + 2], args[cnt + 3])
+                cnt += 4
+            return func
+
+        if len(initial_params) % 4 != 0:
+            fitter_logger.debug(f"Check the number of initial parameters in fit_voigt method."
+                                f"Should be multiple of 4.")
+            return
+        bounds_low, bounds_high = self._get_fitting_restrains(initial_params, fix_pars, tolerance, boundaries)
+        popt, pcov = self._curve_fit(_multi_voigt, initial_params, (bounds_low, bounds_high))
+
+        cnt = 0
+        while cnt < len(initial_params):
+            peak_y = _multi_voigt(self._X_data, popt[cnt], popt[cnt + 1], popt[cnt + 2], popt[cnt + 3])
+            self._Peaks[cnt // 4] = Peak(self._X_data, peak_y,
+                                         [popt[cnt], popt[cnt+1], popt[cnt+2], popt[cnt+3]],
+                                         [pcov[cnt], pcov[cnt+1], pcov[cnt+2], pcov[cnt+3]],
+                                         peak_func=_multi_voigt,
+                                         peak_id=cnt // 4, peak_type="Voigt")
+            cnt += 4
+        self.make_fitline()
+
     def fit_doniach_sunjic(self, initial_params, fix_pars=None, tolerance=0.0001, boundaries=None):
         """Fits Doniach-Sunjic assimetric function (Formula taken from https://lmfit.github.io/lmfit- py/builtin_models.html)
         to Region object based on initial values of four parameters (amplitude, center, gauss_fwhm, lorentz_fwhm).
@@ -666,8 +1123,7 @@ class Fitter:
             return
         bounds_low, bounds_high = self._get_fitting_restrains(initial_params, fix_pars, tolerance, boundaries)
         # Parameters and parameters covariance of the fit
-        popt, pcov = curve_fit(fitfunc, self._X_data, self._Y_data, p0=initial_params,
-                               bounds=(bounds_low, bounds_high))
+        popt, pcov = self._curve_fit(fitfunc, initial_params, (bounds_low, bounds_high))
 
         cnt = 0
         while cnt < len(initial_params):
@@ -683,17 +1139,204 @@ class Fitter:
             cnt += 4
         self.make_fitline()
 
+    def _guess_baseline(self, smoothing=None):
+        """Smooths the spectrum with Savitzky-Golay filter and estimates its Shirley background
+        :param smoothing: length of the filter window in points. By default 1/50 of the spectrum but at least 5 points
+        :return: (ndarray, ndarray, float) smoothed intensity, background and standard deviation of the noise
+        """
+        npoints = len(self._Y_data)
+        if smoothing is None:
+            smoothing = max(5, npoints // 50)
+        window = min(int(smoothing) // 2 * 2 + 1, (npoints - 1) // 2 * 2 + 1)
+        polyorder = min(3, window - 1)
+        smoothed = savgol_filter(self._Y_data, window, polyorder)
+        noise = 1.4826 * np.median(np.absolute(self._Y_data - smoothed))
+        baseline = helpers.get_shirley_bg(self._X_data, smoothed)
+        if baseline is None:
+            baseline = np.full(npoints, np.amin(smoothed))
+        return smoothed, baseline, noise
+
+    def guess_bg(self, bg_types=('shirley', 'constant'), smoothing=None):
+        """Estimates initial values of backgrounds from the Shirley background of the smoothed spectrum
+        :param bg_types: names of Fitter.bg_types to estimate. 'linear' and 'square' start from zero
+        :param smoothing: length of the smoothing window in points (see guess_peaks())
+        :return: dictionary {bg_type: {'value': value, 'fix': False, 'min': None, 'max': None}}
+        which can be used by fit() or GlobalFit
+        """
+        smoothed, baseline, _ = self._guess_baseline(smoothing)
+        low, high = np.argmin(self._X_data), np.argmax(self._X_data)
+        use_shirley = 'shirley' in bg_types
+        values = {'constant': baseline[low] if use_shirley else np.amin(smoothed), 'linear': 0.0, 'square': 0.0}
+        # Fitter.shirley() grows towards higher energies by value * spacing * (integral of the peaks)
+        peaks_sum = np.sum(smoothed - baseline)
+        spacing = np.absolute(self._X_data[-1] - self._X_data[0]) / (len(self._X_data) - 1)
+        values['shirley'] = (baseline[high] - baseline[low]) / (spacing * peaks_sum) if peaks_sum > 0 else 0.0
+        bg = {}
+        for bg_type in bg_types:
+            if bg_type not in self.bg_types:
+                raise KeyError(f"'{bg_type}' is not a valid background type")
+            bg[bg_type] = {'value': float(values[bg_type]), 'fix': False, 'min': None, 'max': None}
+        return bg
+
+    def guess_peaks(self, fittype='Gauss', max_peaks=None, min_height=None, smoothing=None):
+        """Finds peaks on the smoothed spectrum with Shirley background subtracted and estimates their parameters.
+        Maxima of the spectrum are found first, shoulders are then found as maxima of the negative second
+        derivative (smoothed over the width of the narrowest maximum) lying outside the half widths of the found peaks.
+        :param fittype: one of Peak.peak_types used for all peaks
+        :param max_peaks: maximal number of peaks, the highest are kept
+        :param min_height: minimal height of a peak above the background. By default 5 standard deviations
+        of the noise or 2% of the highest point, whichever is larger
+        :param smoothing: length of the smoothing window in points. By default 1/50 of the spectrum but at least 5
+        :return: list of peak dictionaries named 'Peak0', 'Peak1'... in the order of decreasing height
+        which can be used by fit() or GlobalFit
+        """
+        if fittype not in Peak.peak_types:
+            raise KeyError(f"'{fittype}' is not a valid fitting model")
+        smoothed, baseline, noise = self._guess_baseline(smoothing)
+        signal = smoothed - baseline
+        if min_height is None:
+            min_height = max(5 * noise, 0.02 * np.amax(signal))
+        spacing = np.absolute(self._X_data[-1] - self._X_data[0]) / (len(self._X_data) - 1)
+
+        maxima, _ = find_peaks(signal, prominence=min_height)
+        widths = peak_widths(signal, maxima, rel_height=0.5)[0]
+        candidates = [(signal[ind], ind, width) for ind, width in zip(maxima, widths)]
+        # Curvature is calculated over the width of the narrowest peak to keep the noise low
+        window = int(min(widths, default=5)) // 2 * 2 + 1
+        window = min(max(window, 5), (len(signal) - 1) // 2 * 2 + 1)
+        curvature = -savgol_filter(self._Y_data, window, 3, deriv=2)
+        curvature_noise = noise * np.linalg.norm(savgol_coeffs(window, 3, deriv=2))
+        shoulders, _ = find_peaks(curvature, height=5 * curvature_noise)
+        for ind in shoulders:
+            if signal[ind] < min_height or any(abs(ind - peak_ind) <= width / 2 for _, peak_ind, width in candidates):
+                continue
+            # Inflection points of a Gaussian are one standard deviation away from the center
+            left, right = ind, ind
+            while left > 0 and curvature[left - 1] > 0:
+                left -= 1
+            while right < len(curvature) - 1 and curvature[right + 1] > 0:
+                right += 1
+            candidates.append((signal[ind], ind, (right - left) * np.sqrt(2 * np.log(2))))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        if max_peaks is not None:
+            candidates = candidates[:max_peaks]
+        if not candidates:
+            fitter_logger.warning(f"No peaks found in {self._ID}")
+
+        peaks = []
+        for i, (height, ind, width) in enumerate(candidates):
+            fwhm = max(width, 1.0) * spacing
+            center = self._X_data[ind]
+            parameters = {'center': {'value': center, 'min': center - fwhm, 'max': center + fwhm}}
+            if fittype == "Gauss":
+                parameters['fwhm'] = fwhm
+                amplitude = height * fwhm * np.sqrt(np.pi / (4 * np.log(2)))
+            elif fittype == "Lorentz":
+                parameters['fwhm'] = fwhm
+                amplitude = height * np.pi * fwhm / 2
+            elif fittype == "Pseudo Voigt":
+                # Lorentz width a quarter of the Gauss one gives the total width of 1.1366 of the Gauss width
+                parameters['g_fwhm'] = fwhm / 1.1366
+                parameters['l_fwhm'] = {'value': fwhm / 1.1366 / 4, 'min': 0, 'max': 5 * fwhm}
+                amplitude = height
+            elif fittype == "Voigt":
+                # The same split of the width as for pseudo Voigt, amplitude is the area
+                parameters['g_fwhm'] = fwhm / 1.1366
+                parameters['l_fwhm'] = {'value': fwhm / 1.1366 / 4, 'min': 0, 'max': 5 * fwhm}
+                amplitude = height / Fitter.voigt(0.0, 1.0, 0.0, fwhm / 1.1366, fwhm / 1.1366 / 4)
+            else:
+                # Doniach-Sunjic without asymmetry is a Lorentzian with the FWHM of 2 sigma of the Gauss width
+                parameters['g_fwhm'] = fwhm * np.sqrt(2 * np.log(2))
+                parameters['l_fwhm'] = {'value': 0.1, 'min': 0, 'max': 0.6}
+                sigma = parameters['g_fwhm'] / (2 * np.sqrt(2 * np.log(2)))
+                amplitude = height * sigma ** 0.95 / np.cos(np.pi * 0.05 / 2)
+            for name in ('fwhm', 'g_fwhm'):
+                if name in parameters:
+                    parameters[name] = {'value': parameters[name], 'min': parameters[name] / 5,
+                                        'max': parameters[name] * 5}
+            parameters['amplitude'] = {'value': amplitude, 'min': 0, 'max': 10 * amplitude}
+            for name, spec in parameters.items():
+                spec['value'], spec['min'], spec['max'] = (float(spec['value']), float(spec['min']),
+                                                           float(spec['max']))
+                spec.update({'fix': False, 'dependencetype': 'Independent', 'dependencebase': None})
+            peaks.append({'peakname': f"Peak{i}", 'fittype': fittype,
+                          'parameters': {name: parameters[name] for name in Peak.peak_types[fittype]}})
+        return peaks
+
+    def fit(self, peaks, bg=None, trace=False, reuse_shapes=False, support=None, resolution=None, **kws):
+        """Fits a mix of any Peak.peak_types line shapes and Fitter.bg_types backgrounds to Region object
+        in a single least-squares run.
+        :param peaks: list of peak dictionaries in the format used by GlobalFit (see CompositeModel), e.g.
+        [{'peakname': 'Peak0', 'fittype': 'Doniach-Sunjic',
+          'parameters': {'amplitude': {'value': 200, 'fix': False, 'min': 10, 'max': 100000}, ...}},
+         {'peakname': 'Peak1', 'fittype': 'Gauss',
+          'parameters': {'amplitude': 50, 'center': 22.35, 'fwhm': 1.1}}]
+        :param bg: dictionary {bg_type: {'value': 0.0, 'fix': False, 'min': None, 'max': None}} or a list of
+        Fitter.bg_types names
+        :param trace: if True, the FitReport (see get_report()) keeps the cost of every model evaluation
+        :param reuse_shapes: if True, line shapes are calculated again only when their center or widths change
+        (see CompositeModel.get_shape())
+        :param support: if given, every peak is evaluated only within support FWHM around its center and the Jacobian
+        is calculated band by band (see CompositeModel.fit()). Speeds up fits with many localised peaks
+        :param resolution: instrument function the peaks are convolved with: InstrumentResolution, FWHM of a Gaussian
+        or dictionary {pass energy: FWHM or InstrumentResolution} looked up by the pass energy of the region
+        :param kws: keyword arguments passed to scipy.optimize.least_squares
+        :return: True if the solver converged, False otherwise
+        """
+        model = CompositeModel(peaks, bg, bindingscale=bool(self.region.is_binding()), reuse_shapes=reuse_shapes,
+                               resolution=InstrumentResolution.from_value(resolution, self.region))
+        self._Report = FitReport(self._ID, trace=trace)
+        values, errors, result = model.fit(self._X_data, self._Y_data, report=self._Report, support=support, **kws)
+        self._Report.log(logging.DEBUG)
+        if result is None:
+            self.set_model_results(model, values, errors)
+            return True
+        if not result.success:
+            fitter_logger.warning(f"Fit of {self._ID} did not converge: {result.message}")
+        self.set_model_results(model, values, errors)
+        return result.success
+
+    def set_model_results(self, model, values, errors, report=None):
+        """Replaces peaks and backgrounds of the Fitter with the ones of the fitted CompositeModel
+        :param model: CompositeModel
+        :param values: values of all model parameters
+        :param errors: errors of all model parameters
+        :param report: FitReport of the fit, if any
+        :return: None
+        """
+        if report is not None:
+            self._Report = report
+        self._Peaks = {}
+        windows = model.get_windows() or [None] * len(model.peaks)
+        for (peak_id, fittype, indices), window in zip(model.peaks, windows):
+            self._Peaks[peak_id] = CompactPeak(self._X_data, values[indices].tolist(), errors[indices].tolist(),
+                                               peak_id=peak_id, peak_type=fittype, bindingscale=model.bindingscale,
+                                               resolution=model.resolution, window=window)
+        if model.backgrounds:
+            self._Bg = {bgtype: {'value': float(values[ind]), 'stderr': float(errors[ind])}
+                        for bgtype, ind in model.backgrounds}
+            self.make_fitline(usebg=True)
+        else:
+            self._Bg = None
+            self.make_fitline(usebg=False)
+        self._Model = (model, np.asarray(values, dtype=float))
+
     def make_fitline(self, usebg=False):
         """Calculates the total fit line including all peaks and calculates the
         residuals and r-squared.
         """
+        self._VirtualCurves = {}
+        self._Model = None
         # Calculate fit line
+        self._FitLine = np.zeros_like(self._Y_data)
         for peak in self._Peaks.values():
             if peak:
                 self._FitLine += peak.get_data()[1]
         if usebg and self._Bg is not None:
+            # Backgrounds are evaluated on the peaks line, the same way as in the fitting models
+            peaks_line = self._FitLine.copy()
             for key, val in self._Bg.items():
-                self._FitLine += self.get_model(key, self._X_data, self._Y_data, val)
+                self._FitLine += self.get_model(key, self._X_data, peaks_line, val)
         # Calculate residuals
         self._Residuals = self._Y_data - self._FitLine
         # Calculate R-squared
@@ -705,15 +1348,27 @@ class Fitter:
         self._Chisquared = np.sum(((self._Y_data - self._FitLine)/std_d)**2)
         self._RMS = np.sum((self._Y_data - self._FitLine)**2)
 
+    def get_report(self):
+        """Returns FitReport of the last fit or None if there was no fit
+        """
+        return self._Report
+
+    def get_fit_model(self):
+        """Returns the CompositeModel of the last fit with the fitted values of all its parameters, e.g. for
+        batchfitter.bootstrap(), or None if the peaks were not fitted with Fitter.fit() or GlobalFit
+        :return: (CompositeModel, ndarray) or None
+        """
+        return self._Model
+
     def get_bg(self):
         if self._Bg is None:
             return None
         bg_dict = {}
         for key, val in self._Bg.items():
-            if type(val['value']) == float:
-                bg_dict[key] = [val['value'], 0.0]
-            else:
+            if hasattr(val['value'], 'stderr'):  # lmfit Parameter
                 bg_dict[key] = [val['value'].value, val['value'].stderr]
+            else:
+                bg_dict[key] = [float(val['value']), val.get('stderr', 0.0)]
         return bg_dict
 
     def get_fit_line(self):
@@ -730,8 +1385,10 @@ class Fitter:
         for example.
         :param num: Number of desired points or multiplicator
         :param multiply: True if num is multiplicator, False if num is absolute number of points
-        :return (ndarray, ndarray) x and y data with desired number of points
+        :return (ndarray, ndarray) x and y data with desired number of points (read-only)
         """
+        if ('bg', num, multiply) in self._VirtualCurves:
+            return self._VirtualCurves[('bg', num, multiply)]
         if multiply:
             bg_virtual_x = np.linspace(self._X_data[0], self._X_data[-1], len(self._X_data) * num, endpoint=True)
         else:
@@ -739,14 +1396,20 @@ class Fitter:
         bg_virtual_y = np.zeros_like(bg_virtual_x)
 
         if self._Bg is not None:
-            total_bg_y = np.zeros_like(self._Y_data)
             for key, val in self._Bg.items():
-                total_bg_y += self.get_model(key, self._X_data, self._Y_data, val)
-
-            x = list(range(len(self._X_data)))
-            new_x = np.linspace(0, max(x), len(bg_virtual_x), endpoint=True)
-            bg_virtual_y = np.interp(new_x, x, total_bg_y)
-
+                if key == 'shirley':
+                    # Shirley background at x is proportional to the area of the peaks below x,
+                    # which is integrated exactly instead of summing the peaks on the grid
+                    for peak in self._Peaks.values():
+                        if peak:
+                            bg_virtual_y += val['value'] * Peak.calculate_area(
+                                peak.get_peak_type(), peak.get_parameters(), (np.amin(self._X_data), bg_virtual_x),
+                                peak._bindingscale)
+                else:
+                    bg_virtual_y += self.get_model(key, bg_virtual_x, None, val)
+        bg_virtual_x.flags.writeable = False
+        bg_virtual_y.flags.writeable = False
+        self._VirtualCurves[('bg', num, multiply)] = bg_virtual_x, bg_virtual_y
         return bg_virtual_x, bg_virtual_y
 
     def get_virtual_fitline(self, num=10, multiply=True, usebg=False):
@@ -756,20 +1419,25 @@ class Fitter:
         for example.
         :param num: Number of desired points or multiplicator
         :param multiply: True if num is multiplicator, False if num is absolute number of points
-        :return (ndarray, ndarray) x and y data with desired number of points
+        :return (ndarray, ndarray) x and y data with desired number of points (read-only)
         """
+        if ('fitline', num, multiply, usebg) in self._VirtualCurves:
+            return self._VirtualCurves[('fitline', num, multiply, usebg)]
         fitline_x, fitline_y = None, None
         for i, peak in enumerate(self._Peaks.values()):
             if peak:
                 peak_data = peak.get_virtual_data(num=num, multiply=multiply)
                 if i == 0:
-                    fitline_x, fitline_y = peak_data
+                    fitline_x, fitline_y = peak_data[0], peak_data[1].copy()
                 else:
                     _, fy = peak_data
                     fitline_y += fy
         if usebg:
             _, bg_y = self.get_virtual_bg(num=num, multiply=multiply)
             fitline_y += bg_y
+        if fitline_y is not None:
+            fitline_y.flags.writeable = False
+        self._VirtualCurves[('fitline', num, multiply, usebg)] = fitline_x, fitline_y
         return fitline_x, fitline_y
 
     def get_residuals(self):
@@ -816,3 +1484,413 @@ class Fitter:
         return self._global_gauss_fwhm
 
 
+
+
+class CompositeModel:
+    """Sum of any mix of Peak.peak_types line shapes and Fitter.bg_types backgrounds compiled into one flat
+    parameter vector, so that the whole spectrum is solved in a single least-squares run.
+    """
+    max_support_refits = 3
+
+    def __init__(self, peaks, bg=None, bindingscale=True, reuse_shapes=False, resolution=None):
+        """
+        :param peaks: list of peak dictionaries in the format used by GlobalFit, e.g.
+        [{'peakname': 'Peak0', 'fittype': 'Pseudo Voigt',
+          'parameters': {'amplitude': {'value': 200, 'fix': False, 'min': 10, 'max': 100000},
+                         'center': {'value': 22.35, 'fix': False, 'min': 20, 'max': 25},
+                         'g_fwhm': {'value': 1.15, 'fix': True},
+                         'l_fwhm': {'value': 0.5, 'fix': False, 'min': 0.4, 'max': 0.6}}}]
+        A plain number can be given instead of a parameter dictionary. Missing bounds mean no bounds. Parameters with
+        'dependencetype' 'Dependent +' or 'Dependent *' are linked to the same parameter of the peak given by
+        'dependencebase' (peak number N for the peak named 'PeakN', or the peak name), their 'value', 'min' and 'max'
+        are then the offset or the factor. 'Common' parameters are treated as independent within one spectrum.
+        :param bg: dictionary {bg_type: {'value': 0.0, 'fix': False, 'min': None, 'max': None}} or a list of
+        Fitter.bg_types names which are then fitted starting from zero
+        :param bindingscale: True if the energy axis is binding energy (defines the Doniach-Sunjic asymmetry)
+        :param reuse_shapes: if True, the line shapes normalised to unit amplitude are kept for every peak and
+        energy axis and calculated again only when the center or widths of the peak change (see evaluate())
+        :param resolution: InstrumentResolution or FWHM of a Gaussian instrument function the peaks are convolved
+        with. The backgrounds are calculated from the convolved peaks
+        """
+        self.bindingscale = bindingscale
+        self.reuse_shapes = reuse_shapes
+        self.resolution = InstrumentResolution.from_value(resolution)
+        self._Shapes = {}  # {(peak number, id(energy), window): (energy, shape parameters, line shape)}
+        self._Windows = None  # (energy, [slice of energy for every peak]) of the last fit with support windows
+        self.names = []
+        self.peaks = []  # [(peak_id, fittype, ndarray of parameter indices), ...]
+        self.backgrounds = []  # [(bg_type, parameter index), ...]
+        values, lower, upper, fixed = [], [], [], []
+        dependencies = {}  # {parameter index: (base peak name, parameter name, '+' or '*')}
+
+        def add_parameter(name, spec):
+            if not isinstance(spec, dict):
+                spec = {'value': spec}
+            if spec.get('value') is None or spec.get('value') == "":
+                raise ValueError(f"Initial value of parameter '{name}' is not defined")
+            self.names.append(name)
+            values.append(float(spec['value']))
+            lower.append(-np.inf if spec.get('min') is None or spec.get('min') == "" else float(spec['min']))
+            upper.append(np.inf if spec.get('max') is None or spec.get('max') == "" else float(spec['max']))
+            fixed.append(bool(spec.get('fix', False)))
+            return spec
+
+        for i, peak in enumerate(peaks):
+            fittype = peak['fittype']
+            if fittype not in Peak.peak_types:
+                raise KeyError(f"'{fittype}' is not a valid fitting model")
+            peak_id = peak.get('peakname', i)
+            indices = []
+            for param_name in Peak.peak_types[fittype]:
+                if param_name not in peak['parameters']:
+                    raise KeyError(f"Parameter '{param_name}' is missing for peak {peak_id}")
+                indices.append(len(self.names))
+                spec = add_parameter(f"{peak_id}_{param_name}", peak['parameters'][param_name])
+                if spec.get('dependencetype') in ('Dependent +', 'Dependent *'):
+                    base = spec['dependencebase']
+                    if not isinstance(base, str):
+                        base = f"Peak{base}"
+                    dependencies[indices[-1]] = (base, param_name, spec['dependencetype'][-1])
+            self.peaks.append((peak_id, fittype, np.array(indices)))
+
+        if bg is not None and not isinstance(bg, dict):
+            bg = {bgtype: {'value': 0.0} for bgtype in bg}
+        for bgtype, spec in (bg or {}).items():
+            if bgtype not in Fitter.bg_types:
+                raise KeyError(f"'{bgtype}' is not a valid background model")
+            self.backgrounds.append((bgtype, len(self.names)))
+            add_parameter(f"bg_{bgtype}", spec)
+
+        self.values = np.array(values, dtype=float)
+        self.lower = np.array(lower, dtype=float)
+        self.upper = np.array(upper, dtype=float)
+        self.fixed = np.array(fixed, dtype=bool)
+        self.free = np.flatnonzero(~self.fixed)
+        self.links = self._order_links(dependencies)
+
+    def _order_links(self, dependencies):
+        """Resolves the dependence bases to parameter indices and orders the links so that every base
+        is resolved before the parameters depending on it.
+        :return: list of (index, base index, '+' or '*')
+        """
+        links = {}
+        for ind, (base_peak, param_name, operation) in dependencies.items():
+            base_name = f"{base_peak}_{param_name}"
+            if base_name not in self.names:
+                raise KeyError(f"Dependence base '{base_name}' for parameter '{self.names[ind]}' is not defined")
+            links[ind] = (self.names.index(base_name), operation)
+        ordered, resolved = [], set()
+
+        def resolve(ind, chain):
+            if ind in resolved or ind not in links:
+                return
+            if ind in chain:
+                raise ValueError(f"Circular dependence of parameter '{self.names[ind]}'")
+            resolve(links[ind][0], chain | {ind})
+            ordered.append((ind, *links[ind]))
+            resolved.add(ind)
+
+        for ind in links:
+            resolve(ind, set())
+        return ordered
+
+    def expand(self, free_values):
+        """Returns the vector of all line shape and background parameters for the given values of free parameters.
+        Fixed parameters keep their initial values, dependent ones are calculated from their bases.
+        """
+        values = self.values.copy()
+        values[self.free] = free_values
+        for ind, base, operation in self.links:
+            if operation == '+':
+                values[ind] = values[base] + values[ind]
+            else:
+                values[ind] = values[base] * values[ind]
+        return values
+
+    def contract(self, values):
+        """Returns the vector of free parameters for the vector of all parameters, the inverse of expand()
+        """
+        raw = np.array(values, dtype=float)
+        for ind, base, operation in self.links:
+            if operation == '+':
+                raw[ind] = values[ind] - values[base]
+            elif values[base] != 0:
+                raw[ind] = values[ind] / values[base]
+            else:
+                raw[ind] = self.values[ind]
+        return raw[self.free]
+
+    def expand_derivatives(self, free_values):
+        """Returns the vector of all parameters (see expand()) and its derivatives with respect to the free parameters
+        :return: (ndarray, ndarray) values and derivatives of shape (number of parameters, number of free parameters)
+        """
+        raw = self.values.copy()
+        raw[self.free] = free_values
+        values = self.expand(free_values)
+        derivatives = np.zeros((len(self.values), len(self.free)))
+        derivatives[self.free, np.arange(len(self.free))] = 1.0
+        for ind, base, operation in self.links:
+            if operation == '+':
+                derivatives[ind] = derivatives[base] + derivatives[ind]
+            else:
+                derivatives[ind] = raw[ind] * derivatives[base] + values[base] * derivatives[ind]
+        return values, derivatives
+
+    def propagate_covariance(self, free_values, covariance):
+        """Returns the errors of all parameters given the covariance matrix of the free parameters
+        """
+        _, derivatives = self.expand_derivatives(free_values)
+        variances = np.einsum('ij,jk,ik->i', derivatives, covariance, derivatives)
+        return np.sqrt(np.absolute(variances))
+
+    def evaluate(self, energy, values, resolution=None):
+        """Calculates the model for the full vector of parameters (see expand())
+        :param energy: x axis
+        :param values: vector of all parameters. An array of shape (number of parameters, number of spectra, 1)
+        evaluates a stack of spectra at once
+        :param resolution: InstrumentResolution to use instead of self.resolution
+        :return: (ndarray, ndarray) total model line and its background part
+        """
+        resolution = resolution or self.resolution
+        if resolution is None:
+            line = self.evaluate_peaks(energy, values)
+        else:
+            line = resolution.convolve(energy, self.evaluate_peaks(resolution.get_grid(energy), values))
+        bg = np.zeros_like(line)
+        for bgtype, ind in self.backgrounds:
+            if bgtype == 'shirley':
+                bg += Fitter.shirley(energy, line, values[ind])
+            else:
+                bg += Fitter.get_model_func(bgtype)(energy, values[ind])
+        return line + bg, bg
+
+    def evaluate_peaks(self, energy, values):
+        """Calculates the sum of the peaks without convolution (see evaluate())
+        """
+        asymmetry = 'higher' if self.bindingscale else 'lower'
+        line = np.zeros_like(energy, dtype=float)
+        if np.ndim(values) == 1:
+            windows = None
+            if self._Windows is not None and self._Windows[0] is energy:
+                windows = self._Windows[1]
+            for n, (_, fittype, indices) in enumerate(self.peaks):
+                window = slice(None) if windows is None else windows[n]
+                if self.reuse_shapes:
+                    line[window] += values[indices[0]] * self.get_shape(n, fittype, energy, values[indices[1:]],
+                                                                         asymmetry, window)
+                else:
+                    line[window] += Fitter.get_model_func(fittype)(energy[window], *values[indices],
+                                                                   asymmetry=asymmetry)
+        else:
+            for _, fittype, indices in self.peaks:
+                line = line + Fitter.get_model_func(fittype)(energy, *values[indices], asymmetry=asymmetry)
+        return line
+
+    def get_shape(self, n, fittype, energy, shape_values, asymmetry, window=slice(None)):
+        """Returns the line shape of the peak number n with unit amplitude. All line shapes are proportional to
+        the amplitude, so the shape is reused while the other parameters of the peak stay the same, e.g. when
+        the finite-difference Jacobian steps the amplitude, the background or another peak.
+        :param n: peak number in self.peaks
+        :param fittype: one of Peak.peak_types
+        :param energy: x axis
+        :param shape_values: values of the peak parameters except the amplitude
+        :param asymmetry: 'higher' or 'lower', see Fitter.doniach_sunjic()
+        :param window: slice of energy to calculate the shape on
+        :return: read-only ndarray
+        """
+        key = (n, id(energy), window.start, window.stop)
+        shape_values = tuple(shape_values)
+        cached = self._Shapes.get(key)
+        if cached is not None and cached[0] is energy and cached[1] == shape_values:
+            return cached[2]
+        shape = Fitter.get_model_func(fittype)(energy[window], 1.0, *shape_values, asymmetry=asymmetry)
+        shape.flags.writeable = False
+        self._Shapes[key] = (energy, shape_values, shape)
+        return shape
+
+    def clear_shapes(self):
+        """Releases the line shapes kept for reuse
+        """
+        self._Shapes = {}
+
+    def get_support(self, energy, free_values, width):
+        """Returns the support windows of the peaks: the parts of the energy axis within width FWHM from every
+        center the peak can take within its finite bounds. The FWHM (g_fwhm + l_fwhm for four-parameter line shapes)
+        are taken at free_values.
+        :param energy: x axis, monotonic
+        :param free_values: values of free parameters
+        :param width: half-width of the window in FWHM of the peak
+        :return: list of slices of energy for every peak in self.peaks
+        """
+        values = self.expand(free_values)
+        with np.errstate(invalid='ignore'):
+            lowest = self.expand(self.lower[self.free])
+            highest = self.expand(self.upper[self.free])
+        windows = []
+        for _, _, indices in self.peaks:
+            centers = np.array([values[indices[1]], lowest[indices[1]], highest[indices[1]]])
+            centers = centers[np.isfinite(centers)]
+            fwhm = np.sum(np.absolute(values[indices[2:]]))
+            inside = np.flatnonzero((energy >= centers.min() - width * fwhm) & (energy <= centers.max() + width * fwhm))
+            if len(inside) == 0:
+                windows.append(slice(0, 0))
+            else:
+                windows.append(slice(int(inside[0]), int(inside[-1]) + 1))
+        return windows
+
+    def get_windows(self):
+        """Returns the energy ranges (low, high) the peaks were truncated to in the last fit with support windows
+        (see fit()), (inf, -inf) for peaks outside the energy axis, or None if the peaks were not truncated
+        """
+        if self._Windows is None:
+            return None
+        axis, windows = self._Windows
+        ranges = []
+        for window in windows:
+            if window.stop > window.start:
+                ends = axis[window.start], axis[window.stop - 1]
+                ranges.append((float(min(ends)), float(max(ends))))
+            else:
+                ranges.append((np.inf, -np.inf))
+        return ranges
+
+    def jacobian(self, free_values, energy, intensity):
+        """Returns the Jacobian of residuals() calculated band by band: the columns of the parameters of a peak are
+        forward differences of this peak alone on its support window (see get_support()), the amplitude column is
+        the line shape itself. Backgrounds are linear in their values and the Shirley background is linear in the
+        peaks line, so their contributions are added for all peaks at once. Dependent parameters are accounted for
+        by the chain rule through expand_derivatives(). With an instrument function the peak columns are calculated on
+        its grid and convolved.
+        :param free_values: values of free parameters
+        :param energy: x axis
+        :param intensity: y axis (not used, the signature follows residuals())
+        :return: ndarray of shape (number of points, number of free parameters)
+        """
+        values, derivatives = self.expand_derivatives(free_values)
+        used = np.any(derivatives != 0, axis=1)
+        asymmetry = 'higher' if self.bindingscale else 'lower'
+        axis = energy if self.resolution is None else self.resolution.get_grid(energy)
+        windows = [slice(None)] * len(self.peaks)
+        if self._Windows is not None and self._Windows[0] is axis:
+            windows = self._Windows[1]
+        line = np.zeros_like(axis, dtype=float)
+        columns = np.zeros((len(values), len(axis)))
+        for (_, fittype, indices), window in zip(self.peaks, windows):
+            func = Fitter.get_model_func(fittype)
+            x = axis[window]
+            shape = func(x, 1.0, *values[indices[1:]], asymmetry=asymmetry)
+            line[window] += values[indices[0]] * shape
+            columns[indices[0], window] = shape
+            for k in range(1, len(indices)):
+                if not used[indices[k]]:
+                    continue
+                shifted = values[indices].copy()
+                step = np.sqrt(np.finfo(float).eps) * max(1.0, abs(shifted[k]))
+                shifted[k] += step
+                columns[indices[k], window] = (func(x, *shifted, asymmetry=asymmetry) -
+                                               values[indices[0]] * shape) / step
+        if self.resolution is not None:
+            line = self.resolution.convolve(energy, line)
+            columns = self.resolution.convolve(energy, columns)
+        for bgtype, ind in self.backgrounds:
+            if bgtype == 'shirley':
+                peak_columns = np.concatenate([indices for _, _, indices in self.peaks]).astype(int)
+                columns[peak_columns] += values[ind] * Fitter.shirley(energy, columns[peak_columns], 1.0)
+                columns[ind] = Fitter.shirley(energy, line, 1.0)
+            else:
+                columns[ind] = Fitter.get_model_func(bgtype)(energy, 1.0)
+        return -(columns.T @ derivatives)
+
+    def residuals(self, free_values, energy, intensity):
+        return intensity - self.evaluate(energy, self.expand(free_values))[0]
+
+    def fit(self, energy, intensity, p0=None, report=None, support=None, **kws):
+        """Solves the model for one spectrum with scipy.optimize.least_squares
+        :param energy: x axis
+        :param intensity: y axis
+        :param p0: initial values of free parameters. If None, values from the peaks description are used
+        :param report: FitReport to fill in, if given
+        :param support: if given, every peak is evaluated only within support FWHM around its center (see
+        get_support()) and the Jacobian is calculated band by band (see jacobian()), so that the cost of a fit grows
+        about linearly with the number of localised peaks. The line shapes are truncated at the window edges. If the
+        peaks outgrow their windows, the fit is repeated on wider ones (at most max_support_refits times). The final
+        windows are kept, so that evaluate() on the same energy axis and get_windows() give the minimised model
+        :param kws: keyword arguments passed to scipy.optimize.least_squares
+        :return: (ndarray, ndarray, OptimizeResult) values and errors of all parameters and the solver result
+        """
+        lower, upper = self.lower[self.free], self.upper[self.free]
+        if p0 is None:
+            p0 = self.values[self.free]
+        # least_squares requires the starting point to be strictly feasible
+        p0 = np.clip(p0, lower, upper)
+        if len(self.free) == 0:
+            values = self.expand(p0)
+            if report is not None:
+                report.finish(cost=0.5 * np.sum((intensity - self.evaluate(energy, values)[0]) ** 2), success=True,
+                              message="No free parameters", nfev=0, njev=0)
+            return values, np.zeros_like(values), None
+        residuals = self.residuals
+        if report is not None:
+            residuals = report.wrap(residuals)
+            report.start()
+        self._Windows = None
+        if support is not None:
+            axis = energy if self.resolution is None else self.resolution.get_grid(energy)
+            self._Windows = (axis, self.get_support(axis, p0, support))
+            kws.setdefault('jac', self.jacobian)
+        nfev, njev = 0, 0
+        try:
+            for attempt in range(self.max_support_refits + 1):
+                result = least_squares(residuals, p0, bounds=(lower, upper), args=(energy, intensity), **kws)
+                nfev, njev = nfev + result.nfev, njev + (result.njev or 0)
+                if support is None:
+                    break
+                # The windows are taken at the starting widths. If the peaks grew out of them, the fit is repeated
+                # from the solution on the windows of the fitted widths, which only grow
+                windows = self._Windows[1]
+                grown = []
+                for old, new in zip(windows, self.get_support(axis, result.x, support)):
+                    if old.stop > old.start and new.stop > new.start:
+                        new = slice(min(old.start, new.start), max(old.stop, new.stop))
+                    grown.append(new if new.stop > new.start else old)
+                if grown == windows:
+                    break
+                if attempt == self.max_support_refits:
+                    fitter_logger.warning(f"Support windows still grow after {attempt} refits, "
+                                          f"the peaks are truncated")
+                    break
+                self._Windows = (axis, grown)
+                self.clear_shapes()
+                p0 = result.x
+        except Exception:
+            self._Windows = None
+            raise
+        finally:
+            self.clear_shapes()
+        if report is not None:
+            report.finish(cost=result.cost, success=result.success, status=result.status, message=result.message,
+                          nfev=nfev, njev=njev)
+        values = self.expand(result.x)
+        errors = self.propagate_covariance(result.x, self.covariance(result, len(intensity)))
+        return values, errors, result
+
+    @staticmethod
+    def covariance(result, ndata):
+        """Estimates the covariance of free parameters from the Jacobian at the solution
+        scaled by the reduced chi-square, the same way as scipy.optimize.curve_fit does.
+        Sparse Jacobians (solved with jac_sparsity) are reduced to the normal matrix first.
+        """
+        if sparse.issparse(result.jac):
+            covariance = np.linalg.pinv((result.jac.T @ result.jac).toarray(), hermitian=True)
+        else:
+            _, s, vt = np.linalg.svd(result.jac, full_matrices=False)
+            threshold = np.finfo(float).eps * max(result.jac.shape) * s[0]
+            s = s[s > threshold]
+            vt = vt[:s.size]
+            covariance = np.dot(vt.T / s ** 2, vt)
+        dof = ndata - result.x.size
+        if dof > 0:
+            covariance = covariance * 2 * result.cost / dof
+        else:
+            covariance.fill(np.inf)
+        return covariance
@@ -1,21 +1,76 @@
 import copy
+import json
 import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
 import numpy as np
+from scipy import sparse
+from scipy.optimize import least_squares
 from lmfit import Parameters, minimize
+from lmfit.minimizer import MinimizerResult
 
 from specqp import helpers
-from specqp.fitter import Fitter, Peak
+from specqp.fitcache import FitCache
+from specqp.fitter import Fitter, FitReport, Peak, CompactPeak, CompositeModel, InstrumentResolution
 
 globalfitter_logger = logging.getLogger("specqp.globalfitter")  # Creating child logger
 
 
+class FitAborted(Exception):
+    """Raised from the objective function to stop the solver when the progress callback asks for it
+    """
+    def __init__(self, free_values):
+        super().__init__("Fit aborted")
+        self.free_values = free_values
+
+
+# State of a GlobalFit.fit_multistart() worker process: the evaluation plan, constraints and solver settings
+_multistart = {}
+
+
+def _init_multistart(plan, constraints, sparsity, kws):
+    _multistart.update(plan=plan, constraints=constraints, sparsity=sparsity, kws=kws)
+
+
+def _fit_start(start_ind, x0):
+    """Solves the global fit from one starting point of the free parameters
+    :return: (int, OptimizeResult, int) number of the start, the solver result and the number of evaluations
+    """
+    plan, constraints = _multistart['plan'], _multistart['constraints']
+    lower, upper = constraints.lower[constraints.free], constraints.upper[constraints.free]
+    report = FitReport(f"Start {start_ind}")
+    residuals = report.wrap(lambda free_values: plan.residuals(constraints.expand(free_values)))
+    try:
+        result = least_squares(residuals, x0, bounds=(lower, upper), jac_sparsity=_multistart['sparsity'],
+                               **_multistart['kws'])
+    finally:
+        plan.close()
+    return start_ind, result, report.evaluations
+
+
 class GlobalFit:
-    def __init__(self, regions, peaks_info, bg_params, y_data='final'):
+    def __init__(self, regions, peaks_info, bg_params, y_data='final', workers=1, resolution=None):
         if not helpers.is_iterable(regions):
             self._Regions = [regions]
         else:
             self._Regions = regions
+        # Instrument functions the peaks of every spectrum are convolved with: InstrumentResolution, FWHM of
+        # a Gaussian, dictionary {pass energy: FWHM or InstrumentResolution} or a list of those for every spectrum
+        if not isinstance(resolution, (list, tuple)):
+            resolution = [resolution] * len(self._Regions)
+        if len(resolution) != len(self._Regions):
+            raise ValueError(f"{len(resolution)} instrument functions are given for {len(self._Regions)} spectra")
+        self._Resolutions = [InstrumentResolution.from_value(value, region)
+                             for value, region in zip(resolution, self._Regions)]
+        for shared in {id(value): value for value in self._Resolutions if value is not None}.values():
+            shared.reserve_grids(sum(value is shared for value in self._Resolutions))
+        self._YData = y_data
         self._Data = []
         self._Fitters = []
         for region in self._Regions:
@@ -29,12 +84,27 @@ class GlobalFit:
         self._FitParams = Parameters()
         self._PeaksInfo = copy.deepcopy(peaks_info)
         self._BgParams = copy.deepcopy(bg_params)
+        # Fit definitions as they were given, for checkpoints
+        self._InitPeaksInfo = copy.deepcopy(peaks_info)
+        self._InitBgParams = copy.deepcopy(bg_params)
         for bgpar in self._BgParams.values():
             if bgpar['min'] is None or bgpar['min'] == "":
                 bgpar['min'] = -np.inf
             if bgpar['max'] is None or bgpar['max'] == "":
                 bgpar['max'] = np.inf
         self._BaseValues = {}
+        # Number of threads evaluating the spectra of err_func concurrently
+        self._Workers = workers
+        # Result of the last fit, lmfit.minimizer.MinimizerResult, and its FitReport
+        self._Result = None
+        self._Report = None
+        # Parameter values of the last call of err_func, for the progress callback of the lmfit backend
+        self._LastValues = None
+        # Operation ('+', '*' or '=' for 'Common') and names of parameters which every constrained parameter
+        # is calculated from
+        self._ParamDeps = {}
+        # Outcomes of the starts of the last fit_multistart()
+        self._Starts = []
 
         self.bindingscale = True
         if not self._Regions[0].is_binding():
@@ -56,39 +126,102 @@ class GlobalFit:
             return fit_params[f'{peak_name}_{param_name}_{spectra_ind}'].stderr
 
     def get_bg_values(self, fit_params, spectra_ind):
-        local_bg = copy.deepcopy(self._BgParams)
+        local_bg = {bg_type: dict(params) for bg_type, params in self._BgParams.items()}
         if fit_params:
             for bg_type, params in local_bg.items():
                 params['value'] = fit_params[f'bg_{bg_type}_{spectra_ind}']
         return local_bg
 
+    def get_param_values(self, fit_params=None):
+        """Returns the values of all parameters as a vector ordered the same way as self._FitParams
+        """
+        if not fit_params:
+            fit_params = self._FitParams
+        return np.fromiter((par.value for par in fit_params.values()), dtype=float, count=len(fit_params))
+
+    def get_report(self):
+        """Returns FitReport of the last global fit or None if there was no fit
+        """
+        return self._Report
+
+    def get_cache_key(self, *options):
+        """Returns the key of the fit in FitCache: hash of the data, the peaks and backgrounds definitions,
+        the current starting values of the parameters, the instrument functions and options
+        :param options: solver options defining the result, e.g. the keyword arguments of fit()
+        """
+        return FitCache.make_key(list(self._Regions), self._YData, 'GlobalFit', self._InitPeaksInfo, self._InitBgParams,
+                                 list(self._FitParams.keys()), self.get_param_values(), self._Resolutions, options)
+
+    def save_checkpoint(self, filename, values=None, state=None):
+        """Writes the fit definitions and parameter values to a JSON file. The file is replaced atomically,
+        so an interrupted write never leaves a broken checkpoint.
+        :param filename: name of the checkpoint file
+        :param values: vector of all parameter values ordered as self._FitParams. Current values if None
+        :param state: dictionary with the state of the solver
+        :return: None
+        """
+        if values is None:
+            values = self.get_param_values()
+        data = {
+            'regions': [spectrum['scan'] for spectrum in self._Data],
+            'y_data': self._YData,
+            'peaks_info': self._InitPeaksInfo,
+            'bg_params': self._InitBgParams,
+            'params': {name: float(value) for name, value in zip(self._FitParams.keys(), values)},
+            'state': state or {}
+        }
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as tmp:
+            try:
+                json.dump(data, tmp, default=float)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            except Exception:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        os.replace(tmp.name, filename)
+
+    @classmethod
+    def from_checkpoint(cls, filename, regions, workers=1, resolution=None):
+        """Creates GlobalFit from the checkpoint file written by save_checkpoint() or fit(checkpoint=...)
+        with the parameters starting from the saved values
+        :param filename: name of the checkpoint file
+        :param regions: the same regions (in the same order) that were fitted when the checkpoint was written
+        :param workers: number of threads evaluating the spectra
+        :param resolution: instrument functions of the spectra (see GlobalFit), they are not saved in checkpoints
+        :return: GlobalFit
+        """
+        with open(filename) as checkpoint_file:
+            data = json.load(checkpoint_file)
+        if not helpers.is_iterable(regions):
+            regions = [regions]
+        if len(regions) != len(data['regions']):
+            raise ValueError(f"The checkpoint was written for {len(data['regions'])} regions, "
+                             f"{len(regions)} are given")
+        if [region.get_id() for region in regions] != data['regions']:
+            globalfitter_logger.warning("IDs of the regions don't match the ones in the checkpoint")
+        global_fit = cls(regions, data['peaks_info'], data['bg_params'], y_data=data['y_data'], workers=workers,
+                         resolution=resolution)
+        for name, value in data['params'].items():
+            if name in global_fit._FitParams and global_fit._FitParams[name].expr is None:
+                global_fit._FitParams[name].value = value
+        state = data.get('state', {})
+        if state:
+            globalfitter_logger.info(f"Resuming from {filename}: {state.get('evaluations', 0)} evaluations, "
+                                     f"cost {state.get('cost')}, finished {state.get('finished', False)}")
+        return global_fit
+
     def sim_spectra(self, fit_params, spectra_ind):
         """Defines the model for the fit (doniach, voigt, shirley bg, linear bg
         """
-        line = np.zeros_like(self._Data[spectra_ind]['intensity'])
-        bg = np.zeros_like(self._Data[spectra_ind]['intensity'])
-        local_bg = self.get_bg_values(fit_params, spectra_ind)
-        peaks = copy.deepcopy(self._PeaksInfo)
-        for peak in peaks:
-            if fit_params:
-                for param_name, param_data in peak['parameters'].items():
-                    param_data['value'] = fit_params[f"{peak['peakname']}_{param_name}_{spectra_ind}"]
-            line += Fitter.get_model(peak['fittype'], self._Data[spectra_ind]['energy'],
-                                     self._Data[spectra_ind]['intensity'], peak['parameters'],
-                                     bindingscale=self.bindingscale)
-        for fittype, params in local_bg.items():
-            bg += Fitter.get_model(fittype, self._Data[spectra_ind]['energy'], line, params)
-        line += bg
-        return line, bg
+        return self._Plan.simulate(self.get_param_values(fit_params), spectra_ind)
 
     def err_func(self, fit_params):
         """ calculate total residual for fits to several data sets held
         in a 2-D array, and modeled by model function"""
-        residuals = []
-        for ind in range(len(self._Regions)):
-            spectra, _ = self.sim_spectra(fit_params, ind)
-            residuals.append(self._Data[ind]['intensity'] - spectra)
-        return [item for innerlist in residuals for item in innerlist]
+        self._LastValues = self.get_param_values(fit_params)
+        return self._Plan.residuals(self._LastValues)
 
     def make_initial_params(self):
         """
@@ -159,6 +292,9 @@ class GlobalFit:
                                             max=self._FitParams[f"Peak{param_data['dependencebase']}_{param_name}_{ind}"].max + param_data['max'],
                                             vary=vary,
                                             expr=f"Peak{param_data['dependencebase']}_{param_name}_{ind} + {peak['peakname']}_{param_name}_{ind}_base")
+                        self._ParamDeps[f"{peak['peakname']}_{param_name}_{ind}"] = ('+', [
+                            f"Peak{param_data['dependencebase']}_{param_name}_{ind}",
+                            f"{peak['peakname']}_{param_name}_{ind}_base"])
                     elif param_data['dependencetype'] == 'Dependent *':
                         self._FitParams.add(f"{peak['peakname']}_{param_name}_{ind}_base", value=param_data['value'],
                                             min=param_data['min'],
@@ -170,6 +306,9 @@ class GlobalFit:
                                             max=self._FitParams[f"Peak{param_data['dependencebase']}_{param_name}_{ind}"].max * param_data['max'],
                                             vary=vary,
                                             expr=f"Peak{param_data['dependencebase']}_{param_name}_{ind} * {peak['peakname']}_{param_name}_{ind}_base")
+                        self._ParamDeps[f"{peak['peakname']}_{param_name}_{ind}"] = ('*', [
+                            f"Peak{param_data['dependencebase']}_{param_name}_{ind}",
+                            f"{peak['peakname']}_{param_name}_{ind}_base"])
                     elif param_data['dependencetype'] == 'Common':
                         if not ind == 0:
                             common[f"{peak['peakname']}_{param_name}_{ind}"] = f"{peak['peakname']}_{param_name}_{0}"
@@ -179,32 +318,754 @@ class GlobalFit:
         if len(common) > 0:
             for key, val in common.items():
                 self._FitParams[key].expr = val
+                self._ParamDeps[key] = ('=', [val])
+
+        self._Plan = EvaluationPlan(self._PeaksInfo, list(self._BgParams.keys()), self._Data,
+                                    list(self._FitParams.keys()), bindingscale=self.bindingscale,
+                                    workers=self._Workers, resolutions=self._Resolutions)
+
+    def get_free_params(self, param_name):
+        """Returns the set of names of varied parameters that the parameter param_name is calculated from
+        """
+        par = self._FitParams[param_name]
+        if par.expr is None:
+            return {param_name} if par.vary else set()
+        free_params = set()
+        for dependence in self._ParamDeps[param_name][1]:
+            free_params |= self.get_free_params(dependence)
+        return free_params
+
+    def get_jacobian_sparsity(self):
+        """Returns the sparsity structure of the Jacobian of err_func with respect to the varied parameters.
+        Residuals of every spectrum depend only on the parameters of this spectrum and on the parameters
+        linked to them by 'Common' and 'Dependent' constraints.
+        :return: scipy.sparse.csr_matrix of shape (number of data points, number of varied parameters)
+        """
+        free_names = [name for name, par in self._FitParams.items() if par.vary and par.expr is None]
+        columns = {name: i for i, name in enumerate(free_names)}
+        param_names = list(self._FitParams.keys())
+        indices, row_lengths = [], []
+        for i, layout in enumerate(self._Plan.indices):
+            spectrum_params = set()
+            for ind in layout:
+                spectrum_params |= self.get_free_params(param_names[ind])
+            spectrum_columns = np.sort([columns[name] for name in spectrum_params]).astype(int)
+            npoints = self._Plan.offsets[i + 1] - self._Plan.offsets[i]
+            indices.append(np.tile(spectrum_columns, npoints))
+            row_lengths.append(np.full(npoints, len(spectrum_columns)))
+        indices = np.concatenate(indices)
+        indptr = np.concatenate(([0], np.cumsum(np.concatenate(row_lengths))))
+        return sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(self._Plan.size, len(free_names)))
+
+    def get_spectrum_model(self, spectra_ind, fit_params=None):
+        """Returns CompositeModel of one spectrum with the current parameter values and bounds of this spectrum.
+        'Dependent' constraints are kept within the spectrum, 'Common' parameters become independent.
+        :param spectra_ind: number of the spectrum
+        :param fit_params: lmfit Parameters to take the values from, the parameters of GlobalFit if None
+        """
+        if fit_params is None:
+            fit_params = self._FitParams
+        peaks = []
+        for peak in self._PeaksInfo:
+            parameters = {}
+            for param_name, param_data in peak['parameters'].items():
+                name = f"{peak['peakname']}_{param_name}_{spectra_ind}"
+                if param_data['dependencetype'] in ('Dependent +', 'Dependent *'):
+                    name = f"{name}_base"
+                par = fit_params[name]
+                parameters[param_name] = {'value': par.value, 'min': par.min, 'max': par.max,
+                                          'fix': bool(param_data['fix']),
+                                          'dependencetype': param_data['dependencetype'],
+                                          'dependencebase': param_data['dependencebase']}
+            peaks.append({'peakname': peak['peakname'], 'fittype': peak['fittype'], 'parameters': parameters})
+        bg = {}
+        for bgtype in self._BgParams.keys():
+            par = fit_params[f'bg_{bgtype}_{spectra_ind}']
+            bg[bgtype] = {'value': par.value, 'min': par.min, 'max': par.max, 'fix': not par.vary}
+        return CompositeModel(peaks, bg, bindingscale=self.bindingscale, resolution=self._Resolutions[spectra_ind])
+
+    def fit_spectrum(self, spectra_ind, **kws):
+        """Fits one spectrum independently from the others (see get_spectrum_model())
+        :return: (CompositeModel, ndarray) the model and the fitted values of its parameters or
+        (CompositeModel, None) if the fit failed
+        """
+        model = self.get_spectrum_model(spectra_ind)
+        try:
+            values, _, result = model.fit(self._Data[spectra_ind]['energy'], self._Data[spectra_ind]['intensity'],
+                                          **kws)
+        except ValueError as err:
+            globalfitter_logger.warning(f"Fit of spectrum {self._Data[spectra_ind]['scan']} failed: {err}")
+            return model, None
+        if result is not None and not result.success:
+            globalfitter_logger.warning(f"Fit of spectrum {self._Data[spectra_ind]['scan']} did not converge")
+            return model, None
+        return model, values
+
+    def warm_start(self, **kws):
+        """Fits every spectrum independently (concurrently if GlobalFit has several workers) and uses the results
+        as initial values of the global fit. 'Common' parameters start from the mean of individual fits,
+        'Dependent' offsets and factors from the difference or ratio of the parameter and its base.
+        Spectra with failed individual fits keep their initial values.
+        :param kws: keyword arguments passed to scipy.optimize.least_squares for individual fits.
+        Parameters are scaled by the Jacobian (x_scale='jac') unless specified otherwise
+        :return: number of spectra fitted successfully
+        """
+        kws.setdefault('x_scale', 'jac')
+        spectra = range(len(self._Regions))
+        if self._Workers > 1:
+            with ThreadPoolExecutor(max_workers=self._Workers) as executor:
+                fits = list(executor.map(lambda ind: self.fit_spectrum(ind, **kws), spectra))
+        else:
+            fits = [self.fit_spectrum(ind, **kws) for ind in spectra]
+
+        seeds = {}
+        common = {}
+        for ind, (model, values) in enumerate(fits):
+            if values is None:
+                continue
+            fitted = dict(zip(model.names, values))
+            for peak in self._PeaksInfo:
+                for param_name, param_data in peak['parameters'].items():
+                    local_name = f"{peak['peakname']}_{param_name}"
+                    name = f"{local_name}_{ind}"
+                    if param_data['dependencetype'] == 'Dependent +':
+                        base = fitted[f"Peak{param_data['dependencebase']}_{param_name}"]
+                        seeds[f"{name}_base"] = fitted[local_name] - base
+                    elif param_data['dependencetype'] == 'Dependent *':
+                        base = fitted[f"Peak{param_data['dependencebase']}_{param_name}"]
+                        if base != 0:
+                            seeds[f"{name}_base"] = fitted[local_name] / base
+                    elif param_data['dependencetype'] == 'Common':
+                        common.setdefault(f"{local_name}_0", []).append(fitted[local_name])
+                    else:
+                        seeds[name] = fitted[local_name]
+            for bgtype in self._BgParams.keys():
+                seeds[f'bg_{bgtype}_{ind}'] = fitted[f'bg_{bgtype}']
+        for name, values in common.items():
+            seeds[name] = np.mean(values)
+        for name, value in seeds.items():
+            par = self._FitParams[name]
+            if par.vary and par.expr is None:
+                par.value = value
+        return sum(values is not None for _, values in fits)
+
+    def fit_sequential(self, callback=None, history=3, max_cost_increase=3.0, **kws):
+        """Fits the spectra one by one in their order, every spectrum on its own (see get_spectrum_model()).
+        A fit starts from the linear extrapolation of the last history results. If the fit diverges (doesn't
+        converge or ends with the cost more than max_cost_increase times higher than the one of the previous
+        spectrum), it is repeated from the previous result and then from the initial values, keeping the best one.
+        :param callback: function callback(spectra_ind, fitter) called when a spectrum is fitted, e.g. to follow
+        the trends of peak areas and centers. If it returns True, the remaining spectra are not fitted
+        :param history: number of previous results used for the extrapolation, 1 to start from the previous result
+        :param max_cost_increase: ratio of the costs of consecutive spectra treated as divergence
+        :param kws: keyword arguments passed to scipy.optimize.least_squares
+        :return: list of Fitter objects of the fitted spectra
+        """
+        previous = []
+        previous_cost = None
+        for ind, fitterobj in enumerate(self._Fitters):
+            model = self.get_spectrum_model(ind)
+            starts = []
+            if previous:
+                starts.append(('extrapolated', self.extrapolate(previous[-max(history, 1):])))
+            if len(previous) > 1 and history > 1:
+                starts.append(('previous', previous[-1]))
+            starts.append(('initial', None))
+            best = None
+            # One report per spectrum counts the evaluations of all attempts
+            report = FitReport(self._Data[ind]['scan'])
+            report.start()
+            for label, p0 in starts:
+                try:
+                    values, errors, result = model.fit(self._Data[ind]['energy'], self._Data[ind]['intensity'],
+                                                       p0=p0, report=report, **kws)
+                except ValueError as err:
+                    globalfitter_logger.warning(f"Fit of spectrum {self._Data[ind]['scan']} from the {label} "
+                                                f"parameters failed: {err}")
+                    continue
+                if result is None:
+                    best = (values, errors, None, 0.0)
+                    break
+                if best is None or result.cost < best[3]:
+                    best = (values, errors, result, result.cost)
+                diverged = not result.success or (previous_cost is not None and
+                                                  result.cost > max_cost_increase * previous_cost)
+                if not diverged:
+                    break
+                globalfitter_logger.info(f"Fit of spectrum {self._Data[ind]['scan']} from the {label} parameters "
+                                         f"diverged")
+            if best is None:
+                globalfitter_logger.warning(f"Spectrum {self._Data[ind]['scan']} could not be fitted")
+                return self._Fitters[:ind]
+            values, errors, result, previous_cost = best
+            if result is not None:
+                previous.append(result.x)
+                report.finish(cost=result.cost, success=result.success, status=result.status,
+                              message=result.message, nfev=result.nfev, njev=result.njev)
+            fitterobj.set_model_results(model, values, errors, report=report)
+            if callback is not None and callback(ind, fitterobj):
+                return self._Fitters[:ind + 1]
+        return self._Fitters
+
+    @staticmethod
+    def extrapolate(history):
+        """Predicts the next vector of parameters by the least-squares straight line through the previous ones
+        :param history: list of vectors of parameters
+        :return: ndarray
+        """
+        history = np.asarray(history, dtype=float)
+        if len(history) < 2:
+            return history[-1]
+        steps = np.arange(len(history)) - (len(history) - 1) / 2
+        slope = steps @ (history - history.mean(axis=0)) / (steps @ steps)
+        return history.mean(axis=0) + slope * (len(history) - (len(history) - 1) / 2)
+
+    def fit(self, backend='lmfit', warm_start=False, callback=None, checkpoint=None, checkpoint_interval=60.0,
+            trace=False, reuse_shapes=False, **kws):
+        """Fits all spectra simultaneously
+        :param backend: 'lmfit' to call minimize from lmfit using the objective function and the parameters or
+        'scipy' to solve the reduced vector of free parameters with scipy.optimize.least_squares directly, without
+        evaluating lmfit constraint expressions on every step
+        :param warm_start: if True, the global fit starts from the results of individual fits (see warm_start()).
+        The global refinement then scales parameters by the Jacobian (x_scale='jac') unless specified otherwise,
+        otherwise the steps from the nearly converged starting point stay small
+        :param callback: function callback(evaluation, cost) called after every evaluation of the objective
+        function. If it returns True, the fit is aborted and the fitters get the last evaluated parameters
+        without errors
+        :param checkpoint: name of the file where the best parameters found so far are saved every
+        checkpoint_interval seconds and the final parameters when the fit is finished (see from_checkpoint())
+        :param checkpoint_interval: minimal time in seconds between checkpoints
+        :param trace: if True, the FitReport (see get_report()) keeps the cost of every evaluation
+        of the objective function
+        :param reuse_shapes: if True, the line shapes of every spectrum are calculated again only when their center
+        or widths change (see CompositeModel.get_shape()). Keeps one line per peak and spectrum in memory
+        :param kws: keyword arguments passed to the solver
+        :return: list of Fitter objects with the fitted peaks and backgrounds for every spectrum
+        """
+        if backend not in ('lmfit', 'scipy'):
+            raise ValueError(f"Unknown fitting backend '{backend}'")
+        if warm_start:
+            self.warm_start()
+            kws.setdefault('x_scale', 'jac')
+        checkpointer = None
+        if checkpoint is not None:
+            checkpointer = FitCheckpoint(self, checkpoint, interval=checkpoint_interval, backend=backend)
+
+        def monitor(evaluation, cost, values):
+            if checkpointer is not None:
+                checkpointer.update(evaluation, cost, values)
+            return callback is not None and callback(evaluation, cost)
+
+        if callback is None and checkpointer is None:
+            monitor = None
+        self._Report = FitReport(f"GlobalFit of {len(self._Regions)} spectra", method=f"{backend} least_squares",
+                                 trace=trace)
+        self._Report.start()
+        self._Plan.model.reuse_shapes = reuse_shapes
+        try:
+            if backend == 'lmfit':
+                if monitor is not None:
+                    kws['iter_cb'] = lambda params, iteration, resid, *args, **kwargs: monitor(
+                        iteration, 0.5 * np.dot(resid, resid), self._LastValues)
+                result = minimize(self._Report.wrap(self.err_func), self._FitParams, method='least_squares',
+                                  jac_sparsity=self.get_jacobian_sparsity(), **kws)
+            else:
+                result = self.fit_free_params(callback=monitor, report=self._Report, **kws)
+        except Exception as err:
+            self._Report.finish(success=False, message=f"Failed: {err}")
+            if checkpointer is not None:
+                checkpointer.write()
+            raise
+        finally:
+            self._Plan.close()
+            self._Plan.model.reuse_shapes = False
+        self._Report.finish(cost=0.5 * result.chisqr, success=result.success, status=getattr(result, 'status', None),
+                            message=result.message, nfev=result.nfev, njev=getattr(result, 'njev', None))
+        self._Report.log(logging.DEBUG)
+        self._Result = result
+        if checkpointer is not None:
+            if result.aborted:
+                checkpointer.write()
+            else:
+                checkpointer.write(values=self.get_param_values(result.params), cost=0.5 * result.chisqr,
+                                   finished=True)
+        self.update_fitters(result.params)
+        return self._Fitters
+
+    def fit_multistart(self, n_starts=8, sampling='lhs', spread=0.5, processes=None, seed=None, **kws):
+        """Solves the global fit with scipy.optimize.least_squares (see fit_free_params()) from several starting
+        points and keeps the best solution, to escape the local minima of overlapping peaks. The first start
+        is the initial guess, the others are spread over the bounds of the free parameters by a Latin hypercube
+        or uniformly at random. Parameters without finite bounds on both sides are varied by spread times their
+        initial value. The starts run in a pool of processes, so the wall time grows with the number of starts
+        divided by the number of processes. The outcomes of all starts are available from get_starts().
+        :param n_starts: number of starting points including the initial guess
+        :param sampling: 'lhs' for Latin hypercube sampling or 'random' for uniform random sampling
+        :param spread: relative variation of the parameters without finite bounds
+        :param processes: number of worker processes, os.cpu_count() if None. With 1 the starts run in this process
+        :param seed: seed of the random generator
+        :param kws: keyword arguments passed to scipy.optimize.least_squares
+        :return: list of Fitter objects with the fitted peaks and backgrounds for every spectrum
+        """
+        constraints = ConstraintMap(self._FitParams, self._ParamDeps)
+        lower, upper = constraints.lower[constraints.free], constraints.upper[constraints.free]
+        x0 = np.clip(constraints.values[constraints.free], lower, upper)
+        if len(constraints.free) == 0:
+            return self.fit(backend='scipy', **kws)
+        starts = self.multistart_points(x0, lower, upper, n_starts, sampling=sampling, spread=spread, seed=seed)
+        self._Report = FitReport(f"GlobalFit of {len(self._Regions)} spectra", method=f"{n_starts} starts of "
+                                                                                      f"least_squares")
+        self._Report.start()
+        sparsity = self.get_jacobian_sparsity()
+        processes = min(processes or os.cpu_count() or 1, len(starts))
+        if processes > 1:
+            self._Plan.close()
+            with Pool(processes, initializer=_init_multistart,
+                      initargs=(self._Plan, constraints, sparsity, kws)) as pool:
+                outcomes = pool.starmap(_fit_start, enumerate(starts))
+        else:
+            _init_multistart(self._Plan, constraints, sparsity, kws)
+            try:
+                outcomes = [_fit_start(i, start) for i, start in enumerate(starts)]
+            finally:
+                _multistart.clear()
+        self._Starts = [{'start': i, 'cost': float(result.cost), 'success': bool(result.success),
+                         'nfev': int(result.nfev), 'values': constraints.expand(result.x)}
+                        for i, result, _ in outcomes]
+        converged = [outcome for outcome in outcomes if outcome[1].success] or outcomes
+        _, best, _ = min(converged, key=lambda outcome: outcome[1].cost)
+        costs = np.array([result.cost for _, result, _ in outcomes])
+        near_best = np.count_nonzero(costs <= best.cost * (1 + 1e-6) + 1e-12)
+        message = (f"Best of {len(outcomes)} starts: {near_best} reached the cost {best.cost:.6g}, "
+                   f"the costs range up to {costs.max():.6g}")
+        globalfitter_logger.info(message)
+        self._Report.evaluations = sum(evaluations for _, _, evaluations in outcomes)
+        self._Report.finish(cost=best.cost, success=best.success, status=best.status, message=message,
+                            nfev=sum(result.nfev for _, result, _ in outcomes),
+                            njev=sum(result.njev or 0 for _, result, _ in outcomes))
+        self._Report.log(logging.DEBUG)
+        covariance = CompositeModel.covariance(best, self._Plan.size)
+        result = self.make_result(constraints, constraints.expand(best.x),
+                                  constraints.propagate_covariance(best.x, covariance),
+                                  success=best.success, nfev=best.nfev, njev=best.njev, residual=best.fun,
+                                  message=message, covar=covariance, status=best.status)
+        self._Result = result
+        self.update_fitters(result.params)
+        return self._Fitters
+
+    @staticmethod
+    def multistart_points(x0, lower, upper, n_starts, sampling='lhs', spread=0.5, seed=None):
+        """Returns the starting points of fit_multistart(): the initial guess followed by n_starts - 1 points
+        sampled within the bounds
+        :param x0: initial values of the free parameters
+        :param lower: lower bounds of the free parameters
+        :param upper: upper bounds of the free parameters
+        :param n_starts: number of points
+        :param sampling: 'lhs' for Latin hypercube sampling or 'random' for uniform random sampling
+        :param spread: relative variation of the parameters without finite bounds (absolute one for zero values)
+        :param seed: seed of the random generator
+        :return: ndarray (n_starts, number of free parameters)
+        """
+        if sampling == 'lhs':
+            # Imported here, scipy.stats.qmc needs scipy 1.7 and the rest of the module does not
+            from scipy.stats import qmc
+            unit = qmc.LatinHypercube(d=len(x0), seed=seed).random(max(n_starts - 1, 0))
+        elif sampling == 'random':
+            unit = np.random.default_rng(seed).random((max(n_starts - 1, 0), len(x0)))
+        else:
+            raise ValueError(f"Unknown sampling '{sampling}'")
+        bounded = np.isfinite(lower) & np.isfinite(upper)
+        scale = spread * np.where(x0 != 0, np.absolute(x0), 1.0)
+        low = np.where(bounded, lower, x0 - scale)
+        high = np.where(bounded, upper, x0 + scale)
+        points = np.clip(low + unit * (high - low), lower, upper)
+        return np.vstack([x0, points])
+
+    def get_starts(self):
+        """Returns the outcomes of the starts of the last fit_multistart(): list of dictionaries with the number
+        of the start, the final cost, the success flag, the number of evaluations and the values of all parameters
+        ordered as the lmfit Parameters of the fit
+        """
+        return self._Starts
+
+    def fit_free_params(self, callback=None, report=None, **kws):
+        """Solves the global fit with scipy.optimize.least_squares for the vector of free parameters only.
+        Constrained parameters are calculated from it by ConstraintMap.
+        :param callback: function callback(evaluation, cost, values) returning True to abort the fit, values is
+        the vector of all parameters ordered as self._FitParams
+        :param report: FitReport counting and timing the evaluations of the residuals, if given
+        :param kws: keyword arguments passed to scipy.optimize.least_squares
+        :return: lmfit.minimizer.MinimizerResult with Parameters (values and stderr) of the fit
+        """
+        constraints = ConstraintMap(self._FitParams, self._ParamDeps)
+        lower, upper = constraints.lower[constraints.free], constraints.upper[constraints.free]
+        x0 = np.clip(constraints.values[constraints.free], lower, upper)
+        ndata = self._Plan.size
+        if len(constraints.free) == 0:
+            values = constraints.expand(x0)
+            return self.make_result(constraints, values, np.zeros_like(values), success=True, nfev=0,
+                                    residual=self._Plan.residuals(values), message="No free parameters")
+
+        evaluations = 0
 
-    def fit(self):
-        """Calls minimize from lmfit using the objective function and the parameters
+        def residuals(free_values):
+            nonlocal evaluations
+            values = constraints.expand(free_values)
+            resid = self._Plan.residuals(values)
+            if callback is not None:
+                evaluations += 1
+                if callback(evaluations, 0.5 * np.dot(resid, resid), values):
+                    raise FitAborted(free_values)
+            return resid
+
+        if report is not None:
+            residuals = report.wrap(residuals)
+        try:
+            result = least_squares(residuals, x0, bounds=(lower, upper), jac_sparsity=self.get_jacobian_sparsity(),
+                                   **kws)
+        except FitAborted as abort:
+            values = constraints.expand(abort.free_values)
+            return self.make_result(constraints, values, None, success=False, aborted=True, nfev=evaluations,
+                                    residual=self._Plan.residuals(values), message="Fit aborted")
+        covariance = CompositeModel.covariance(result, ndata)
+        return self.make_result(constraints, constraints.expand(result.x),
+                                constraints.propagate_covariance(result.x, covariance),
+                                success=result.success, nfev=result.nfev, njev=result.njev, residual=result.fun,
+                                message=result.message, covar=covariance, status=result.status)
+
+    def make_result(self, constraints, values, errors, **kws):
+        """Packs values and errors of all parameters into lmfit-compatible Parameters and MinimizerResult.
+        If errors is None, stderr of the parameters stays None
+        """
+        free = np.zeros(len(values), dtype=bool)
+        free[constraints.free] = True
+        params = Parameters()
+        for i, name in enumerate(constraints.names):
+            params.add(name, value=values[i], min=constraints.lower[i], max=constraints.upper[i], vary=bool(free[i]))
+            if errors is not None:
+                params[name].stderr = errors[i]
+        nvarys = len(constraints.free)
+        ndata = self._Plan.size
+        chisqr = float(np.sum(kws['residual'] ** 2))
+        kws.setdefault('aborted', False)
+        return MinimizerResult(params=params, method='least_squares', var_names=[constraints.names[ind]
+                                                                                  for ind in constraints.free],
+                               ndata=ndata, nvarys=nvarys, nfree=ndata - nvarys, chisqr=chisqr,
+                               redchi=chisqr / max(ndata - nvarys, 1), errorbars=nvarys > 0 and errors is not None,
+                               **kws)
+
+    def update_fitters(self, fit_params):
+        """Adds fitted peaks and backgrounds to the Fitter objects of all spectra
+        :param fit_params: lmfit Parameters with the results of the fit
         """
-        result = minimize(self.err_func, self._FitParams, method='least_squares')
         for i, fitterobj in enumerate(self._Fitters):
             for peak in self._PeaksInfo:
                 peak_pars = {}
                 peak_errs = {}
                 for key, val in peak['parameters'].items():
-                    peak_pars[key] = result.params[f"{peak['peakname']}_{key}_{i}"].value
-                    peak_errs[key] = result.params[f"{peak['peakname']}_{key}_{i}"].stderr
-                asymmetry = 'higher'
-                if not self.bindingscale:
-                    asymmetry = 'lower'
-                peak_y = Fitter.get_model_func(peak['fittype'])(fitterobj.get_data()[0], *peak_pars.values(),
-                                                                asymmetry=asymmetry)
-                peak = Peak(fitterobj.get_data()[0], peak_y, [*peak_pars.values()], [*peak_errs.values()],
-                            peak_func=Fitter.get_model_func(peak['fittype']),
-                            peak_id=peak['peakname'], peak_type=peak['fittype'],
-                            bindingscale=self.bindingscale,
-                            lmfit=True)
+                    peak_pars[key] = fit_params[f"{peak['peakname']}_{key}_{i}"].value
+                    peak_errs[key] = fit_params[f"{peak['peakname']}_{key}_{i}"].stderr
+                peak = CompactPeak(fitterobj.get_data()[0], [*peak_pars.values()], [*peak_errs.values()],
+                                   peak_id=peak['peakname'], peak_type=peak['fittype'],
+                                   bindingscale=self.bindingscale, resolution=self._Resolutions[i])
+                # Peaks of a previous fit are replaced, add_peak() keeps existing ones
+                fitterobj.delete_peak(peak.get_peak_id())
                 fitterobj.add_peak(peak)
             if len(self._BgParams) > 0:
-                fitterobj._Bg = self.get_bg_values(result.params, i)
+                fitterobj._Bg = self.get_bg_values(fit_params, i)
                 fitterobj.make_fitline(usebg=True)
             else:
                 fitterobj.make_fitline(usebg=False)
-        return self._Fitters
+            model = self.get_spectrum_model(i, fit_params)
+            fitterobj._Model = (model, model.expand(model.values[model.free]))
+
+
+class ConstraintMap:
+    """'Common', 'Dependent +' and 'Dependent *' constraints of GlobalFit parameters compiled into index arrays.
+    The vector of all parameter values is gathered from the reduced vector of free parameters level by level,
+    so that no lmfit expressions are evaluated while fitting.
+    """
+    operations = {
+        '=': lambda base, other: base,
+        '+': np.add,
+        '*': np.multiply
+    }
+
+    def __init__(self, fit_params, param_deps):
+        """
+        :param fit_params: lmfit Parameters of GlobalFit
+        :param param_deps: {parameter name: (operation, [base name, offset or factor name])} for constrained
+        parameters. Operation is '=' for 'Common', '+' and '*' for 'Dependent +' and 'Dependent *'
+        """
+        self.names = list(fit_params.keys())
+        positions = {name: i for i, name in enumerate(self.names)}
+        self.values = np.array([par.value for par in fit_params.values()], dtype=float)
+        self.lower = np.array([par.min for par in fit_params.values()], dtype=float)
+        self.upper = np.array([par.max for par in fit_params.values()], dtype=float)
+        self.free = np.array([i for i, par in enumerate(fit_params.values()) if par.vary and par.expr is None],
+                             dtype=int)
+        # Every constrained parameter goes one level above the deepest of its bases
+        depth = {}
+
+        def get_depth(name):
+            if name not in param_deps:
+                return 0
+            if name not in depth:
+                depth[name] = 1 + max(get_depth(base) for base in param_deps[name][1])
+            return depth[name]
+
+        levels = {}
+        for name, (operation, bases) in param_deps.items():
+            level = levels.setdefault(get_depth(name), {}).setdefault(operation, ([], [], []))
+            level[0].append(positions[name])
+            level[1].append(positions[bases[0]])
+            level[2].append(positions[bases[-1]])
+        # [{operation: (target indices, base indices, offset or factor indices)}, ...] from the lowest level
+        self.levels = [{operation: tuple(np.array(inds, dtype=int) for inds in links)
+                        for operation, links in levels[level].items()} for level in sorted(levels)]
+
+    def expand(self, free_values):
+        """Returns the vector of all parameter values for the given values of free parameters.
+        Constrained values are clipped to their bounds the same way as lmfit does.
+        """
+        values = self.values.copy()
+        values[self.free] = free_values
+        for level in self.levels:
+            for operation, (target, base, other) in level.items():
+                values[target] = np.clip(self.operations[operation](values[base], values[other]),
+                                         self.lower[target], self.upper[target])
+        return values
+
+    def propagate_covariance(self, free_values, covariance):
+        """Returns the errors of all parameters given the covariance matrix of the free parameters
+        """
+        values = self.expand(free_values)
+        # Derivatives of every parameter with respect to the free parameters as sparse rows {column: derivative}
+        derivatives = [{} for _ in self.names]
+        for column, ind in enumerate(self.free):
+            derivatives[ind] = {column: 1.0}
+        for level in self.levels:
+            for operation, links in level.items():
+                for target, base, other in zip(*links):
+                    if operation == '=':
+                        derivatives[target] = dict(derivatives[base])
+                        continue
+                    base_factor, other_factor = 1.0, 1.0
+                    if operation == '*':
+                        base_factor, other_factor = values[other], values[base]
+                    row = {column: base_factor * derivative for column, derivative in derivatives[base].items()}
+                    for column, derivative in derivatives[other].items():
+                        row[column] = row.get(column, 0.0) + other_factor * derivative
+                    derivatives[target] = row
+        errors = np.zeros(len(self.names))
+        for i, row in enumerate(derivatives):
+            if row:
+                columns = np.fromiter(row.keys(), dtype=int, count=len(row))
+                gradient = np.fromiter(row.values(), dtype=float, count=len(row))
+                errors[i] = np.sqrt(np.absolute(gradient @ covariance[np.ix_(columns, columns)] @ gradient))
+        return errors
+
+
+class EvaluationPlan:
+    """Parameter layout of a global fit compiled once into integer index arrays, so that the spectra are simulated
+    straight from the vector of parameter values without any dictionary lookups.
+    """
+    def __init__(self, peaks_info, bg_types, data, param_names, bindingscale=True, workers=1, resolutions=None):
+        """
+        :param peaks_info: list of peak dictionaries as passed to GlobalFit
+        :param bg_types: list of used Fitter.bg_types
+        :param data: list of dictionaries {'energy': ndarray, 'intensity': ndarray} for every spectrum
+        :param param_names: names of all parameters in the order of the values vector
+        :param bindingscale: True if the energy axis is binding energy
+        :param workers: number of threads evaluating chunks of spectra concurrently in residuals()
+        :param resolutions: InstrumentResolution or None for every spectrum
+        """
+        # The model of one spectrum with its own flat layout of line shape and background parameters
+        layout_peaks = [{'peakname': peak['peakname'], 'fittype': peak['fittype'],
+                         'parameters': {name: 0.0 for name in Peak.peak_types[peak['fittype']]}}
+                        for peak in peaks_info]
+        self.model = CompositeModel(layout_peaks, bg_types, bindingscale=bindingscale)
+        self.energies = [spectrum['energy'] for spectrum in data]
+        self.intensities = [spectrum['intensity'] for spectrum in data]
+        self.resolutions = list(resolutions) if resolutions is not None else [None] * len(data)
+        positions = {name: i for i, name in enumerate(param_names)}
+        # indices[i] picks the layout of spectrum i from the values vector
+        self.indices = np.array([[positions[f"{name}_{i}"] for name in self.model.names]
+                                 for i in range(len(data))], dtype=int).reshape(len(data), len(self.model.names))
+        self.offsets = np.concatenate(([0], np.cumsum([len(intensity) for intensity in self.intensities])))
+        self.size = int(self.offsets[-1])
+        self.workers = max(1, min(int(workers or 1), len(data)))
+        self.chunks = [chunk for chunk in np.array_split(np.arange(len(data)), self.workers) if len(chunk) > 0]
+        self._Executor = None
+
+    def simulate(self, values, spectra_ind):
+        """Returns the simulated spectrum and its background for the spectrum number spectra_ind
+        """
+        return self.model.evaluate(self.energies[spectra_ind], values[self.indices[spectra_ind]],
+                                   resolution=self.resolutions[spectra_ind])
+
+    def residuals(self, values, out=None, spectra=None):
+        """Writes residuals of the spectra (all by default) into the contiguous vector out.
+        With several workers all spectra are split into chunks which are evaluated concurrently,
+        every chunk writing into its own part of out.
+        :param values: vector of all parameter values
+        :param out: ndarray of self.size to write into. A new one is allocated if None
+        :param spectra: iterable of spectra indices to evaluate
+        :return: out
+        """
+        if out is None:
+            out = np.empty(self.size)
+        if spectra is None and self.workers > 1:
+            if self._Executor is None:
+                self._Executor = ThreadPoolExecutor(max_workers=self.workers)
+            futures = [self._Executor.submit(self.residuals, values, out, chunk) for chunk in self.chunks]
+            for future in futures:
+                future.result()
+            return out
+        if spectra is None:
+            spectra = range(len(self.energies))
+        for i in spectra:
+            line, _ = self.simulate(values, i)
+            np.subtract(self.intensities[i], line, out=out[self.offsets[i]:self.offsets[i + 1]])
+        return out
+
+    def __getstate__(self):
+        # Worker threads are not pickled, e.g. when the plan is sent to the processes of GlobalFit.fit_multistart()
+        state = self.__dict__.copy()
+        state['_Executor'] = None
+        return state
+
+    def close(self):
+        """Stops the worker threads and releases the line shapes kept by the model. The threads are started again
+        by the next call of residuals() if needed
+        """
+        self.model.clear_shapes()
+        if self._Executor is not None:
+            self._Executor.shutdown()
+            self._Executor = None
+
+
+class FitCheckpoint:
+    """Keeps the best parameters found during a fit and periodically saves them with GlobalFit.save_checkpoint()
+    """
+    def __init__(self, global_fit, filename, interval=60.0, backend='lmfit'):
+        """
+        :param global_fit: GlobalFit instance
+        :param filename: name of the checkpoint file
+        :param interval: minimal time in seconds between writes
+        :param backend: fitting backend, saved with the solver state
+        """
+        self.global_fit = global_fit
+        self.filename = filename
+        self.interval = interval
+        self.backend = backend
+        self.best_cost = np.inf
+        self.best_values = None
+        self.evaluations = 0
+        self._Start = time.perf_counter()
+        self._LastWrite = self._Start
+
+    def update(self, evaluation, cost, values):
+        """Registers one evaluation of the objective function and writes the checkpoint if it is time to
+        """
+        self.evaluations = evaluation
+        if cost < self.best_cost:
+            self.best_cost = cost
+            self.best_values = np.array(values, dtype=float)
+        if time.perf_counter() - self._LastWrite >= self.interval:
+            self.write()
+
+    def write(self, values=None, cost=None, finished=False):
+        """Saves the given or the best values found so far
+        """
+        if values is None:
+            values, cost = self.best_values, self.best_cost
+        state = {'backend': self.backend, 'evaluations': self.evaluations,
+                 'cost': None if cost is None or not np.isfinite(cost) else float(cost),
+                 'elapsed': time.perf_counter() - self._Start, 'finished': finished}
+        try:
+            self.global_fit.save_checkpoint(self.filename, values, state=state)
+        except OSError as err:
+            globalfitter_logger.warning(f"Couldn't write the checkpoint {self.filename}: {err}")
+        self._LastWrite = time.perf_counter()
+
+
+class FitRunner:
+    """Runs GlobalFit.fit (or GlobalFit.fit_sequential) in a worker thread so that the calling (GUI) thread
+    stays responsive. Messages are put into the thread-safe queue self.messages:
+    ('progress', evaluation, cost, elapsed seconds) at most every progress_interval seconds,
+    ('spectrum', spectra_ind, {peak_id: (area, center)}, elapsed seconds) for every spectrum of a sequential fit,
+    ('done', list of Fitter objects, True if the fit was cancelled) and ('error', exception).
+    """
+    def __init__(self, global_fit, progress_interval=0.2, cache=None):
+        """
+        :param global_fit: GlobalFit instance
+        :param progress_interval: minimal time in seconds between progress messages
+        :param cache: FitCache to take the results of the same fit from and to store the finished fits in
+        """
+        self.global_fit = global_fit
+        self.progress_interval = progress_interval
+        self.cache = cache
+        self.messages = queue.Queue()
+        self._Cancel = threading.Event()
+        self._Thread = None
+
+    def start(self, sequential=False, **kws):
+        """Starts the fit
+        :param sequential: if True, the spectra are fitted one by one with GlobalFit.fit_sequential
+        :param kws: keyword arguments passed to GlobalFit.fit or GlobalFit.fit_sequential
+        """
+        if self.is_running():
+            globalfitter_logger.warning("The fit is already running")
+            return
+        self._Cancel.clear()
+        kws['sequential'] = sequential
+        self._Thread = threading.Thread(target=self._run, kwargs=kws, daemon=True)
+        self._Thread.start()
+
+    def cancel(self):
+        """Asks the running fit to stop. The fitters then get the last evaluated parameters
+        """
+        self._Cancel.set()
+
+    def is_running(self):
+        return self._Thread is not None and self._Thread.is_alive()
+
+    def _run(self, sequential=False, **kws):
+        start = time.perf_counter()
+        last_report = -np.inf
+
+        def callback(evaluation, cost):
+            nonlocal last_report
+            elapsed = time.perf_counter() - start
+            if elapsed - last_report >= self.progress_interval:
+                last_report = elapsed
+                self.messages.put(('progress', evaluation, cost, elapsed))
+            return self._Cancel.is_set()
+
+        def spectrum_callback(spectra_ind, fitterobj):
+            trends = {peak.get_peak_id(): (peak.get_peak_area(), peak.get_parameters('center'))
+                      for peak in (fitterobj.get_peaks() or [])}
+            self.messages.put(('spectrum', spectra_ind, trends, time.perf_counter() - start))
+            return self._Cancel.is_set()
+
+        key = None
+        if self.cache is not None:
+            key = self.global_fit.get_cache_key(sequential, kws)
+            fitters = self.cache.get_fitters(key, list(self.global_fit._Regions))
+            if fitters is not None:
+                self.global_fit._Fitters = fitters
+                self.messages.put(('done', fitters, False))
+                return
+        try:
+            if sequential:
+                fitters = self.global_fit.fit_sequential(callback=spectrum_callback, **kws)
+            else:
+                fitters = self.global_fit.fit(callback=callback, **kws)
+        except Exception as err:
+            globalfitter_logger.error("Global fit failed", exc_info=True)
+            self.messages.put(('error', err))
+        else:
+            if key is not None and not self._Cancel.is_set():
+                self.cache.put_fitters(key, fitters)
+            self.messages.put(('done', fitters, self._Cancel.is_set()))
@@ -5,6 +5,7 @@ import re
 import datetime
 import ntpath
 import logging
+import queue
 import webbrowser
 
 import pandas as pd
@@ -28,7 +29,8 @@ from specqp import datahandler
 from specqp import plotter
 from specqp import helpers
 from specqp import fitter
-from specqp.globalfitter import GlobalFit
+from specqp.fitcache import fit_cache
+from specqp.globalfitter import GlobalFit, FitRunner
 
 # Default font for the GUI
 LARGE_FONT = ("Verdana", "12")
@@ -1769,16 +1771,25 @@ class FitWindow(tk.Toplevel):
             gui_logger.warning("Please fill in initial values for all parameters. Bounds can stay empty.")
             self._display_message("Please fill in initial values for all parameters. Bounds can stay empty.")
             return False
-        # Fitting
-        self.fitter_obj = fitter.Fitter(self.region)
-        if self.fittype == 'Gauss':  # Gauss
-            self.fitter_obj.fit_gaussian(initial_guess, fix_parameters, boundaries=parameter_bounds)
-        if self.fittype == 'Lorentz':  # Lorentz
-            self.fitter_obj.fit_lorentzian(initial_guess, fix_parameters, boundaries=parameter_bounds)
-        if self.fittype == 'Pseudo Voigt':  # Pseudo Voigt
-            self.fitter_obj.fit_pseudo_voigt(initial_guess, fix_parameters, boundaries=parameter_bounds)
-        if self.fittype == 'Doniach-Sunjic':  # Doniach-Sunjik
-            self.fitter_obj.fit_doniach_sunjic(initial_guess, fix_parameters, boundaries=parameter_bounds)
+        # Fitting, unless the same fit of the same data is in the cache
+        cache_key = fit_cache.make_key(self.region, 'final', 'FitWindow', self.fittype, initial_guess, fix_parameters,
+                                       parameter_bounds)
+        cached = fit_cache.get_fitters(cache_key, self.region)
+        if cached is not None:
+            self.fitter_obj = cached[0]
+        else:
+            self.fitter_obj = fitter.Fitter(self.region)
+            if self.fittype == 'Gauss':  # Gauss
+                self.fitter_obj.fit_gaussian(initial_guess, fix_parameters, boundaries=parameter_bounds)
+            if self.fittype == 'Lorentz':  # Lorentz
+                self.fitter_obj.fit_lorentzian(initial_guess, fix_parameters, boundaries=parameter_bounds)
+            if self.fittype == 'Pseudo Voigt':  # Pseudo Voigt
+                self.fitter_obj.fit_pseudo_voigt(initial_guess, fix_parameters, boundaries=parameter_bounds)
+            if self.fittype == 'Doniach-Sunjic':  # Doniach-Sunjik
+                self.fitter_obj.fit_doniach_sunjic(initial_guess, fix_parameters, boundaries=parameter_bounds)
+            if self.fittype == 'Voigt':  # Voigt
+                self.fitter_obj.fit_voigt(initial_guess, fix_parameters, boundaries=parameter_bounds)
+            fit_cache.put_fitters(cache_key, [self.fitter_obj])
         if self.spectrum_color.get() != "Default color":
             region_color = self.spectrum_color.get()
         else:
@@ -2216,6 +2227,8 @@ class AdvancedFitWindow(tk.Toplevel):
         self.fitter_objs = None
         self.fittype = fittype
         self.results_txt = None
+        self.fit_runner = None
+        self.fit_poll_job = None
 
         toppanel = ttk.Frame(self, borderwidth=1, relief="groove")
         # Right panel for plotting
@@ -2230,8 +2243,8 @@ class AdvancedFitWindow(tk.Toplevel):
                                      font_size=int(service.get_service_parameter("FONT_SIZE")))
         # Left panel for fitting settings
         self.fit_settings_panel = ttk.Frame(toppanel, borderwidth=1, relief="groove")
-        fit_button = ttk.Button(self.fit_settings_panel, text='Do Fit', command=self._do_fit)
-        fit_button.pack(side=tk.TOP, fill=tk.X, padx=4, pady=4)
+        self.fit_button = ttk.Button(self.fit_settings_panel, text='Do Fit', command=self._do_fit)
+        self.fit_button.pack(side=tk.TOP, fill=tk.X, padx=4, pady=4)
         self.settings = ttk.Frame(self.fit_settings_panel, borderwidth=1, relief="groove")
         # Choose spectrum color
         spectrum_color_frame = ttk.Frame(self.settings)
@@ -2276,6 +2289,16 @@ class AdvancedFitWindow(tk.Toplevel):
                                                onvalue="True", offvalue="", background=BG,
                                                anchor=tk.W, relief=tk.FLAT, highlightthickness=0)
         self.same_scale_box.pack(side=tk.LEFT, anchor=tk.W)
+        # Fit the spectra one by one starting from the previous results instead of the global fit
+        sequential_frame = ttk.Frame(self.settings)
+        sequential_label = ttk.Label(sequential_frame, text="Sequential fit", anchor=tk.W)
+        sequential_label.pack(side=tk.LEFT, expand=False)
+        self.sequential_var = tk.StringVar(value="")
+        self.sequential_box = tk.Checkbutton(sequential_frame, var=self.sequential_var,
+                                             onvalue="True", offvalue="", background=BG,
+                                             anchor=tk.W, relief=tk.FLAT, highlightthickness=0)
+        self.sequential_box.pack(side=tk.LEFT, anchor=tk.W)
+        sequential_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=False)
         self.settings.pack(side=tk.TOP, fill=tk.X, expand=False)
         # Choose background settings
         self.bg_panel = ttk.Frame(self.fit_settings_panel, borderwidth=1, relief="groove")
@@ -2349,10 +2372,11 @@ class AdvancedFitWindow(tk.Toplevel):
         :param peak2: new peak
         :return: None
         """
-        if (peak2.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic') and peak1.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic')) or \
+        if (peak2.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic', 'Voigt') and
+                peak1.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic', 'Voigt')) or \
                 (peak2.fit_type in ('Gauss', 'Lorentz') and peak1.fit_type in ('Gauss', 'Lorentz')):
             peak2.set_all_parameters(*peak1.get_all_parameters(string_output=True))
-        elif peak2.fit_type in ('Gauss', 'Lorentz') and peak1.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic'):
+        elif peak2.fit_type in ('Gauss', 'Lorentz') and peak1.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic', 'Voigt'):
             for par_name in ('amplitude', 'center', 'g_fwhm', 'l_fwhm'):
                 if peak2.fit_type == 'Gauss' and par_name == 'g_fwhm':
                     peak2.set_parameter('fwhm',*peak1.get_parameter(par_name, string_output=True))
@@ -2360,7 +2384,7 @@ class AdvancedFitWindow(tk.Toplevel):
                     peak2.set_parameter('fwhm', *peak1.get_parameter(par_name, string_output=True))
                 if par_name in ('amplitude', 'center'):
                     peak2.set_parameter(par_name, *peak1.get_parameter(par_name, string_output=True))
-        elif peak2.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic') and peak1.fit_type in ('Gauss', 'Lorentz'):
+        elif peak2.fit_type in ('Pseudo Voigt', 'Doniach-Sunjic', 'Voigt') and peak1.fit_type in ('Gauss', 'Lorentz'):
             for par_name in ('amplitude', 'center', 'fwhm'):
                 if peak1.fit_type == 'Gauss' and par_name == 'fwhm':
                     peak2.set_parameter('g_fwhm', *peak1.get_parameter(par_name, string_output=True))
@@ -2410,14 +2434,63 @@ class AdvancedFitWindow(tk.Toplevel):
             peaks_info.append(peak_info)
 
         fit = GlobalFit(self.regions, peaks_info, bg_params)
-        self.fitter_objs = fit.fit()
+        self.fit_runner = FitRunner(fit, cache=fit_cache)
+        self.fit_runner.start(sequential=bool(self.sequential_var.get()))
+        self.fit_button.configure(text='Cancel Fit', command=self._cancel_fit)
+        self._display_message("Fitting...")
+        self.fit_poll_job = self.after(100, self._poll_fit)
+
+    def _cancel_fit(self):
+        if self.fit_runner is not None:
+            self.fit_runner.cancel()
+            self._display_message("Cancelling the fit...")
+
+    def destroy(self):
+        # Stopping the running fit together with the window
+        if self.fit_poll_job is not None:
+            self.after_cancel(self.fit_poll_job)
+        if self.fit_runner is not None:
+            self.fit_runner.cancel()
+        super().destroy()
+
+    def _poll_fit(self):
+        """Checks the messages from the running fit every 100 ms and shows the results when it is finished
+        """
+        while True:
+            try:
+                message = self.fit_runner.messages.get_nowait()
+            except queue.Empty:
+                self.fit_poll_job = self.after(100, self._poll_fit)
+                return
+            if message[0] == 'progress':
+                _, evaluation, cost, elapsed = message
+                self._display_message(f"Fitting... Evaluation {evaluation}, cost {cost:.6g}, {elapsed:.1f} s")
+            elif message[0] == 'spectrum':
+                _, spectra_ind, trends, elapsed = message
+                trends_txt = ", ".join(f"{peak_id}: area {area:.4g}, center {center:.4g}"
+                                       for peak_id, (area, center) in trends.items())
+                self._display_message(f"Fitted spectrum {spectra_ind + 1} of {len(self.regions)} "
+                                      f"({elapsed:.1f} s). {trends_txt}")
+            else:
+                break
+        self.fit_button.configure(text='Do Fit', command=self._do_fit)
+        self.fit_runner = None
+        self.fit_poll_job = None
+        if message[0] == 'error':
+            self._display_message(f"Fit failed: {message[1]}")
+            return
+        _, self.fitter_objs, cancelled = message
         self.currently_plotted = 0
         self._plot(self.currently_plotted)
+        self._show_fit_results(cancelled)
 
+    def _show_fit_results(self, cancelled=False):
         # Showing results
         round_precision = int(service.get_service_parameter('ROUND_PRECISION'))
         self.results_txt = ""
-        for region_num in range(len(self.regions)):
+        if cancelled:
+            self.results_txt += "The fit was cancelled. Parameters of the last iteration are shown.\n\n"
+        for region_num in range(len(self.fitter_objs)):
             self.results_txt += f"Region #{region_num} ({self.fitter_objs[region_num].get_id()}):\n" \
                                 f"--------------------------------------------------\n\n"
             self.results_txt += f"Goodness:\n" \
@@ -2426,8 +2499,9 @@ class AdvancedFitWindow(tk.Toplevel):
             self.results_txt += f"Background parameters:\n"
             if self.fitter_objs[region_num].get_bg() is not None:
                 for bg_key, bg_val in self.fitter_objs[region_num].get_bg().items():
+                    bg_error = 'NaN' if bg_val[1] is None else round(bg_val[1], round_precision)
                     self.results_txt += f"{bg_key}: {round(bg_val[0], round_precision)} +/- " \
-                                        f"{round(bg_val[1], round_precision)}\n"
+                                        f"{bg_error}\n"
                 self.results_txt += "\n"
             else:
                 self.results_txt += f"None:\n\n"
@@ -2494,7 +2568,7 @@ class AdvancedFitWindow(tk.Toplevel):
             num = self.currently_plotted
         elif num is None and self.currently_plotted is None:
             num = 0
-        assert num < len(self.regions)
+        assert num < len(self.fitter_objs)
         ymax = None
         if self.same_scale_var.get():
             ymax = 1.1 * self._get_all_max()
@@ -2654,7 +2728,7 @@ class AdvancedFitWindow(tk.Toplevel):
             return
         if self.currently_plotted is None:
             return
-        if self.currently_plotted == len(self.regions) - 1:
+        if self.currently_plotted == len(self.fitter_objs) - 1:
             return
         else:
             self.currently_plotted += 1
@@ -2766,7 +2840,7 @@ class AdvancedFitWindow(tk.Toplevel):
                         metadata = dict(title=self.regions[0].get_id(), artist='SpecQP')
                         writer = FFMpegWriter(fps=15, metadata=metadata)
                         with writer.saving(self.plot_panel.figure, movie_file_path, 1000):
-                            for region_num in range(len(self.regions)):
+                            for region_num in range(len(self.fitter_objs)):
                                 self._plot(region_num)
                                 writer.grab_frame()
                         return True
@@ -2804,7 +2878,7 @@ class AdvancedFitWindow(tk.Toplevel):
         else:
             save_dir_path = filedialog.askdirectory(initialdir=output_dir, title='Please select a directory')
             if save_dir_path:
-                for region_num in range(len(self.regions)):
+                for region_num in range(len(self.fitter_objs)):
                     self._plot(region_num)
                     self.plot_panel.figure.savefig(save_dir_path + f'/{region_num}.png')
 
@@ -2,13 +2,19 @@
 """
 import os
 import logging
-import scipy as sp
+from functools import lru_cache
 import numpy as np
+from scipy import fft, special
 from scipy.optimize import curve_fit
 
 
 helpers_logger = logging.getLogger("specqp.helpers")  # Creating child logger
 
+# Boltzmann constant, eV/K
+BOLTZMANN = 8.617333262e-5
+# Names of the parameters of fermi_edge() in the order of fit_fermi_edge() initial parameters
+fermi_edge_params = ('amplitude', 'edge', 'gauss_fwhm', 'background', 'temperature', 'slope')
+
 
 def is_iterable(obj):
     try:
@@ -18,39 +24,116 @@ def is_iterable(obj):
         return False
 
 
-def fit_fermi_edge(region, initial_params, column="final", add_column=True, overwrite=True):
+@lru_cache(maxsize=64)
+def _fermi_edge_grid(lowest, step, npoints, pad):
+    """Uniform grid of fermi_edge() and the squared frequencies of its FFT scaled so that the transform of
+    a Gaussian of FWHM w is exp(-w**2 * factor). Energy axes of the same range and step share the grid,
+    e.g. Fermi scans of a batch calibration.
+    :return: (ndarray, ndarray) read-only grid and factor
+    """
+    size = fft.next_fast_len(npoints + 2 * pad, real=True)
+    grid = lowest - pad * step + step * np.arange(size)
+    factor = (np.pi * fft.rfftfreq(size, step)) ** 2 / (4 * np.log(2))
+    grid.flags.writeable = False
+    factor.flags.writeable = False
+    return grid, factor
+
+
+def fermi_edge(x, amplitude, edge, gauss_fwhm, background, temperature, slope=0.0, binding=True, oversample=2):
+    """Fermi-Dirac distribution times a linear density of states convolved with a Gaussian instrument function:
+    [(amplitude + slope * (x - edge)) * FD(x)] * G(gauss_fwhm) + background.
+    The product is calculated on a uniform grid oversampled and padded by three FWHM of the Gaussian, convolved by
+    FFT and interpolated to x. The grids and frequencies are cached for every energy range and step (see
+    _fermi_edge_grid()), the padding is rounded up to a power of two points so that the grid stays the same while
+    gauss_fwhm changes within a fit.
+    :param x: energy axis
+    :param amplitude: density of states at the Fermi level
+    :param edge: Fermi level
+    :param gauss_fwhm: FWHM of the Gaussian instrument function
+    :param background: constant background
+    :param temperature: temperature in K
+    :param slope: slope of the density of states
+    :param binding: True if x is binding energy (the occupied states are at x > edge), False for kinetic energy
+    :param oversample: number of grid points per step of x
+    :return: ndarray
+    """
+    x = np.asarray(x, dtype=float)
+    steps = np.absolute(np.diff(x))
+    steps = steps[steps > 0]
+    step = (steps.min() if len(steps) else abs(gauss_fwhm) + BOLTZMANN * temperature) / oversample
+    lowest, highest = np.amin(x), np.amax(x)
+    pad = 1 << int(np.ceil(np.log2(max(3 * abs(gauss_fwhm) / step, 1))))
+    grid, factor = _fermi_edge_grid(lowest, step, int(np.ceil((highest - lowest) / step)) + 2, pad)
+    occupation = special.expit((grid - edge) / max(BOLTZMANN * temperature, 1e-12) * (1 if binding else -1))
+    line = fft.irfft(fft.rfft((amplitude + slope * (grid - edge)) * occupation) *
+                        np.exp(-gauss_fwhm ** 2 * factor), n=len(grid))
+    return np.interp(x, grid, line) + background
+
+
+def fit_fermi_edge(region, initial_params, column="final", add_column=True, overwrite=True, model='erfc',
+                   fix_pars=None):
     """Fits error function to fermi level scan. If add_column flag
     is True, adds the fitting results as a column to the Region object.
     NOTE: Overwrites the 'fitFermi' column if already present.
     Returns a list [shift, fittingError]
+    :param model: 'erfc' for the complementary error function with initial_params [a0, a1, a2, a3] (see error_func)
+    or 'fermi' for the Fermi-Dirac distribution times a linear density of states convolved with a Gaussian
+    (see fermi_edge()) with initial_params [amplitude, edge, gauss_fwhm, background, temperature, slope].
+    Temperature (K) and slope are optional and start from 300 and 0
+    :param fix_pars: names of fermi_edge_params kept at their initial values, e.g. ['gauss_fwhm'] when the
+    resolution is known or ['temperature'] when the sample temperature is. Errors of fixed parameters are 0
     """
 
     # f(x) = s/(exp(-1*(x-m)/(8.617*(10^-5)*t)) + 1) + a*x + b
     def error_func(x, a0, a1, a2, a3):
         """Defines a complementary error function of the form
-        (a0/2)*sp.special.erfc((a1-x)/a2) + a3
+        (a0/2)*special.erfc((a1-x)/a2) + a3
         """
-        return (a0 / 2) * sp.special.erfc((a1 - x) / a2) + a3
+        return (a0 / 2) * special.erfc((a1 - x) / a2) + a3
 
     if not region.get_flags()["fermi_flag"]:
         helpers_logger.warning(f"Can't fit the error func to non-Fermi region {region.get_id()}")
         return
 
-    # Parameters and parameters covariance of the fit
-    popt, pcov = curve_fit(error_func,
-                           region.get_data(column='energy'),
-                           region.get_data(column=column),
-                           p0=initial_params)
+    if model == 'erfc':
+        # Parameters and parameters covariance of the fit
+        popt, pcov = curve_fit(error_func,
+                               region.get_data(column='energy'),
+                               region.get_data(column=column),
+                               p0=initial_params)
+        fit_func = error_func
+        errors = np.sqrt(np.diag(pcov))
+    elif model == 'fermi':
+        binding = bool(region.is_binding())
+        if not 4 <= len(initial_params) <= len(fermi_edge_params):
+            raise ValueError(f"Fermi edge model takes 4 to {len(fermi_edge_params)} initial parameters "
+                             f"{fermi_edge_params}, got {len(initial_params)}")
+        initial_params = list(initial_params) + [300.0, 0.0][len(initial_params) - 4:]
+        fixed = [fermi_edge_params.index(name) for name in (fix_pars or [])]
+        free = [i for i in range(len(fermi_edge_params)) if i not in fixed]
+        popt = np.array(initial_params, dtype=float)
+
+        def fit_func(x, *values):
+            return fermi_edge(x, *values, binding=binding)
+
+        def free_func(x, *args):
+            values = popt.copy()
+            values[free] = args
+            return fit_func(x, *values)
+
+        lower = [-np.inf, -np.inf, 0, -np.inf, 0, -np.inf]
+        free_popt, pcov = curve_fit(free_func, region.get_data(column='energy'), region.get_data(column=column),
+                                    p0=popt[free], bounds=([lower[i] for i in free], [np.inf] * len(free)))
+        popt[free] = free_popt
+        errors = np.zeros_like(popt)
+        errors[free] = np.sqrt(np.diag(pcov))
+    else:
+        raise ValueError(f"Unknown Fermi edge model '{model}'")
 
     if add_column:
-        region.add_column("fitFermi", error_func(region.get_data(column='energy'),
-                                                popt[0],
-                                                popt[1],
-                                                popt[2],
-                                                popt[3]),
-                          overwrite=overwrite)
+        region.add_column("fitFermi", fit_func(region.get_data(column='energy'), *popt), overwrite=overwrite)
     # Return parameters and their uncertainties
-    return [popt, np.sqrt(np.diag(pcov))]
+    return [popt, errors]
 
 
 def subtract_linear_bg(region, y_data='final', manual_bg=None, by_min=False, add_column=True, overwrite=True):
@@ -146,42 +229,47 @@ def subtract_linear_bg(region, y_data='final', manual_bg=None, by_min=False, add
     return background
 
 
-def subtract_shirley(region, y_data='final', tolerance=1e-5, maxiter=50, add_column=True, overwrite=True):
-    """Calculates shirley background. Adopted from https://github.com/schachmett/xpl
+def get_shirley_bg(energy, counts, tolerance=1e-5, maxiter=50):
+    """Calculates iterative Shirley background of a spectrum. Adopted from https://github.com/schachmett/xpl
     Author Simon Fischer <sfischer@ifp.uni-bremen.de>"
+    :return: ndarray or None if the iterations didn't converge
     """
-    def get_shirley_bg(energy, counts, tolerance=1e-5, maxiter=50):
-        if energy[0] < energy[-1]:
-            is_reversed = True
-            energy = energy[::-1]
-            counts = counts[::-1]
-        else:
-            is_reversed = False
-        background = np.ones(energy.shape) * counts[-1]
-        integral = np.zeros(energy.shape)
-        spacing = (energy[-1] - energy[0]) / (len(energy) - 1)
+    if energy[0] < energy[-1]:
+        is_reversed = True
+        energy = energy[::-1]
+        counts = counts[::-1]
+    else:
+        is_reversed = False
+    background = np.ones(energy.shape) * counts[-1]
+    integral = np.zeros(energy.shape)
+    spacing = (energy[-1] - energy[0]) / (len(energy) - 1)
+    subtracted = counts - background
+    ysum = subtracted.sum() - np.cumsum(subtracted)
+    for i in range(len(energy)):
+        integral[i] = spacing * (ysum[i] - 0.5 * (subtracted[i] + subtracted[-1]))
+    iteration = 0
+    while iteration < maxiter:
         subtracted = counts - background
-        ysum = subtracted.sum() - np.cumsum(subtracted)
-        for i in range(len(energy)):
-            integral[i] = spacing * (ysum[i] - 0.5 * (subtracted[i] + subtracted[-1]))
-        iteration = 0
-        while iteration < maxiter:
-            subtracted = counts - background
-            integral = spacing * (subtracted.sum() - np.cumsum(subtracted))
-            bnew = ((counts[0] - counts[-1]) * integral / integral[0] + counts[-1])
-            if np.linalg.norm((bnew - background) / counts[0]) < tolerance:
-                background = bnew.copy()
-                break
-            else:
-                background = bnew.copy()
-            iteration += 1
-        if iteration >= maxiter:
-            return None
-        output = background
-        if is_reversed:
-            output = background[::-1]
-        return output
+        integral = spacing * (subtracted.sum() - np.cumsum(subtracted))
+        bnew = ((counts[0] - counts[-1]) * integral / integral[0] + counts[-1])
+        if np.linalg.norm((bnew - background) / counts[0]) < tolerance:
+            background = bnew.copy()
+            break
+        else:
+            background = bnew.copy()
+        iteration += 1
+    if iteration >= maxiter:
+        return None
+    output = background
+    if is_reversed:
+        output = background[::-1]
+    return output
+
 
+def subtract_shirley(region, y_data='final', tolerance=1e-5, maxiter=50, add_column=True, overwrite=True):
+    """Calculates shirley background. Adopted from https://github.com/schachmett/xpl
+    Author Simon Fischer <sfischer@ifp.uni-bremen.de>"
+    """
     energy = region.get_data(column="energy")
     counts = region.get_data(column=y_data)
     bg = get_shirley_bg(energy, counts, tolerance, maxiter)
@@ -0,0 +1,547 @@
+import copy
+import gc
+import json
+import os
+import tempfile
+import unittest
+import weakref
+import specqp as sp
+import numpy as np
+import pandas as pd
+from scipy import special
+from specqp.globalfitter import GlobalFit, FitRunner
+from specqp.fitcache import FitCache
+from specqp.batchfitter import BatchFit, bootstrap, fit_regions
+from specqp.fitter import CompositeModel, InstrumentResolution
+
+
+def make_region(energy, counts, binding=True, region_id="Synthetic"):
+    info = {sp.Region.info_entries[0]: region_id,
+            sp.Region.info_entries[1]: "20",
+            sp.Region.info_entries[2]: "1",
+            sp.Region.info_entries[3]: "1000",
+            sp.Region.info_entries[4]: "Binding" if binding else "Kinetic",
+            sp.Region.info_entries[5]: str(abs(energy[1] - energy[0])),
+            sp.Region.info_entries[6]: "0.1",
+            sp.Region.info_entries[7]: "synthetic",
+            sp.Region.info_entries[8]: ""}
+    return sp.Region(energy, counts, info=info, conditions={"Comments": ""}, id_=region_id)
+
+
+def par(value, min_=None, max_=None, fix=False, dependencetype='Independent', dependencebase=None):
+    return {'value': value, 'min': min_, 'max': max_, 'fix': fix,
+            'dependencetype': dependencetype, 'dependencebase': dependencebase}
+
+
+class TestFitter(unittest.TestCase):
+    def setUp(self):
+        self.energy = np.linspace(290, 280, 201)
+        peaks_line = (sp.Fitter.doniach_sunjic(self.energy, 100, 284.5, 0.6, 0.1) +
+                      sp.Fitter.gauss(self.energy, 40, 286.3, 1.2))
+        noise = np.random.default_rng(0).normal(0, 0.5, self.energy.size)
+        self.counts = peaks_line + sp.Fitter.shirley(self.energy, peaks_line, 0.05) + 5 + noise
+        self.peaks = [
+            {'peakname': 'Peak0', 'fittype': 'Doniach-Sunjic',
+             'parameters': {'amplitude': par(80, 0, 1000), 'center': par(284.4, 283, 286),
+                            'g_fwhm': par(0.5, 0.1, 2), 'l_fwhm': par(0.2, 0, 0.5)}},
+            {'peakname': 'Peak1', 'fittype': 'Gauss',
+             'parameters': {'amplitude': par(30, 0), 'center': par(1.7, 1, 3, dependencetype='Dependent +',
+                                                                   dependencebase=0),
+                            'fwhm': par(1.0, 0.1, 3)}}
+        ]
+        self.bg = {'shirley': par(0.01), 'constant': par(4)}
+
+    def test_mixed_fit(self):
+        fitter = sp.Fitter(make_region(self.energy, self.counts))
+        self.assertTrue(fitter.fit(self.peaks, self.bg))
+        ds, gauss = fitter.get_peaks()
+        self.assertEqual(ds.get_peak_type(), 'Doniach-Sunjic')
+        self.assertAlmostEqual(ds.get_parameters('center'), 284.5, places=2)
+        self.assertAlmostEqual(gauss.get_parameters('center'), 286.3, places=1)
+        self.assertAlmostEqual(gauss.get_parameters('amplitude'), 40, delta=2)
+        self.assertAlmostEqual(fitter.get_bg()['shirley'][0], 0.05, places=2)
+        np.testing.assert_allclose(fitter.get_fit_line(), self.counts, atol=2.5)
+        report = fitter.get_report()
+        self.assertTrue(report.success)
+        self.assertAlmostEqual(report.cost, 0.5 * np.sum(fitter.get_residuals() ** 2), places=6)
+        self.assertGreaterEqual(report.evaluations, report.nfev)
+        self.assertLessEqual(report.model_time, report.wall_time)
+        # The legacy methods fit with bounds through curve_fit
+        fitter = sp.Fitter(make_region(self.energy, self.counts))
+        fitter.fit_gaussian([40, 286.3, 1.2], fix_pars={"amplitude": [0]})
+        report = fitter.get_report()
+        self.assertTrue(report.success)
+        self.assertEqual(report.nfev, report.evaluations)
+        self.assertAlmostEqual(report.cost, 0.5 * np.sum(fitter.get_residuals() ** 2), places=6)
+
+    def test_reuse_shapes(self):
+        fitter = sp.Fitter(make_region(self.energy, self.counts))
+        fitter.fit(self.peaks, self.bg)
+        reference = [peak.get_parameters() for peak in fitter.get_peaks()]
+        self.assertTrue(fitter.fit(self.peaks, self.bg, reuse_shapes=True))
+        for peak, parameters in zip(fitter.get_peaks(), reference):
+            np.testing.assert_allclose(peak.get_parameters(), parameters, rtol=1e-6)
+        model = CompositeModel(self.peaks, reuse_shapes=True)
+        values = model.expand(model.values[model.free])
+        line = model.evaluate(self.energy, values)[0]
+        shape = model.get_shape(0, 'Doniach-Sunjic', self.energy, values[1:4], 'higher')
+        values[0] *= 2
+        np.testing.assert_allclose(model.evaluate(self.energy, values)[0] - line, values[0] / 2 * shape)
+        self.assertIs(model.get_shape(0, 'Doniach-Sunjic', self.energy, values[1:4], 'higher'), shape)
+
+    def test_support_windows(self):
+        energy = np.linspace(300, 280, 801)
+        centers = np.arange(282, 299, 2.5)
+        counts = sum(sp.Fitter.pseudo_voigt(energy, 50 + 5 * i, center, 0.7, 0.2) for i, center in enumerate(centers))
+        counts += sp.Fitter.shirley(energy, counts, 0.005) + 3
+        peaks = [{'peakname': f"Peak{i}", 'fittype': 'Pseudo Voigt',
+                  'parameters': {'amplitude': {'value': 40, 'min': 0, 'max': 200},
+                                 'center': {'value': center + 0.1, 'min': center - 0.5, 'max': center + 0.5},
+                                 'g_fwhm': {'value': 0.8, 'min': 0.2, 'max': 2}, 'l_fwhm': 0.2}}
+                 for i, center in enumerate(centers)]
+        bg = {'shirley': {'value': 0.0, 'min': 0, 'max': 1}, 'constant': {'value': 2.0}}
+        model = CompositeModel(peaks, bg)
+        free_values = model.values[model.free]
+        windows = model.get_support(energy, free_values, 5)
+        self.assertTrue(all(abs(energy[window.start] - energy[window.stop - 1]) < 12 for window in windows))
+        full = model.jacobian(free_values, energy, counts)
+        model._Windows = (energy, model.get_support(energy, free_values, 1000))
+        np.testing.assert_allclose(model.jacobian(free_values, energy, counts), full)
+        fitter = sp.Fitter(make_region(energy, counts))
+        self.assertTrue(fitter.fit(peaks, bg, support=20))
+        for peak, center in zip(fitter.get_peaks(), centers):
+            self.assertAlmostEqual(peak.get_parameters('center'), center, places=3)
+        self.assertEqual(fitter.get_report().evaluations, fitter.get_report().nfev)
+        # Windows set at a quarter of the true widths grow with the peaks, the reported line is the minimised one
+        counts = sp.Fitter.voigt(energy, 100, 284.5, 1.2, 0.1) + sp.Fitter.voigt(energy, 50, 286.5, 1.2, 0.1) + 5
+        fitter = sp.Fitter(make_region(energy, counts))
+        peaks = [{'peakname': f'Peak{i}', 'fittype': 'Voigt',
+                  'parameters': {'amplitude': par(80, 0), 'center': par(center, center - 1, center + 1),
+                                 'g_fwhm': par(0.3, 0.05, 5), 'l_fwhm': par(0.1, 0.01, 1)}}
+                 for i, center in enumerate((284.5, 286.5))]
+        self.assertTrue(fitter.fit(peaks, {'constant': par(4)}, support=8))
+        self.assertAlmostEqual(fitter.get_report().cost, 0.5 * np.sum(fitter.get_residuals() ** 2), places=8)
+        self.assertAlmostEqual(fitter.get_peaks('Peak0').get_parameters('g_fwhm'), 1.2, places=2)
+        model, values = fitter.get_fit_model()
+        np.testing.assert_allclose(model.evaluate(fitter.get_data()[0], values)[0], fitter.get_fit_line())
+
+    def test_compact_peaks(self):
+        fitter = sp.Fitter(make_region(self.energy, self.counts))
+        fitter.fit(self.peaks, self.bg)
+        ds = fitter.get_peaks('Peak0')
+        self.assertIs(ds.get_data()[0], fitter.get_data()[0])
+        self.assertIs(ds.get_data()[1], ds.get_data()[1])
+        np.testing.assert_allclose(ds.get_data()[1], sp.Fitter.doniach_sunjic(self.energy, *ds.get_parameters()))
+        x, y = ds.get_virtual_data(num=50, multiply=False)
+        np.testing.assert_allclose(y, sp.Fitter.doniach_sunjic(x, *ds.get_parameters()))
+        self.assertFalse(y.flags.writeable)
+        self.assertIn(f"Area: {ds.get_peak_area():.4f}", str(ds))
+        self.assertIn(str(ds), str(fitter))
+        # The curves are kept by the peak only, so the peaks go away with the fitter
+        ref = weakref.ref(ds)
+        del ds, fitter
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_virtual_curves(self):
+        fitter = sp.Fitter(make_region(self.energy, self.counts))
+        fitter.fit(self.peaks, self.bg)
+        peaks_line = sum(peak.get_data()[1] for peak in fitter.get_peaks())
+        x, bg = fitter.get_virtual_bg(num=1)
+        # The exact Shirley integral differs from the summation on the grid by half a step
+        step = abs(self.energy[1] - self.energy[0])
+        np.testing.assert_allclose(bg, fitter.get_fit_line() - peaks_line,
+                                   atol=fitter.get_bg()['shirley'][0] * step * np.amax(peaks_line) / 2 + 1e-6)
+        self.assertIs(fitter.get_virtual_fitline(usebg=True)[1], fitter.get_virtual_fitline(usebg=True)[1])
+        fitter.fit(self.peaks, {'constant': par(4)})
+        np.testing.assert_allclose(fitter.get_virtual_bg()[1], fitter.get_bg()['constant'][0])
+
+    def test_peak_areas(self):
+        dense = np.linspace(290, 280, 20001)
+        for peak_type, parameters in (("Gauss", [100, 284.5, 1.0]), ("Lorentz", [100, 284.5, 1.0]),
+                                      ("Pseudo Voigt", [100, 284.5, 0.8, 0.3]),
+                                      ("Doniach-Sunjic", [100, 284.5, 0.6, 0.2]),
+                                      ("Voigt", [100, 284.5, 0.8, 0.3])):
+            for binding in (True, False):
+                line = sp.Fitter.get_model_func(peak_type)(dense, *parameters,
+                                                           asymmetry='higher' if binding else 'lower')
+                self.assertAlmostEqual(sp.Peak.calculate_area(peak_type, parameters, (280, 290), binding),
+                                       np.trapz(line[::-1], dense[::-1]), delta=1e-3)
+        areas = sp.Peak.calculate_area("Gauss", [np.array([10, 20]), np.array([284, 285]), 1.0], (280, 290))
+        np.testing.assert_allclose(areas, [10, 20])
+
+    def test_voigt(self):
+        # Voigt reduces to Gauss and Lorentz at the limits of the widths
+        x = np.linspace(-3, 3, 601)
+        line = sp.Fitter.voigt(x, 1.0, 0.0, 1.0, 0.0)
+        np.testing.assert_allclose(line, sp.Fitter.gauss(x, 1.0, 0.0, 1.0), atol=1e-12)
+        line = sp.Fitter.voigt(x, 1.0, 0.0, 1e-6, 1.0)
+        np.testing.assert_allclose(line, sp.Fitter.lorentz(x, 1.0, 0.0, 1.0), rtol=1e-5)
+        self.assertAlmostEqual(sp.Peak.calculate_area("Voigt", [2.0, 0.0, 1.0, 1.0], (-1e6, 1e6)), 2.0, places=5)
+        fitter = sp.Fitter(make_region(self.energy, sp.Fitter.voigt(self.energy, 100, 284.5, 0.8, 0.3) + 5))
+        self.assertTrue(fitter.fit(fitter.guess_peaks('Voigt', max_peaks=1), fitter.guess_bg(('constant',))))
+        self.assertAlmostEqual(fitter.get_peaks('Peak0').get_parameters('amplitude'), 100, delta=1)
+        peak = fitter.get_peaks('Peak0')
+        self.assertAlmostEqual(peak.get_peak_area(), -np.trapz(peak.get_data()[1], self.energy), delta=0.1)
+
+    def test_resolution(self):
+        # Lorentz convolved with a Gaussian instrument function is the Voigt line
+        resolution = InstrumentResolution(fwhm=0.5)
+        line = resolution.convolve(self.energy, sp.Fitter.lorentz(resolution.get_grid(self.energy), 10, 285, 0.3))
+        np.testing.assert_allclose(line, sp.Fitter.voigt(self.energy, 10, 285, 0.5, 0.3), atol=1e-10)
+        offsets = np.linspace(-2, 2, 801)
+        measured = InstrumentResolution(kernel=(offsets, sp.Fitter.gauss(offsets, 3.0, 0.0, 0.5)))
+        line = measured.convolve(self.energy, sp.Fitter.gauss(measured.get_grid(self.energy), 10, 285, 0.4))
+        np.testing.assert_allclose(line, sp.Fitter.gauss(self.energy, 10, 285, np.hypot(0.4, 0.5)), atol=1e-2)
+        counts = sp.Fitter.voigt(self.energy, 100, 284.5, 0.5, 0.3) + 5
+        fitter = sp.Fitter(make_region(self.energy, counts))
+        peaks = [{'peakname': 'Peak0', 'fittype': 'Lorentz',
+                  'parameters': {'amplitude': par(80, 0), 'center': par(284.4, 283, 286), 'fwhm': par(0.6, 0.05, 2)}}]
+        self.assertTrue(fitter.fit(peaks, {'constant': par(4)}, resolution={20: 0.5}, support=8))
+        peak = fitter.get_peaks('Peak0')
+        self.assertAlmostEqual(peak.get_parameters('fwhm'), 0.3, places=3)
+        self.assertAlmostEqual(peak.get_parameters('amplitude'), 100, delta=0.1)
+        np.testing.assert_allclose(fitter.get_fit_line(), counts, atol=1e-3)
+        with self.assertRaises(KeyError):
+            fitter.fit(peaks, resolution={50: 0.5})
+
+    def test_fermi_edge(self):
+        x = np.linspace(-0.5, 0.5, 201)
+        # At zero temperature the edge is the complementary error function
+        sigma = 0.1 / (2 * np.sqrt(2 * np.log(2)))
+        np.testing.assert_allclose(sp.helpers.fermi_edge(x, 100, 0.02, 0.1, 5, 1e-3, oversample=8),
+                                   50 * special.erfc((0.02 - x) / (sigma * np.sqrt(2))) + 5, atol=1e-3)
+        counts = sp.helpers.fermi_edge(x, 100, 0.02, 0.1, 5, 300, 20)
+        region = make_region(x, counts + np.random.default_rng(0).normal(0, 0.5, x.size))
+        region.set_fermi_flag()
+        popt, errors = sp.helpers.fit_fermi_edge(region, [90, 0.0, 0.08, 4], model='fermi', fix_pars=['temperature'])
+        self.assertEqual(len(popt), len(sp.helpers.fermi_edge_params))
+        self.assertAlmostEqual(popt[1], 0.02, delta=3 * errors[1])
+        self.assertAlmostEqual(popt[2], 0.1, delta=3 * errors[2])
+        self.assertEqual((popt[4], errors[4]), (300, 0))
+        np.testing.assert_allclose(region.get_data("fitFermi"), counts, atol=0.5)
+        with self.assertRaises(ValueError):
+            sp.helpers.fit_fermi_edge(region, [90, 0.0, 0.08], model='fermi')
+        popt, errors = sp.helpers.fit_fermi_edge(region, [100, 0.0, 0.05, 5])
+        self.assertEqual(len(popt), 4)
+
+    def test_region_fingerprint(self):
+        region = make_region(self.energy, self.counts)
+        twin = sp.Region(self.energy.copy(), self.counts.copy(), info=dict(region.get_info()),
+                         conditions={"Comments": ""}, id_="Twin")
+        self.assertEqual(region.get_fingerprint(), twin.get_fingerprint())
+        other = make_region(self.energy, self.counts, region_id="Other")
+        self.assertEqual(other.get_fingerprint(metadata=False), region.get_fingerprint(metadata=False))
+        self.assertNotEqual(other.get_fingerprint(), region.get_fingerprint())
+        collection = sp.RegionsCollection([region])
+        self.assertTrue(collection.is_duplicate(twin.get_id(), twin))
+        self.assertIsNone(collection.add_regions([twin], by_content=True))
+        self.assertEqual(sp.RegionsCollection([region]).add_regions([twin]), [twin.get_id()])
+        sweeps = sp.Region(self.energy, self.counts, add_dimension_flag=True,
+                           add_dimension_data=[self.counts, self.counts * 2], info=dict(region.get_info()),
+                           conditions={"Comments": ""}, id_="Sweeps")
+        first, second = sp.Region.separate_add_dimension(sweeps)
+        meta_hash = second.get_meta_hash()
+        first.set_info_entry(sp.Region.info_entries[1], "50", overwrite=True)
+        self.assertEqual(second.get_info(sp.Region.info_entries[1]), "20")
+        self.assertEqual(second.get_meta_hash(), meta_hash)
+        energy_hash, meta_hash = twin.get_column_hash('energy'), twin.get_meta_hash()
+        twin.correct_energy_shift(0.1)
+        self.assertNotEqual(twin.get_column_hash('energy'), energy_hash)
+        self.assertNotEqual(twin.get_meta_hash(), meta_hash)
+        final_hash = twin.get_column_hash('final')
+        twin.add_column('final', self.counts * 2, overwrite=True)
+        self.assertNotEqual(twin.get_column_hash('final'), final_hash)
+        self.assertEqual(twin.get_column_hash('counts'), region.get_column_hash('counts'))
+        self.assertFalse(collection.is_duplicate(twin.get_id(), twin))
+
+    def test_guess_peaks(self):
+        fitter = sp.Fitter(make_region(self.energy, self.counts))
+        peaks = fitter.guess_peaks('Doniach-Sunjic', max_peaks=1) + fitter.guess_peaks('Gauss')[1:]
+        self.assertEqual(len(peaks), 2)
+        self.assertAlmostEqual(peaks[0]['parameters']['center']['value'], 284.5, delta=0.1)
+        self.assertAlmostEqual(peaks[1]['parameters']['center']['value'], 286.3, delta=0.5)
+        self.assertTrue(fitter.fit(peaks, fitter.guess_bg()))
+        self.assertAlmostEqual(fitter.get_peaks('Peak1').get_parameters('fwhm'), 1.2, delta=0.05)
+
+
+class TestGlobalFit(unittest.TestCase):
+    def setUp(self):
+        energy = np.linspace(290, 280, 151)
+        rng = np.random.default_rng(1)
+        self.regions = []
+        for i in range(3):
+            peaks_line = (sp.Fitter.gauss(energy, 100 + 10 * i, 284.5 + 0.05 * i, 1.0) +
+                          sp.Fitter.gauss(energy, 0.5 * (100 + 10 * i), 286.0 + 0.05 * i, 1.0))
+            counts = peaks_line + 5 + rng.normal(0, 0.5, energy.size)
+            self.regions.append(make_region(energy, counts, region_id=f"Synthetic{i}"))
+        self.peaks = [
+            {'peakname': 'Peak0', 'fittype': 'Gauss',
+             'parameters': {'amplitude': par(90, 0, 1000), 'center': par(284.4, 283, 286),
+                            'fwhm': par(0.8, 0.1, 3, dependencetype='Common')}},
+            {'peakname': 'Peak1', 'fittype': 'Gauss',
+             'parameters': {'amplitude': par(0.4, 0.1, 1, dependencetype='Dependent *', dependencebase=0),
+                            'center': par(1.4, 1, 2, dependencetype='Dependent +', dependencebase=0),
+                            'fwhm': par(0.8, 0.1, 3, dependencetype='Common')}}
+        ]
+        self.bg = {'constant': par(4, 0, 10)}
+
+    def test_scipy_backend(self):
+        lmfit_fitters = GlobalFit(self.regions, self.peaks, self.bg).fit(backend='lmfit')
+        scipy_fitters = GlobalFit(self.regions, self.peaks, self.bg).fit(backend='scipy')
+        for lmfit_fitter, scipy_fitter in zip(lmfit_fitters, scipy_fitters):
+            for lmfit_peak, scipy_peak in zip(lmfit_fitter.get_peaks(), scipy_fitter.get_peaks()):
+                np.testing.assert_allclose(scipy_peak.get_parameters(), lmfit_peak.get_parameters(), rtol=1e-5)
+                np.testing.assert_allclose(scipy_peak.get_fitting_errors(), lmfit_peak.get_fitting_errors(),
+                                           rtol=1e-3)
+        self.assertAlmostEqual(scipy_fitters[2].get_peaks()[1].get_parameters('amplitude'), 60, delta=3)
+
+    def test_bootstrap(self):
+        fitters = GlobalFit(self.regions, self.peaks, self.bg).fit(backend='scipy')
+        table = bootstrap(fitters[:2], n_samples=60, seed=0, processes=2, chunksize=20)
+        self.assertEqual(table.index.get_level_values('fit').unique().to_list(), ["Synthetic0", "Synthetic1"])
+        self.assertTrue((table['samples'] == 60).all())
+        peak = fitters[1].get_peaks('Peak1')
+        results = table.loc["Synthetic1"]
+        self.assertAlmostEqual(results.loc['Peak1_center', 'value'], peak.get_parameters('center'), places=6)
+        self.assertAlmostEqual(results.loc['Peak1_area', 'value'], peak.get_peak_area(), places=6)
+        self.assertTrue((results['low'] <= results['value']).all() and (results['value'] <= results['high']).all())
+        self.assertAlmostEqual(results.loc['Peak1_amplitude', 'std'], peak.get_fitting_errors('amplitude'),
+                               delta=0.5 * peak.get_fitting_errors('amplitude'))
+        fitter = sp.Fitter(self.regions[0])
+        fitter.fit(self.peaks, self.bg)
+        results = bootstrap(fitter, n_samples=20, method='poisson', seed=0).loc["Synthetic0"]
+        self.assertAlmostEqual(results.loc['Peak0_area', 'value'], fitter.get_peaks('Peak0').get_peak_area())
+        fitter.fit_gaussian([90, 284.5, 1.0])
+        with self.assertRaises(ValueError):
+            bootstrap(fitter)
+
+    def test_multistart(self):
+        peaks = copy.deepcopy(self.peaks)
+        for peak in peaks:
+            peak['parameters']['fwhm']['value'] = 0.2
+        peaks[0]['parameters']['center']['value'] = 283.1
+        single = GlobalFit(self.regions, peaks, self.bg)
+        single.fit(backend='scipy')
+        fit = GlobalFit(self.regions, peaks, self.bg)
+        fitters = fit.fit_multistart(n_starts=4, seed=0, processes=2)
+        starts = fit.get_starts()
+        self.assertEqual(len(starts), 4)
+        self.assertAlmostEqual(starts[0]['cost'], 0.5 * single._Result.chisqr, delta=1e-6 * single._Result.chisqr)
+        self.assertAlmostEqual(fit.get_report().cost, min(start['cost'] for start in starts))
+        self.assertLess(fit._Result.chisqr, 0.01 * single._Result.chisqr)
+        self.assertAlmostEqual(fitters[0].get_peaks('Peak0').get_parameters('center'), 284.5, delta=0.05)
+        points = GlobalFit.multistart_points(np.array([1.0, 5.0]), np.array([0.0, -np.inf]), np.array([2.0, np.inf]),
+                                             5, seed=0)
+        np.testing.assert_array_equal(points[0], [1.0, 5.0])
+        self.assertTrue((points[:, 0] >= 0).all() and (points[:, 0] <= 2).all())
+        self.assertTrue((np.absolute(points[:, 1] - 5.0) <= 2.5).all())
+
+    def test_evaluation_plan(self):
+        peaks = copy.deepcopy(self.peaks)
+        peaks.append({'peakname': 'Peak2', 'fittype': 'Doniach-Sunjic',
+                      'parameters': {'amplitude': par(0.2, 0.01, 1, dependencetype='Dependent *', dependencebase=0),
+                                     'center': par(-1.5, -2, -1, dependencetype='Dependent +', dependencebase=0),
+                                     'g_fwhm': par(0.6, 0.1, 2), 'l_fwhm': par(0.1, 0.01, 0.5, dependencetype='Common')}})
+        bg = {'constant': par(4, 0, 10), 'linear': par(0.01, -1, 1), 'square': par(1e-3, -1, 1),
+              'shirley': par(0.02, 0, 1)}
+        fit = GlobalFit(self.regions, peaks, bg)
+        params = copy.deepcopy(fit._FitParams)
+        for param in params.values():
+            if param.vary and param.expr is None:
+                param.value = param.value * 1.01 + 1e-3
+        # Residuals of the lmfit parameter path the plan replaced
+        expected = []
+        for i, data in enumerate(fit._Data):
+            line = np.zeros_like(data['intensity'])
+            for peak in peaks:
+                values = {name: {'value': params[f"{peak['peakname']}_{name}_{i}"].value}
+                          for name in peak['parameters']}
+                line += sp.Fitter.get_model(peak['fittype'], data['energy'], data['intensity'], values)
+            bg_line = np.zeros_like(line)
+            for bg_type, bg_params in fit.get_bg_values(params, i).items():
+                bg_line += sp.Fitter.get_model(bg_type, data['energy'], line, {'value': bg_params['value'].value})
+            expected.append(data['intensity'] - line - bg_line)
+        # Equal up to the rounding of the summation order
+        np.testing.assert_allclose(fit.err_func(params), np.concatenate(expected), rtol=1e-12, atol=1e-12)
+
+    def test_jacobian_sparsity(self):
+        bg = {'constant': par(4, 0, 10), 'shirley': par(0.02, 0, 1)}
+        fit = GlobalFit(self.regions, self.peaks, bg)
+        sparsity = fit.get_jacobian_sparsity().toarray()
+        free_names = [name for name, param in fit._FitParams.items() if param.vary and param.expr is None]
+        self.assertEqual(sparsity.shape, (fit._Plan.size, len(free_names)))
+        # Every nonzero of the finite-difference Jacobian is within the pattern
+        base = fit.err_func(fit._FitParams)
+        for column, name in enumerate(free_names):
+            params = copy.deepcopy(fit._FitParams)
+            params[name].value = params[name].value * (1 + 1e-6) + 1e-6
+            derivative = fit.err_func(params) - base
+            self.assertFalse(np.any((derivative != 0) & (sparsity[:, column] == 0)), name)
+        # Spectra don't depend on the parameters of other spectra
+        self.assertEqual(sparsity[:fit._Plan.offsets[1], free_names.index('Peak0_amplitude_1')].sum(), 0)
+
+    def test_resolution(self):
+        fit = GlobalFit(self.regions, self.peaks, self.bg, resolution=0.6)
+        fitters = fit.fit(backend='scipy')
+        self.assertAlmostEqual(fitters[0].get_peaks('Peak0').get_parameters('fwhm'), 0.8, delta=0.02)
+        self.assertLess(np.std(fitters[1].get_residuals()), 0.6)
+        model, values = fitters[1].get_fit_model()
+        np.testing.assert_allclose(model.evaluate(self.regions[1].get_data('energy'), values)[0],
+                                   fitters[1].get_fit_line())
+        # One instrument function shared by many spectra keeps the grids of all of them
+        regions = [make_region(region.get_data('energy').copy(), region.get_data('final'), region_id=f"Copy{i}")
+                   for i in range(12) for region in self.regions]
+        shared = InstrumentResolution(fwhm=0.6)
+        fit = GlobalFit(regions, self.peaks, self.bg, resolution=shared)
+        fit.err_func(fit._FitParams)
+        grids = {key: cached[1] for key, cached in shared._Grids.items()}
+        fit.err_func(fit._FitParams)
+        self.assertEqual(len(grids), len(regions))
+        self.assertTrue(all(shared._Grids[key][1] is grid for key, grid in grids.items()))
+
+    def test_report(self):
+        fit = GlobalFit(self.regions, self.peaks, self.bg)
+        with self.assertLogs('specqp.fitter', level='DEBUG') as logs:
+            fit.fit(backend='scipy', trace=True)
+        report = fit.get_report()
+        self.assertIn(str(report), logs.output[-1])
+        self.assertEqual(len(report.trace), report.evaluations)
+        self.assertAlmostEqual(min(report.trace), report.cost)
+        self.assertAlmostEqual(report.cost, 0.5 * fit._Result.chisqr)
+
+    def test_parallel_residuals(self):
+        serial = GlobalFit(self.regions, self.peaks, self.bg)
+        parallel = GlobalFit(self.regions, self.peaks, self.bg, workers=2)
+        np.testing.assert_array_equal(parallel.err_func(parallel._FitParams), serial.err_func(serial._FitParams))
+        parallel._Plan.close()
+
+    def test_warm_start(self):
+        fit = GlobalFit(self.regions, self.peaks, self.bg)
+        self.assertEqual(fit.warm_start(), len(self.regions))
+        self.assertAlmostEqual(fit._FitParams['Peak1_amplitude_0_base'].value, 0.5, delta=0.05)
+        self.assertAlmostEqual(fit._FitParams['Peak0_fwhm_0'].value, 1.0, delta=0.05)
+        fitters = fit.fit(backend='scipy')
+        self.assertAlmostEqual(fitters[1].get_peaks()[1].get_parameters('center'), 286.05, delta=0.05)
+
+    def test_cancel(self):
+        fit = GlobalFit(self.regions, self.peaks, self.bg)
+        fitters = fit.fit(backend='scipy', callback=lambda evaluation, cost: evaluation >= 3)
+        self.assertTrue(fit._Result.aborted)
+        self.assertEqual(len(fitters[0].get_peaks()), 2)
+        self.assertIsNone(fitters[0].get_peaks()[0].get_fitting_errors('center'))
+        # Fitting again replaces the peaks of the aborted fit
+        fitters = fit.fit(backend='scipy')
+        for i, fitterobj in enumerate(fitters):
+            self.assertEqual(len(fitterobj.get_peaks()), 2)
+            for peak in fitterobj.get_peaks():
+                self.assertEqual(peak.get_parameters('center'),
+                                 fit._Result.params[f"{peak.get_peak_id()}_center_{i}"].value)
+            model, values = fitterobj.get_fit_model()
+            np.testing.assert_allclose(sum(peak.get_data()[1] for peak in fitterobj.get_peaks()),
+                                       model.evaluate_peaks(fitterobj.get_data()[0], values))
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "fit.json")
+            fit = GlobalFit(self.regions, self.peaks, self.bg)
+            fit.fit(backend='scipy', checkpoint=filename, callback=lambda evaluation, cost: evaluation >= 5)
+            resumed = GlobalFit.from_checkpoint(filename, self.regions)
+            self.assertEqual(os.listdir(directory), ["fit.json"])
+            initial = GlobalFit(self.regions, self.peaks, self.bg)
+            self.assertLess(np.sum(resumed.err_func(resumed._FitParams) ** 2),
+                            np.sum(initial.err_func(initial._FitParams) ** 2))
+            resumed.fit(backend='scipy', checkpoint=filename)
+            with open(filename) as checkpoint:
+                self.assertTrue(json.load(checkpoint)['state']['finished'])
+
+    def test_sequential(self):
+        fit = GlobalFit(self.regions, self.peaks, self.bg)
+        centers = []
+        fitters = fit.fit_sequential(callback=lambda ind, fitterobj: centers.append(
+            fitterobj.get_peaks()[0].get_parameters('center')) or ind == 1)
+        self.assertEqual(len(fitters), 2)
+        np.testing.assert_allclose(centers, [284.5, 284.55], atol=0.02)
+        np.testing.assert_allclose(GlobalFit.extrapolate([[1, 10], [2, 8], [3, 6]]), [4, 4])
+
+
+class TestBatchFit(unittest.TestCase):
+    def setUp(self):
+        self.energy = np.linspace(290, 280, 151)
+        rng = np.random.default_rng(2)
+        self.sweeps = []
+        for i in range(4):
+            peaks_line = (sp.Fitter.pseudo_voigt(self.energy, 100 - 10 * i, 284.5, 0.8, 0.3) +
+                          sp.Fitter.gauss(self.energy, 30 + 10 * i, 286.0, 1.0))
+            self.sweeps.append(peaks_line + sp.Fitter.shirley(self.energy, peaks_line, 0.02) + 3 +
+                               rng.normal(0, 0.5, self.energy.size))
+        self.peaks = [
+            {'peakname': 'Peak0', 'fittype': 'Pseudo Voigt',
+             'parameters': {'amplitude': par(80, 0, 1000), 'center': par(284.4, 283, 286),
+                            'g_fwhm': par(0.7, 0.2, 2), 'l_fwhm': par(0.2, 0.01, 1)}},
+            {'peakname': 'Peak1', 'fittype': 'Gauss',
+             'parameters': {'amplitude': par(40, 0, 1000), 'center': par(1.4, 1, 2, dependencetype='Dependent +',
+                                                                         dependencebase=0),
+                            'fwhm': par(0.8, 0.2, 3)}}
+        ]
+        self.bg = {'shirley': par(0.01, 0, 1), 'constant': par(2, 0, 10)}
+
+    def test_batch_fit(self):
+        info = make_region(self.energy, self.sweeps[0]).get_info()
+        region = sp.Region(self.energy, self.sweeps[0], add_dimension_flag=True, add_dimension_data=self.sweeps,
+                           info=info, conditions={"Comments": ""}, id_="Sweeps")
+        batch = BatchFit.from_region(region, self.peaks, self.bg)
+        values, errors = batch.fit()
+        self.assertTrue(np.all(batch.success))
+        model = CompositeModel(self.peaks, self.bg)
+        for i, sweep in enumerate(self.sweeps):
+            ref_values, ref_errors, _ = model.fit(self.energy, sweep)
+            np.testing.assert_allclose(values[i], ref_values, rtol=1e-4, atol=1e-6)
+            np.testing.assert_allclose(errors[i], ref_errors, rtol=1e-2)
+        self.assertAlmostEqual(values[3, batch.names.index('Peak1_center')], 286.0, delta=0.05)
+        # With a wrong Jacobian no step decreases the cost, the spectra stall away from the minimum
+        jacobian = batch._jacobian
+        batch._jacobian = lambda free_values, lines: -jacobian(free_values, lines)
+        with self.assertLogs('specqp.batchfitter', level='WARNING'):
+            batch.fit(ftol=0, xtol=0)
+        self.assertTrue(np.all(batch.stalled))
+        self.assertFalse(np.any(batch.success))
+
+    def test_fit_regions(self):
+        regions = sp.RegionsCollection([make_region(self.energy, sweep, region_id=f"Sweep{i}")
+                                        for i, sweep in enumerate(self.sweeps)])
+        table = fit_regions(regions, self.peaks, self.bg, processes=2, chunksize=1)
+        self.assertEqual(table.index.to_list(), regions.get_ids())
+        self.assertTrue(table['success'].all())
+        model = CompositeModel(self.peaks, self.bg)
+        ref_values, ref_errors, _ = model.fit(self.energy, self.sweeps[2])
+        np.testing.assert_allclose(table.loc["Sweep2", model.names].astype(float), ref_values)
+        np.testing.assert_allclose(table.loc["Sweep2", [f"{name}_err" for name in model.names]].astype(float),
+                                   ref_errors)
+
+    def test_fit_cache(self):
+        regions = [make_region(self.energy, sweep, region_id=f"Sweep{i}") for i, sweep in enumerate(self.sweeps)]
+        cache = FitCache(max_entries=3)
+        first = fit_regions(regions[:2], self.peaks, self.bg, processes=1, cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 2, 2))
+        table = fit_regions(regions[::-1], self.peaks, self.bg, processes=1, cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 4, 3))
+        pd.testing.assert_frame_equal(table.loc[first.index], first)
+        self.assertNotIn(cache.make_key(regions[1], 'final', 'fit_regions', self.peaks, self.bg, {}), cache)
+        fit_regions(regions[:1], self.peaks, self.bg, processes=1, cache=cache, max_nfev=5)
+        self.assertEqual(cache.misses, 5)
+        fit = GlobalFit(regions[:2], self.peaks, self.bg)
+        runner = FitRunner(fit, cache=cache)
+        for _ in range(2):
+            runner.start(backend='scipy')
+            runner._Thread.join()
+            message = runner.messages.get()
+            while message[0] != 'done':
+                message = runner.messages.get()
+        self.assertEqual((cache.hits, cache.misses), (3, 6))
+        fitters = GlobalFit(regions[:2], self.peaks, self.bg).fit(backend='scipy')
+        np.testing.assert_allclose(message[1][1].get_fit_line(), fitters[1].get_fit_line())
+
+
+if __name__ == '__main__':
+    unittest.main()